@@ -7,6 +7,13 @@ import datetime
 import numpy as np
 import pandas as pd
 import yaht.cache_management as CM
+from yaht.serializers import register_serializer
+from yaht.compression import (
+    CODECS,
+    CompressingWriter,
+    TRIAL_SAMPLE_SIZE,
+    check_compression,
+)
 
 
 @pytest.fixture
@@ -70,3 +77,216 @@ def test_data_last_changed_date(cache_dir):
     recorded_time_created = metadata.loc[data_hash, "time_created"]
     recorded_time_modified = metadata.loc[data_hash, "time_modified"]
     assert recorded_time_created < recorded_time_modified
+
+
+def test_store_array_data(cache_dir):
+    """Arrays should be stored in their own format, recorded in the metadata"""
+    fake_data = np.arange(100).reshape(10, 10)
+    CM.store_cache_data(cache_dir, "DATA_KEY", fake_data)
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "serializer"] == "npy"
+    data_path = CM.get_cache_path(cache_dir, {"hash": "DATA_KEY", "serializer": "npy"})
+    assert data_path.endswith("DATA_KEY.npy")
+    # The file should be a plain numpy file
+    loaded_file = np.load(data_path)
+    assert (loaded_file == fake_data).all()
+
+    loaded_data = CM.load_cache_data(cache_dir, "DATA_KEY")
+    assert (loaded_data == fake_data).all()
+
+
+def test_mmap_object_array_data(cache_dir):
+    """Arrays of python objects can't be memory mapped, so are loaded normally"""
+    fake_data = np.array([{"some": "dict"}, None, "a string"], dtype=object)
+    CM.store_cache_data(cache_dir, "DATA_KEY", fake_data)
+    loaded_data = CM.load_cache_data(cache_dir, "DATA_KEY", mmap=True)
+    assert type(loaded_data) == np.ndarray
+    assert list(loaded_data) == list(fake_data)
+
+    # Other arrays should still be memory mapped
+    CM.store_cache_data(cache_dir, "ARRAY_KEY", np.arange(10))
+    assert type(CM.load_cache_data(cache_dir, "ARRAY_KEY", mmap=True)) == np.memmap
+
+
+def test_store_dataframe_data(cache_dir):
+    """Dataframes should be stored as parquet files when pyarrow is installed"""
+    pytest.importorskip("pyarrow")
+    fake_data = pd.DataFrame({"x": np.arange(10), "y": list("abcdefghij")})
+    CM.store_cache_data(cache_dir, "DATA_KEY", fake_data)
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "serializer"] == "parquet"
+    data_path = CM.get_cache_path(
+        cache_dir, {"hash": "DATA_KEY", "serializer": "parquet"}
+    )
+    assert data_path.endswith("DATA_KEY.parquet")
+
+    loaded_data = CM.load_cache_data(cache_dir, "DATA_KEY")
+    pd.testing.assert_frame_equal(loaded_data, fake_data)
+
+
+class FakeArray(np.ndarray):
+    pass
+
+
+def test_store_array_subclass_data(cache_dir):
+    """Array subclasses should be pickled, so they come back as the same type"""
+    fake_matrix = np.arange(4).reshape(2, 2).view(FakeArray)
+    fake_masked = np.ma.masked_array(np.zeros(1000000), mask=np.arange(1000000) % 2)
+    CM.store_cache_data(cache_dir, "MATRIX_KEY", fake_matrix)
+    CM.store_cache_data(cache_dir, "MASKED_KEY", fake_masked, compression="gzip")
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["MATRIX_KEY", "serializer"] == "pickle"
+    assert metadata.loc["MASKED_KEY", "codec"] == "gzip"
+
+    loaded_matrix = CM.load_cache_data(cache_dir, "MATRIX_KEY")
+    assert type(loaded_matrix) == FakeArray
+    assert (loaded_matrix == fake_matrix).all()
+    loaded_masked = CM.load_cache_data(cache_dir, "MASKED_KEY", mmap=True)
+    assert type(loaded_masked) == np.ma.MaskedArray
+    assert (loaded_masked.mask == fake_masked.mask).all()
+
+
+def test_register_serializer(cache_dir):
+    """Custom serializers should be used for their type and subtypes"""
+
+    class FakeData(str):
+        pass
+
+    register_serializer(
+        FakeData,
+        lambda data, f: f.write(data.encode()),
+        lambda f: FakeData(f.read().decode()),
+        ext=".fake",
+    )
+    CM.store_cache_data(cache_dir, "DATA_KEY", FakeData("some fake data"))
+    data_path = CM.get_cache_path(cache_dir, {"hash": "DATA_KEY", "serializer": "fake"})
+    with open(data_path, "r") as f:
+        assert f.read() == "some fake data"
+    loaded_data = CM.load_cache_data(cache_dir, "DATA_KEY")
+    assert type(loaded_data) == FakeData
+    assert loaded_data == "some fake data"
+
+
+class UnserializableData(list):
+    pass
+
+
+def test_serializer_fallback(cache_dir):
+    """Data a serializer fails to store should be pickled instead"""
+
+    def broken_dump(data, f):
+        raise ValueError("Can't serialize")
+
+    register_serializer(UnserializableData, broken_dump, None, ext=".broken")
+    CM.store_cache_data(cache_dir, "DATA_KEY", UnserializableData([1, 2, 3]))
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "serializer"] == "pickle"
+    assert CM.load_cache_data(cache_dir, "DATA_KEY") == [1, 2, 3]
+
+
+class PartlySerializableData(list):
+    pass
+
+
+def test_partial_serializer_fallback(cache_dir):
+    """Data a serializer fails partway through storing shouldn't leave a file behind"""
+
+    def partial_dump(data, f):
+        f.write(b"partial data")
+        raise ValueError("Can't serialize")
+
+    register_serializer(PartlySerializableData, partial_dump, None, ext=".partial")
+    CM.store_cache_data(cache_dir, "DATA_KEY", PartlySerializableData([1, 2, 3]))
+    shard_dir = os.path.join(cache_dir, CM.get_cache_shard("DATA_KEY"))
+    assert os.listdir(shard_dir) == ["DATA_KEY"]
+    # Syncing shouldn't find anything else, or change how the data is loaded
+    os.utime(shard_dir, (0, 0))
+    CM.sync_cache_metadata(cache_dir)
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "serializer"] == "pickle"
+    assert CM.load_cache_data(cache_dir, "DATA_KEY") == [1, 2, 3]
+
+
+def test_crashed_dump_ignored(cache_dir):
+    """Files left behind by dumps that crashed shouldn't be synced"""
+    CM.store_cache_data(cache_dir, "DATA_KEY", [1, 2, 3])
+    shard_dir = os.path.join(cache_dir, CM.get_cache_shard("DATA_KEY"))
+    with open(
+        os.path.join(shard_dir, "DATA_KEY.npy.1234" + CM.TEMP_FILE_SUFFIX), "wb"
+    ) as f:
+        f.write(b"truncated")
+    CM.sync_cache_metadata(cache_dir)
+    assert list(CM.load_cache_metadata(cache_dir)["hash"]) == ["DATA_KEY"]
+    assert CM.load_cache_data(cache_dir, "DATA_KEY") == [1, 2, 3]
+
+
+def test_compressed_data(cache_dir):
+    """Large compressible data should be compressed, recording the codec used"""
+    fake_data = ["This", "is", "some", "fake", "data"] * 200000
+    CM.store_cache_data(cache_dir, "DATA_KEY", fake_data, compression="size")
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "codec"] in CODECS
+    # The data should be loaded back the same regardless
+    assert CM.load_cache_data(cache_dir, "DATA_KEY") == fake_data
+
+    # Specific codecs can also be asked for
+    fake_array = np.zeros((1000, 1000))
+    CM.store_cache_data(cache_dir, "ARRAY_KEY", fake_array, compression="gzip")
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["ARRAY_KEY", "codec"] == "gzip"
+    data_path = CM.get_cache_path(cache_dir, {"hash": "ARRAY_KEY", "serializer": "npy"})
+    assert os.path.getsize(data_path) < 1000 * 1000
+    # Compressed arrays can't be memory mapped, so are loaded normally
+    loaded_array = CM.load_cache_data(cache_dir, "ARRAY_KEY", mmap=True)
+    assert type(loaded_array) == np.ndarray
+    assert (loaded_array == fake_array).all()
+
+
+def test_unknown_compression(cache_dir):
+    """Compression settings that don't name a codec should raise an error"""
+    with pytest.raises(ValueError, match="gzip"):
+        CM.store_cache_data(cache_dir, "DATA_KEY", [1, 2, 3], compression="gzp")
+    with pytest.raises(ValueError, match="size"):
+        check_compression("smallest")
+    check_compression("none")
+
+
+def test_compression_threshold(cache_dir):
+    """Data should be compressed once it reaches the threshold, however small"""
+    fake_array = np.zeros(20000)
+    CM.store_cache_data(
+        cache_dir,
+        "ARRAY_KEY",
+        fake_array,
+        compression="gzip",
+        compression_threshold=1000,
+    )
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["ARRAY_KEY", "codec"] == "gzip"
+    assert (CM.load_cache_data(cache_dir, "ARRAY_KEY") == fake_array).all()
+
+
+def test_compress_large_writes(mocker):
+    """Large writes should be streamed through without being held back"""
+    data_file = mocker.Mock()
+    writer = CompressingWriter(data_file, "gzip", threshold=1000)
+    writer.write(b"a" * 10)
+    assert writer.stream is None
+    large_data = bytearray(2 * TRIAL_SAMPLE_SIZE)
+    writer.write(large_data)
+    assert writer.codec == "gzip"
+    assert len(writer.held_back) == 0
+    assert writer.tell() == 10 + len(large_data)
+
+
+def test_uncompressed_data(cache_dir):
+    """Small or incompressible data shouldn't be compressed"""
+    fake_data = ["This", "is", "some", "fake", "data"]
+    CM.store_cache_data(cache_dir, "SMALL_KEY", fake_data, compression="size")
+    random_data = np.random.default_rng(0).bytes(2 * 1024 * 1024)
+    CM.store_cache_data(cache_dir, "RANDOM_KEY", random_data, compression="speed")
+
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert pd.isnull(metadata.loc["SMALL_KEY", "codec"])
+    assert pd.isnull(metadata.loc["RANDOM_KEY", "codec"])
+    assert CM.load_cache_data(cache_dir, "RANDOM_KEY") == random_data
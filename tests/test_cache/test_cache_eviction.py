@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import pytest
+import tempfile
+import datetime
+import yaht.cache_management as CM
+
+
+@pytest.fixture
+def cache_dir():
+    new_dir = tempfile.mkdtemp()
+    yield os.path.join(new_dir, "cache")
+    shutil.rmtree(new_dir)
+
+
+def store_computed_data(cache_dir, data_hash, data, compute_time, access_count=0):
+    CM.store_cache_data(cache_dir, data_hash, data)
+    CM.store_cache_metadata_rows(
+        cache_dir,
+        [
+            {
+                "hash": data_hash,
+                "compute_time": compute_time,
+                "access_count": access_count,
+                "time_accessed": datetime.datetime.now(),
+            }
+        ],
+    )
+
+
+def test_parse_byte_size():
+    """Cache budgets can be given as numbers of bytes or with units"""
+    assert CM.parse_byte_size(None) is None
+    assert CM.parse_byte_size(2048) == 2048
+    assert CM.parse_byte_size("2048") == 2048
+    assert CM.parse_byte_size("500MB") == 500 * 1024**2
+    assert CM.parse_byte_size("1.5 GiB") == int(1.5 * 1024**3)
+    with pytest.raises(ValueError):
+        CM.parse_byte_size("lots")
+
+
+def test_record_data_size(cache_dir):
+    """The size of stored data should be recorded in the metadata"""
+    CM.store_cache_data(cache_dir, "some_hash", "x" * 1000)
+    metadata = CM.load_cache_metadata_rows(cache_dir, ["some_hash"])["some_hash"]
+    data_path = CM.get_cache_path(cache_dir, metadata)
+    assert metadata["size"] == os.path.getsize(data_path)
+
+
+def test_no_eviction_within_budget(cache_dir):
+    """Nothing should be evicted from a cache within its budget"""
+    store_computed_data(cache_dir, "some_hash", "x" * 1000, 1.0)
+    assert CM.evict_cache_data(cache_dir, 1024**2) == []
+    assert CM.find_cached_hashes(cache_dir, ["some_hash"]) == {"some_hash"}
+
+
+def test_evict_lowest_scores(cache_dir):
+    """Data that is quick to recompute, rarely used or large should go first"""
+    store_computed_data(cache_dir, "slow", "x" * 1000, 100.0)
+    store_computed_data(cache_dir, "fast", "x" * 1000, 0.1)
+    store_computed_data(cache_dir, "popular", "x" * 1000, 0.1, access_count=10000)
+    store_computed_data(cache_dir, "large", "x" * 100000, 1.0)
+
+    # Only leave space for roughly two small files
+    evicted_hashes = CM.evict_cache_data(cache_dir, 2500)
+    assert evicted_hashes == ["large", "fast"]
+    cached_hashes = CM.find_cached_hashes(cache_dir, ["slow", "popular"])
+    assert cached_hashes == {"slow", "popular"}
+    # The evicted files should be gone, and stay gone after syncing
+    CM.sync_cache_metadata(cache_dir)
+    assert CM.find_cached_hashes(cache_dir, ["fast", "large"]) == set()
+
+
+def test_never_evict_uncomputed_data(cache_dir):
+    """Data that wasn't computed by a process (e.g. added files) can't be recomputed"""
+    CM.store_cache_data(cache_dir, "source", "x" * 1000)
+    store_computed_data(cache_dir, "computed", "x" * 1000, 1.0)
+
+    assert CM.evict_cache_data(cache_dir, 0) == ["computed"]
+    assert CM.find_cached_hashes(cache_dir, ["source"]) == {"source"}
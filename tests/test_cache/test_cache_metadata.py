@@ -28,10 +28,36 @@ def test_generate_cache_metadata(cache_dir):
     assert type(metadata) == pd.DataFrame
     assert len(metadata) == 0
     # Calling load_cache_metadata should create a cache folder and a metadata file
-    metadata_path = os.path.join(cache_dir, "metadata.csv")
+    metadata_path = os.path.join(cache_dir, "metadata.db")
     assert os.path.exists(metadata_path)
 
 
+def test_migrate_legacy_metadata(cache_dir):
+    """Caches with a metadata.csv should be converted to the metadata database"""
+    os.makedirs(cache_dir)
+    legacy_metadata = pd.DataFrame(
+        [
+            {
+                "hash": "SOME_HASH",
+                "filename": "some_filename",
+                "sources": ["some_source"],
+                "time_created": datetime.datetime(2024, 1, 1),
+                "time_modified": datetime.datetime(2024, 1, 2),
+            },
+        ]
+    )
+    legacy_metadata.to_csv(os.path.join(cache_dir, "metadata.csv"), index=False)
+
+    loaded_metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert loaded_metadata.loc["SOME_HASH", "filename"] == "some_filename"
+    assert loaded_metadata.loc["SOME_HASH", "sources"] == ["some_source"]
+    assert loaded_metadata.loc["SOME_HASH", "time_created"] == datetime.datetime(
+        2024, 1, 1
+    )
+    # The old metadata file should be gone once it has been migrated
+    assert not os.path.exists(os.path.join(cache_dir, "metadata.csv"))
+
+
 def test_store_metadata(cache_dir):
     """We should be able to store to the metadata by providing rows of data"""
     # Saving should work even if cache_dir doesn't exist
@@ -252,9 +278,8 @@ def test_modified_filenames(cache_dir):
     metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
     filename = metadata.loc[data_hash, "filename"]
     assert filename == expected_filename
-    assert os.path.exists(os.path.join(cache_dir, filename))
-    # Check the old file is gone
-    assert not os.path.exists(os.path.join(cache_dir, old_filename))
+    # The filename is only a label, the data is still stored under its hash
+    assert CM.load_cache_data(cache_dir, data_hash) == fake_data
 
     # TODO: Test that the first source is used for the filename?
 
@@ -282,7 +307,132 @@ def test_sync_cache_metadata(cache_dir):
     assert recorded_save_time <= save_time + datetime.timedelta(seconds=1)
     assert recorded_save_time == synced_metadata.loc["NEW_FILE", "time_modified"]
 
+    # The file should have been moved into the cache's sharded layout
+    assert not os.path.exists(os.path.join(cache_dir, "NEW_FILE"))
+    new_file_path = CM.get_cache_path(cache_dir, {"hash": "NEW_FILE"})
+    assert os.path.exists(new_file_path)
+
     # Then delete the file and check it no longer exists in the metadata
-    os.remove(os.path.join(cache_dir, "NEW_FILE"))
+    os.remove(new_file_path)
     CM.sync_cache_metadata(cache_dir)
     assert len(CM.load_cache_metadata(cache_dir)) == 1
+
+
+def test_metadata_journal_compaction(cache_dir):
+    """Compacting the journal into the database shouldn't change the metadata"""
+    CM.store_cache_metadata(
+        cache_dir, pd.DataFrame([{"hash": "SOME_HASH", "sources": ["first_source"]}])
+    )
+    CM.store_cache_metadata(
+        cache_dir, pd.DataFrame([{"hash": "SOME_HASH", "sources": ["second_source"]}])
+    )
+    CM.store_cache_metadata(cache_dir, pd.DataFrame([{"hash": "ANOTHER_HASH"}]))
+    journal_metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    # The changes should only have been appended to the journal so far
+    assert os.path.exists(os.path.join(cache_dir, "metadata.journal"))
+
+    CM.compact_cache_metadata(cache_dir)
+    assert not os.path.exists(os.path.join(cache_dir, "metadata.journal"))
+    compacted_metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert len(compacted_metadata) == 2
+    assert set(compacted_metadata.loc["SOME_HASH", "sources"]) == set(
+        ["first_source", "second_source"]
+    )
+    assert (
+        compacted_metadata.loc["SOME_HASH", "time_created"]
+        == journal_metadata.loc["SOME_HASH", "time_created"]
+    )
+    assert (
+        compacted_metadata.loc["SOME_HASH", "time_modified"]
+        == journal_metadata.loc["SOME_HASH", "time_modified"]
+    )
+
+    # Changes made after compacting should be applied on top of the database
+    CM.store_cache_metadata(
+        cache_dir, pd.DataFrame([{"hash": "SOME_HASH", "sources": ["third_source"]}])
+    )
+    loaded_metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert len(loaded_metadata.loc["SOME_HASH", "sources"]) == 3
+
+
+def test_metadata_journal_torn_record(cache_dir):
+    """A partially written journal record shouldn't affect the rest of the journal"""
+    CM.store_cache_metadata(cache_dir, pd.DataFrame([{"hash": "SOME_HASH"}]))
+    # Simulate a crash part way through appending a record
+    with open(os.path.join(cache_dir, "metadata.journal"), "a") as journal:
+        journal.write('\n{"hash": "TORN_HA')
+    assert list(CM.load_cache_metadata(cache_dir)["hash"]) == ["SOME_HASH"]
+
+    # Records appended after the torn one should still be read
+    CM.store_cache_metadata(cache_dir, pd.DataFrame([{"hash": "ANOTHER_HASH"}]))
+    loaded_hashes = set(CM.load_cache_metadata(cache_dir)["hash"])
+    assert loaded_hashes == set(["SOME_HASH", "ANOTHER_HASH"])
+
+
+def test_metadata_journal_replay_race(cache_dir, mocker):
+    """A compaction starting part way through a replay shouldn't lose changes"""
+    CM.store_cache_metadata(cache_dir, pd.DataFrame([{"hash": "SOME_HASH"}]))
+    replay_journal_file = CM.replay_journal_file
+    replayed_paths = []
+
+    def replay_then_compact(journal_path):
+        changes = replay_journal_file(journal_path)
+        replayed_paths.append(journal_path)
+        # Start a compaction straight after the first journal is read
+        if len(replayed_paths) == 1:
+            os.replace(
+                os.path.join(cache_dir, CM.METADATA_JOURNAL_FILE),
+                os.path.join(cache_dir, CM.COMPACTING_JOURNAL_FILE),
+            )
+        return changes
+
+    mocker.patch.object(CM, "replay_journal_file", side_effect=replay_then_compact)
+    assert list(CM.replay_metadata_journal(cache_dir)) == ["SOME_HASH"]
+
+
+def test_metadata_journal_size_threshold(cache_dir, monkeypatch):
+    """The journal should be compacted once it grows past a threshold"""
+    monkeypatch.setattr(CM, "JOURNAL_COMPACTION_SIZE", 1)
+    CM.store_cache_metadata(cache_dir, pd.DataFrame([{"hash": "SOME_HASH"}]))
+    CM.request_metadata_compaction(cache_dir).join()
+
+    assert not os.path.exists(os.path.join(cache_dir, "metadata.journal"))
+    assert list(CM.load_cache_metadata(cache_dir)["hash"]) == ["SOME_HASH"]
+
+
+def test_migrate_cache_layout(cache_dir):
+    """Flat caches should be converted to the sharded layout in place"""
+    os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, "some_filename"), "wb") as f:
+        pickle.dump("some_data", f)
+    CM.store_cache_metadata(
+        cache_dir, pd.DataFrame([{"hash": "SOME_HASH", "filename": "some_filename"}])
+    )
+
+    CM.migrate_cache_layout(cache_dir)
+    assert not os.path.exists(os.path.join(cache_dir, "some_filename"))
+    assert os.path.exists(os.path.join(cache_dir, "SO", "ME", "SOME_HASH"))
+    assert CM.load_cache_data(cache_dir, "SOME_HASH") == "some_data"
+    # The readable filename should be kept
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["SOME_HASH", "filename"] == "some_filename"
+
+
+def test_sync_only_changed_shards(cache_dir, mocker):
+    """Syncing should only list the shards that have changed since the last sync"""
+    CM.store_cache_data(cache_dir, "aaaa_key", "fake_data")
+    CM.store_cache_data(cache_dir, "bbbb_key", "fake_data")
+    CM.sync_cache_metadata(cache_dir)
+
+    listdir_spy = mocker.spy(CM.os, "listdir")
+    CM.sync_cache_metadata(cache_dir)
+    assert listdir_spy.call_args_list == [mocker.call(cache_dir)]
+
+    listdir_spy.reset_mock()
+    os.remove(CM.get_cache_path(cache_dir, {"hash": "bbbb_key"}))
+    CM.sync_cache_metadata(cache_dir)
+    assert listdir_spy.call_args_list == [
+        mocker.call(cache_dir),
+        mocker.call(os.path.join(cache_dir, "bb", "bb")),
+    ]
+    assert list(CM.load_cache_metadata(cache_dir)["hash"]) == ["aaaa_key"]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import pytest
+import tempfile
+import threading
+import yaht.cache_management as CM
+
+
+@pytest.fixture
+def cache_dir():
+    new_dir = tempfile.mkdtemp()
+    yield os.path.join(new_dir, "cache")
+    shutil.rmtree(new_dir)
+
+
+def test_session_batches_metadata(cache_dir):
+    """Metadata stored in a session should only be written when it ends"""
+    with CM.CacheSession(cache_dir) as session:
+        for i in range(10):
+            session.store_data("DATA_KEY_%d" % i, i)
+        # The data can be loaded, but isn't in the metadata yet
+        assert session.load_data("DATA_KEY_3") == 3
+        assert len(CM.load_cache_metadata(cache_dir)) == 0
+
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert len(metadata) == 10
+    assert metadata.loc["DATA_KEY_3", "filename"] == "DATA_KEY_3"
+    assert CM.load_cache_data(cache_dir, "DATA_KEY_3") == 3
+
+
+def test_session_single_write(cache_dir, mocker):
+    """Everything stored in a session should be written in one go"""
+    append_spy = mocker.spy(CM, "append_metadata_journal")
+    with CM.CacheSession(cache_dir) as session:
+        for i in range(10):
+            session.store_data("DATA_KEY_%d" % i, i)
+            session.store_metadata_rows(
+                [{"hash": "DATA_KEY_%d" % i, "sources": ["source_%d" % i]}]
+            )
+    assert append_spy.call_count == 1
+
+
+def test_session_flush_interval(cache_dir):
+    """Sessions with a flush interval should write metadata as they go"""
+    with CM.CacheSession(cache_dir, flush_interval=0) as session:
+        session.store_data("DATA_KEY", "fake_data")
+        assert len(CM.load_cache_metadata(cache_dir)) == 1
+
+
+def test_session_keeps_filenames(cache_dir):
+    """Metadata stored in a session shouldn't override existing filenames"""
+    CM.store_cache_data(cache_dir, "DATA_KEY", "fake_data")
+    CM.store_cache_metadata_rows(
+        cache_dir, [{"hash": "DATA_KEY", "filename": "some_filename"}]
+    )
+
+    with CM.CacheSession(cache_dir) as session:
+        session.store_metadata_rows([{"hash": "DATA_KEY", "sources": ["a_source"]}])
+    metadata = CM.load_cache_metadata(cache_dir).set_index("hash")
+    assert metadata.loc["DATA_KEY", "filename"] == "some_filename"
+    assert metadata.loc["DATA_KEY", "sources"] == ["a_source"]
+
+
+def test_session_background_writes(cache_dir, mocker):
+    """Data should be written in the background, but readable straight away"""
+    write_allowed = threading.Event()
+    write_cache_file = CM.write_cache_file
+
+    def blocked_write_cache_file(*args, **kwargs):
+        write_allowed.wait()
+        return write_cache_file(*args, **kwargs)
+
+    mocker.patch.object(CM, "write_cache_file", blocked_write_cache_file)
+    with CM.CacheSession(cache_dir, write_queue_size=2) as session:
+        session.store_data("DATA_KEY", "fake_data")
+        # Nothing has been written yet, but the data can still be read
+        assert session.load_data("DATA_KEY") == "fake_data"
+        assert not os.path.exists(CM.get_cache_path(cache_dir, {"hash": "DATA_KEY"}))
+        write_allowed.set()
+        # Asking for the metadata waits for the data to be written
+        metadata = session.get_metadata("DATA_KEY")
+        assert os.path.exists(CM.get_cache_path(cache_dir, metadata))
+        for i in range(10):
+            session.store_data("DATA_KEY_%d" % i, i)
+
+    # Everything should be written by the end of the session
+    metadata = CM.load_cache_metadata(cache_dir)
+    assert len(metadata) == 11
+    assert CM.load_cache_data(cache_dir, "DATA_KEY_9") == 9
+
+
+def test_session_background_write_errors(cache_dir, mocker):
+    """Errors writing in the background should be raised by the session"""
+    mocker.patch.object(CM, "write_cache_file", side_effect=IOError("disk full"))
+    with pytest.raises(IOError):
+        with CM.CacheSession(cache_dir, write_queue_size=2) as session:
+            session.store_data("DATA_KEY", "fake_data")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import numpy as np
+from yaht.lazy_data import LazyData, unwrap_lazy_data
+
+
+def test_load_on_first_use():
+    """Lazy data should only be loaded once, when it is first used"""
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return [3, 1, 2]
+
+    lazy_data = LazyData(loader)
+    assert not lazy_data.is_loaded
+    assert len(loads) == 0
+    assert lazy_data.load() == [3, 1, 2]
+    assert lazy_data.is_loaded
+    assert lazy_data.index(2) == 2
+    assert len(loads) == 1
+
+
+def test_transparent_use():
+    """Lazy data should behave like the data it loads"""
+    lazy_list = LazyData(lambda: [3, 1, 2])
+    assert len(lazy_list) == 3
+    assert lazy_list[0] == 3
+    assert sorted(lazy_list) == [1, 2, 3]
+    assert 2 in lazy_list
+    assert lazy_list == [3, 1, 2]
+    assert [0] + lazy_list == [0, 3, 1, 2]
+
+    lazy_array = LazyData(lambda: np.arange(4))
+    assert (lazy_array * 2 == np.arange(4) * 2).all()
+    assert lazy_array.sum() == 6
+    assert np.asarray(lazy_array).shape == (4,)
+    assert unwrap_lazy_data(lazy_array) is lazy_array.load()
+    assert unwrap_lazy_data("not lazy") == "not lazy"
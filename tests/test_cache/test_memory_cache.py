@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import pytest
+import numpy as np
+from yaht.memory_cache import MemoryCache, estimate_data_size
+
+
+def test_estimate_data_size():
+    """Sizes should account for the data inside containers and arrays"""
+    array = np.zeros(1000)
+    assert estimate_data_size(array) >= array.nbytes
+    assert estimate_data_size([array, array]) >= 2 * array.nbytes
+    assert estimate_data_size({"a": "x" * 1000}) > 1000
+    assert estimate_data_size("x" * 1000) > estimate_data_size("x")
+
+
+def test_unbounded_memory_cache():
+    """Without a budget, everything should be kept"""
+    memory_cache = MemoryCache()
+    for i in range(100):
+        memory_cache[str(i)] = np.zeros(1000)
+    assert len(memory_cache) == 100
+    assert memory_cache.stats()["evictions"] == 0
+
+
+def test_hits_and_misses():
+    """Looking up data should be counted as a hit or miss"""
+    memory_cache = MemoryCache()
+    memory_cache["a"] = 1
+    assert memory_cache["a"] == 1
+    with pytest.raises(KeyError):
+        memory_cache["b"]
+    # Checking for data isn't a lookup
+    assert "b" not in memory_cache
+    assert memory_cache.stats()["hits"] == 1
+    assert memory_cache.stats()["misses"] == 1
+
+
+def test_evict_least_recently_used():
+    """Data should be evicted least recently used first once over budget"""
+    data_size = estimate_data_size(np.zeros(1000))
+    memory_cache = MemoryCache(budget=int(data_size * 2.5))
+    memory_cache["a"] = np.zeros(1000)
+    memory_cache["b"] = np.zeros(1000)
+    memory_cache["a"]  # Using a makes b the least recently used
+    memory_cache["c"] = np.zeros(1000)
+
+    assert "a" in memory_cache and "c" in memory_cache
+    assert "b" not in memory_cache
+    assert memory_cache.size <= memory_cache.budget
+    assert memory_cache.stats()["evictions"] == 1
+    # Data bigger than the whole budget isn't kept
+    memory_cache["d"] = np.zeros(10000)
+    assert "d" not in memory_cache
+    assert len(memory_cache) == 2
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import pytest
+import tempfile
+import yaht.cache_management as CM
+from yaht.prefetching import Prefetcher
+
+
+@pytest.fixture
+def cache_dir():
+    new_dir = tempfile.mkdtemp()
+    yield os.path.join(new_dir, "cache")
+    shutil.rmtree(new_dir)
+
+
+def get_metadata(cache_dir, data_hash):
+    return CM.load_cache_metadata_rows(cache_dir, [data_hash])[data_hash]
+
+
+def test_prefetch_data(cache_dir):
+    """Prefetched data should be loaded in the background and taken when needed"""
+    CM.store_cache_data(cache_dir, "DATA_KEY", "fake_data")
+    with Prefetcher(cache_dir) as prefetcher:
+        assert prefetcher.prefetch(get_metadata(cache_dir, "DATA_KEY"))
+        # Data is only prefetched once
+        assert not prefetcher.prefetch(get_metadata(cache_dir, "DATA_KEY"))
+        assert "DATA_KEY" in prefetcher
+        assert prefetcher.take("DATA_KEY") == "fake_data"
+        assert "DATA_KEY" not in prefetcher
+        assert prefetcher.size == 0
+        assert prefetcher.stats()["hits"] == 1
+
+
+def test_prefetch_budget(cache_dir):
+    """Nothing more should be prefetched once the budget is used up"""
+    CM.store_cache_data(cache_dir, "DATA_KEY_1", "x" * 1000)
+    CM.store_cache_data(cache_dir, "DATA_KEY_2", "x" * 1000)
+    with Prefetcher(cache_dir, budget=500) as prefetcher:
+        assert prefetcher.prefetch(get_metadata(cache_dir, "DATA_KEY_1"))
+        assert not prefetcher.prefetch(get_metadata(cache_dir, "DATA_KEY_2"))
+        prefetcher.take("DATA_KEY_1")
+        assert prefetcher.prefetch(get_metadata(cache_dir, "DATA_KEY_2"))
@@ -0,0 +1,50 @@
+import os
+import pytest
+import tempfile
+import yaht.cli as cli
+
+
+@pytest.fixture
+def mock_working_directory():
+    # Generate a temp directory to run test in
+    temp_dir = tempfile.mkdtemp()
+    os.chdir(temp_dir)
+    return temp_dir
+
+
+def test_plan_default_config(mock_working_directory, capsys):
+    """Planning should show what would run without running anything"""
+    cli.gen_scaffold()
+    plan, summary = cli.plan_experiments()
+    # Each of the 3 trials has 3 processes, but n2 is the same in two of them
+    assert len(plan) == 3 * 3
+    assert summary["run"] == 8
+    assert summary["shared"] == 1
+    assert summary["unestimated"] == 8
+    assert set(plan["stage"].dropna()) == {0, 1}
+    output = capsys.readouterr().out
+    assert "8 processes to run" in output
+    assert "<NA>" not in output
+    # Nothing should have been run
+    cli.run_experiments()
+    plan, summary = cli.plan_experiments()
+    assert summary["run"] == 0
+    assert summary["cached"] == 3 * 3
+
+
+def test_plan_estimates_from_history(mock_working_directory):
+    """Cost estimates should come from how long processes took before"""
+    cli.gen_scaffold()
+    cli.run_experiments()
+    # Changing a parameter means the process needs running again
+    with open(cli.DEFAULT_CONFIG_FILE) as f:
+        config_text = f.read()
+    with open(cli.DEFAULT_CONFIG_FILE, "w") as f:
+        f.write(config_text.replace("n2.n: -50", "n2.n: -60"))
+
+    plan, summary = cli.plan_experiments(jobs=2)
+    run_plan = plan[plan["status"] == "run"]
+    assert list(run_plan["name"]) == ["n2"]
+    assert run_plan["estimated_time"].notnull().all()
+    assert run_plan["estimated_size"].iloc[0] > 0
+    assert summary["unestimated"] == 0
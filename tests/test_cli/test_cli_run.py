@@ -51,3 +51,15 @@ def test_run_default_config(mock_all_outputs, mock_working_directory):
     # Check for some of the results
     assert -5 in result_list
     assert -50 in result_list
+
+
+def test_run_parallel_jobs(mock_all_outputs, mock_working_directory):
+    """Running with several jobs should give the same outputs"""
+    result_list = mock_all_outputs
+    cli.gen_scaffold()
+    cli.run_experiments(jobs=2)
+    cli.output_experiment_results()
+
+    assert len(result_list) == 2 * 3
+    assert -5 in result_list
+    assert -50 in result_list
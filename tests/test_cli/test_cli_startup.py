@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import time
+import subprocess
+import yaht
+import yaht.cli as cli
+
+# How long the cli can take to start up and show its help
+STARTUP_TIME_BUDGET = 1.0
+HEAVY_MODULES = ["pandas", "numpy", "matplotlib", "networkx", "yaht.laboratory"]
+
+
+def run_python(*args):
+    """Run python in a subprocess which can import yaht, returning its output"""
+    package_dir = os.path.dirname(os.path.dirname(yaht.__file__))
+    env = os.environ | {"PYTHONPATH": package_dir}
+    env.pop(cli.PROFILE_IMPORTS_VAR, None)
+    return subprocess.run(
+        [sys.executable, *args], env=env, capture_output=True, text=True, check=True
+    )
+
+
+def test_no_heavy_imports():
+    """Importing the cli shouldn't import any heavy modules"""
+    output = run_python(
+        "-c",
+        "import sys, yaht.cli; print([m for m in %r if m in sys.modules])"
+        % HEAVY_MODULES,
+    )
+    assert output.stdout.strip() == "[]"
+
+
+def test_startup_time():
+    """The cli should start up within a time budget"""
+    # The first run may have to compile the modules
+    run_python("-m", "yaht.cli", "--help")
+    start_time = time.perf_counter()
+    output = run_python("-m", "yaht.cli", "--help")
+    assert time.perf_counter() - start_time < STARTUP_TIME_BUDGET
+    assert "Yet another hyperparameter tuner" in output.stdout
+
+
+def test_profile_imports(tmp_path, monkeypatch):
+    """Profiling imports should report the modules imported while running"""
+    (tmp_path / "slow_module.py").write_text("import time\ntime.sleep(0.05)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    report = io.StringIO()
+    with cli.profile_imports(report) as import_times:
+        import slow_module
+    assert import_times["slow_module"][0] >= 0.05
+    assert "slow_module" in report.getvalue()
+    assert "Imported 1 modules" in report.getvalue()
+    monkeypatch.delitem(sys.modules, "slow_module")
@@ -399,3 +399,24 @@ def test_empty_sources():
         },
     }
     assert config == expected_config
+
+
+def test_exponent_parameters():
+    """Numbers in exponent notation should be read as floats"""
+    yaml_config = "\n".join(
+        [
+            "some_experiment:",
+            "  results: foo",
+            "  structure:",
+            "    foo: _",
+            "  parameters:",
+            "    lr: 1e-2",
+            "    n: 1E3",
+            "    name: e10",
+        ]
+    )
+    config_fname = gen_config_file(yaml_config)
+
+    config = read_config_file(config_fname)
+    parameters = config["experiments"]["some_experiment"]["parameters"]
+    assert parameters == {"lr": 0.01, "n": 1000.0, "name": "e10"}
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import pytest
+from yaht.config_processing import process_experiment_config
+from yaht.scheduling import (
+    get_rung_budgets,
+    get_schedule_brackets,
+    select_top_trials,
+    count_promoted,
+)
+
+SCHEDULE_CONFIG = {
+    "budget": "train.epochs",
+    "metric": "accuracy",
+    "max_budget": 27,
+}
+
+
+def read_schedule(**schedule_config):
+    raw_config = {
+        "structure": {"train": "_ -> accuracy"},
+        "results": "accuracy",
+        "schedule": SCHEDULE_CONFIG | schedule_config,
+    }
+    return process_experiment_config(raw_config)["schedule"]
+
+
+def test_successive_halving_schedule():
+    """Successive halving should run every trial, keeping a third at each rung"""
+    schedule = read_schedule()
+    assert schedule["method"] == "successive_halving"
+    assert schedule["mode"] == "max"
+    assert get_rung_budgets(schedule) == [1, 3, 9, 27]
+    trial_names = ["t%d" % i for i in range(30)]
+    assert get_schedule_brackets(schedule, trial_names) == [
+        ([1, 3, 9, 27], trial_names)
+    ]
+    assert [count_promoted(n, schedule) for n in [30, 10, 3, 1]] == [10, 3, 1, 1]
+    # Budgets don't have to be a power of eta apart, or whole numbers
+    assert get_rung_budgets(read_schedule(max_budget=10)) == [1, 3, 10]
+    assert get_rung_budgets(read_schedule(min_budget=0.5, max_budget=2.0, eta=2)) == [
+        0.5,
+        1.0,
+        2.0,
+    ]
+
+
+def test_hyperband_schedule():
+    """Hyperband should start fewer trials at each larger budget"""
+    schedule = read_schedule(method="hyperband")
+    trial_names = ["t%d" % i for i in range(100)]
+    brackets = get_schedule_brackets(schedule, trial_names)
+    assert [budgets for budgets, _ in brackets] == [
+        [1, 3, 9, 27],
+        [3, 9, 27],
+        [9, 27],
+        [27],
+    ]
+    bracket_sizes = [len(t) for _, t in brackets]
+    assert bracket_sizes == sorted(bracket_sizes, reverse=True)
+    assert sum(bracket_sizes) == 100
+    assert [t for _, ts in brackets for t in ts] == trial_names
+
+
+def test_select_top_trials():
+    """The best trials should be selected, never ones without scores"""
+    scores = {"a": 0.5, "b": float("nan"), "c": 0.9, "d": None, "e": 0.5}
+    assert select_top_trials(scores, 2) == ["a", "c"]
+    assert select_top_trials(scores, 2, "min") == ["a", "e"]
+    assert select_top_trials(scores, 4) == ["a", "b", "c", "e"]
+
+
+def test_invalid_schedules():
+    """Schedules that can't be run should raise an error when read"""
+    with pytest.raises(ValueError):
+        process_experiment_config(
+            {"structure": {"a": "_"}, "schedule": {"budget": "a.n"}}
+        )
+    with pytest.raises(ValueError):
+        read_schedule(method="bohb")
+    with pytest.raises(ValueError):
+        read_schedule(mode="best")
+    with pytest.raises(ValueError):
+        read_schedule(min_budget=30)
+    with pytest.raises(ValueError):
+        read_schedule(eta=1)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import math
+import pytest
+from yaht.config_processing import read_config_file
+from yaht.sweeps import SweepTrials
+from tests.test_config.test_read_config_from_file import gen_config_file
+
+
+def read_sweep_config(sweep_lines, trial_lines=()):
+    yaml_config = "\n".join(
+        [
+            "some_experiment:",
+            "  results: foo",
+            "  structure:",
+            "    foo: _",
+            "  sweep:",
+            *["    " + l for l in sweep_lines],
+            *(["  trials:"] + ["    " + l for l in trial_lines] if trial_lines else []),
+        ]
+    )
+    config = read_config_file(gen_config_file(yaml_config))
+    return config["experiments"]["some_experiment"]["trials"]
+
+
+def test_grid_sweep():
+    """Grid sweeps should cover every combination of values"""
+    trials = read_sweep_config(
+        [
+            "params:",
+            "  foo.epochs: [1, 2]",
+            "  foo.lr: {log_uniform: [1e-3, 1e-1], n: 3}",
+        ],
+        ["manual:", "  foo.lr: 0.5"],
+    )
+    assert type(trials) == SweepTrials
+    assert len(trials) == 1 + 2 * 3
+    assert list(trials) == ["manual"] + ["sweep_%d" % i for i in range(6)]
+    assert trials["manual"] == {"foo.lr": 0.5}
+    assert trials["sweep_0"] == {"foo.epochs": 1, "foo.lr": 0.001}
+    assert trials["sweep_1"] == {"foo.epochs": 1, "foo.lr": 0.01}
+    assert trials["sweep_5"] == {"foo.epochs": 2, "foo.lr": 0.1}
+    with pytest.raises(KeyError):
+        trials["sweep_6"]
+
+
+def test_random_sweep():
+    """Random sweeps should sample within their spaces, the same way every time"""
+    sweep_lines = [
+        "method: random",
+        "n_trials: 200",
+        "seed: 3",
+        "params:",
+        "  foo.lr: {log_uniform: [1e-4, 1e-1]}",
+        "  foo.dropout: {uniform: [0, 0.5]}",
+        "  foo.layers: {uniform: [1, 4], integer: true}",
+        "  foo.optimizer: [adam, sgd]",
+    ]
+    trials = read_sweep_config(sweep_lines)
+    points = [trials[t] for t in trials]
+    assert len(points) == 200
+    assert all(1e-4 <= p["foo.lr"] <= 1e-1 for p in points)
+    assert all(0 <= p["foo.dropout"] <= 0.5 for p in points)
+    assert {p["foo.layers"] for p in points} == {1, 2, 3, 4}
+    assert {p["foo.optimizer"] for p in points} == {"adam", "sgd"}
+    # Log uniform samples are spread evenly across orders of magnitude
+    small_lrs = [p for p in points if p["foo.lr"] < 1e-2]
+    assert 100 < len(small_lrs) < 166
+    assert read_sweep_config(sweep_lines)["sweep_042"] == trials["sweep_042"]
+
+
+def test_latin_hypercube_sweep():
+    """Latin hypercube sweeps should sample every stratum of each space once"""
+    trials = read_sweep_config(
+        [
+            "method: lhs",
+            "n_trials: 50",
+            "params:",
+            "  foo.x: {uniform: [0, 1]}",
+            "  foo.y: {log_uniform: [1, 1e5]}",
+        ]
+    )
+    points = [trials[t] for t in trials]
+    x_strata = sorted(math.floor(p["foo.x"] * 50) for p in points)
+    y_strata = sorted(math.floor(math.log10(p["foo.y"]) / 5 * 50) for p in points)
+    assert x_strata == y_strata == list(range(50))
+
+
+def test_invalid_sweeps():
+    """Sweeps that can't be generated should raise an error when read"""
+    with pytest.raises(ValueError):
+        read_sweep_config(["method: random", "params:", "  foo.x: [1, 2]"])
+    with pytest.raises(ValueError):
+        read_sweep_config(["params:", "  foo.x: {uniform: [0, 1]}"])
+    with pytest.raises(ValueError):
+        read_sweep_config(["method: bayesian", "n_trials: 5"])
+    with pytest.raises(ValueError):
+        read_sweep_config(["params:", "  foo.x: {log_uniform: [0, 1], n: 3}"])
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 import os
 import copy
+import logging
 import time
 import shutil
 import pytest
 import tempfile
+import threading
+import multiprocessing
+import numpy as np
 import pandas as pd
+import yaht.laboratory
+import yaht.structure
 import yaht.cache_management as CM
 from yaht.laboratory import Laboratory
+from yaht.processes import register_process
+from yaht.sweeps import SweepTrials
+from yaht.structure import gen_legacy_result_hashes, STRUCTURE_CACHE_DIR
 
 
 @pytest.fixture
@@ -101,9 +110,9 @@ def test_lab_metadata_generation(mock_config, mock_all_procs):
         cached_metadata["sources"]
     )
     # Check that the filename has the right components at least
-    assert "some_lab_name" in cached_metadata["filename"][0]
-    assert "some_experiment" in cached_metadata["filename"][0]
-    assert "control" in cached_metadata["filename"][0]
+    assert "some_lab_name" in cached_metadata["filename"].iloc[0]
+    assert "some_experiment" in cached_metadata["filename"].iloc[0]
+    assert "control" in cached_metadata["filename"].iloc[0]
 
 
 def test_multi_trial_lab(mock_all_procs):
@@ -141,7 +150,36 @@ def test_multi_trial_lab(mock_all_procs):
     assert results.loc["t1", "value"] == "EXAMPLE_DATA_foo_bar-t1"
     assert results.loc["t2", "value"] == "EXAMPLE_DATA_foo_bar-t2"
     # But the first process' result should be reused
-    assert len(os.listdir(cache_dir)) == 1 + 1 + 1 + 3  # Metadata, source, foo, 3*bar
+    data_files = [
+        f
+        for root, _, fs in os.walk(cache_dir)
+        for f in fs
+        if os.path.basename(root) != STRUCTURE_CACHE_DIR
+    ]
+    data_files = [f for f in data_files if f not in CM.METADATA_FILES]
+    assert len(data_files) == 1 + 1 + 3  # Source, foo, 3*bar
+
+    shutil.rmtree(new_dir)
+
+
+def test_constant_metadata_writes(mock_all_procs, mocker):
+    """The metadata shouldn't be written once per process run"""
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    config["experiments"]["mt_exp"] = {
+        "trials": {"t%d" % i: {"bar.y": "-t%d" % i} for i in range(20)},
+        "structure": {
+            "foo": {"sources": ["some_data"], "function": "foo"},
+            "bar": {"sources": ["foo"], "function": "bar"},
+        },
+        "results": ["bar"],
+    }
+
+    append_spy = mocker.spy(CM, "append_metadata_journal")
+    lab = Laboratory(config)
+    lab.run_experiments()
+    assert append_spy.call_count == 1
+    assert len(lab.get_results()) == 21
 
     shutil.rmtree(new_dir)
 
@@ -159,11 +197,12 @@ def test_only_run_needed_processes(mock_config, mock_all_procs, mocker):
     lab.run_experiments()
     results = lab.get_results()
 
-    # If we replace the processes with something else,
-    # nothing about the config has changed,
+    # If we replace the processes with ones with the same code,
+    # nothing about the config or the code has changed,
     # so the lab should not run any of them again
-    def mock_new_process(proc_name):
-        return lambda x, y="": "%s_%s%s-NEW" % (x, proc_name, y)
+    def mock_new_process(name):
+        proc_name = name + "-NEW"
+        return lambda x, y="": "%s_%s%s" % (x, proc_name, y)
 
     mocker.patch("yaht.structure.get_process", mock_new_process)
 
@@ -177,6 +216,100 @@ def test_only_run_needed_processes(mock_config, mock_all_procs, mocker):
     assert new_values == values
 
 
+def test_rerun_changed_code(mock_config, mock_all_procs, mocker):
+    """Changing the code of a process should only rerun it and what depends on it"""
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    foo_hash = lab.structure["result_hashes"].iloc[0][0]
+
+    def mock_changed_process(proc_name):
+        if proc_name == "bar":
+            return lambda x, y="": "%s_%s%s-CHANGED" % (x, proc_name, y)
+        return lambda x, y="": "%s_%s%s" % (x, proc_name, y)
+
+    mocker.patch("yaht.structure.get_process", mock_changed_process)
+    lab = Laboratory(mock_config)
+    lab.determine_unrun_processes()
+    has_run = lab.structure.set_index("name")["has_run"]
+    assert has_run["foo"] and not has_run["bar"]
+    assert lab.structure["result_hashes"].iloc[0][0] == foo_hash
+    lab.run_experiments()
+    assert lab.get_results()["value"][0] == "EXAMPLE_DATA_foo_bar-CHANGED"
+
+
+def test_recompute_evicted_data(mock_config, mock_all_procs, mocker):
+    """Evicted data should only be recomputed when something needs it"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    foo_hash, bar_hash = [h[0] for h in lab.structure["result_hashes"]]
+    computed_rows = CM.load_cache_metadata_rows(cache_dir, [foo_hash, bar_hash])
+    assert all(r["compute_time"] >= 0 for r in computed_rows.values())
+
+    # With only the intermediate evicted, nothing needs to run
+    evicted_row = computed_rows[foo_hash]
+    os.remove(CM.get_cache_path(cache_dir, evicted_row))
+    CM.append_metadata_journal(cache_dir, [{"deleted": foo_hash}])
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    assert lab.structure["has_run"].all()
+    assert CM.find_cached_hashes(cache_dir, [foo_hash]) == set()
+
+    # Results are never evicted, so they can be loaded straight after running
+    mock_config["settings"]["cache_budget"] = 0
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    assert CM.find_cached_hashes(cache_dir, [foo_hash, bar_hash]) == {bar_hash}
+    assert lab.get_results()["value"][0] == "EXAMPLE_DATA_foo_bar"
+
+    # But once everything is evicted, the intermediate is recomputed too
+    bar_row = CM.load_cache_metadata_rows(cache_dir, [bar_hash])[bar_hash]
+    os.remove(CM.get_cache_path(cache_dir, bar_row))
+    CM.append_metadata_journal(cache_dir, [{"deleted": bar_hash}])
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.determine_unrun_processes()
+    assert not lab.structure["has_run"].any()
+    lab = Laboratory(mock_config)
+    lab.run_experiments()
+    assert lab.get_results()["value"][0] == "EXAMPLE_DATA_foo_bar"
+
+
+def test_recompute_evicted_results(mock_config, mock_all_procs):
+    """Evicted intermediates that are also results should always be recomputed"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    mock_config["experiments"]["some_experiment"]["results"] = ["foo", "bar_result"]
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    foo_hash = lab.structure["result_hashes"].iloc[0][0]
+    foo_row = CM.load_cache_metadata_rows(cache_dir, [foo_hash])[foo_hash]
+    os.remove(CM.get_cache_path(cache_dir, foo_row))
+    CM.append_metadata_journal(cache_dir, [{"deleted": foo_hash}])
+
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+    assert CM.find_cached_hashes(cache_dir, [foo_hash]) == {foo_hash}
+    results = lab.get_results().set_index("name")
+    assert results.loc["foo", "value"] == "EXAMPLE_DATA_foo"
+    assert results.loc["bar_result", "value"] == "EXAMPLE_DATA_foo_bar"
+
+
+def test_record_data_accesses(mock_config, mock_all_procs):
+    """Loading data from the cache should be recorded in its metadata"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    lab = Laboratory(mock_config)
+    lab.run_experiments()
+    # Only loading from the cache counts, not data already in memory
+    for _ in range(2):
+        lab.internal_data.clear()
+        lab.get_results()
+    lab.get_results()
+
+    bar_hash = lab.structure["result_hashes"].iloc[-1][0]
+    bar_row = CM.load_cache_metadata_rows(cache_dir, [bar_hash])[bar_hash]
+    assert bar_row["access_count"] == 2
+    assert bar_row["time_accessed"] is not None
+
+
 def test_use_custom_output(mock_config, mock_all_procs):
     """
     Specify a custom output function for the result
@@ -191,3 +324,575 @@ def test_use_custom_output(mock_config, mock_all_procs):
 
     # The results should have a column specifying the output function
     assert results["output"][0] == "bar_output_function"
+
+
+def test_mmap_inputs(mock_config):
+    """Processes can ask for array inputs to be memory mapped from the cache"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    CM.store_cache_data(cache_dir, "array_key", np.arange(10))
+    mock_config["sources"]["some_data"] = "hash:array_key"
+
+    @register_process(mmap_inputs=True)
+    def sum_mmapped_array(array):
+        assert type(array) == np.memmap
+        assert not array.flags.writeable
+        return int(array.sum())
+
+    mock_config["experiments"]["some_experiment"] = {
+        "structure": {
+            "sum_mmapped_array": {"sources": ["some_data"], "results": ["total"]},
+        },
+        "results": ["total"],
+    }
+    lab = Laboratory(mock_config)
+    lab.run_experiments()
+    assert lab.get_results()["value"][0] == 45
+
+
+def test_lazy_inputs(mock_config, mocker):
+    """Processes can ask for inputs to only be loaded when they are used"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    CM.store_cache_data(cache_dir, "unused_key", "UNUSED_DATA")
+    mock_config["sources"]["unused_data"] = "hash:unused_key"
+
+    @register_process(lazy_inputs=True)
+    def use_first_input(first, second):
+        assert not first.is_loaded and not second.is_loaded
+        return first.lower()
+
+    mock_config["experiments"]["some_experiment"] = {
+        "structure": {
+            "use_first_input": {
+                "sources": ["some_data", "unused_data"],
+                "results": ["lowered"],
+            },
+        },
+        "results": ["lowered"],
+    }
+    read_spy = mocker.spy(CM, "read_cache_file")
+    lab = Laboratory(mock_config)
+    lab.run_experiments()
+    assert lab.get_results()["value"][0] == "example_data"
+    loaded_hashes = [c.args[1]["hash"] for c in read_spy.call_args_list]
+    assert "example_key" in loaded_hashes
+    assert "unused_key" not in loaded_hashes
+
+
+def test_memory_budget(mock_all_procs):
+    """Data that doesn't fit in memory should be reloaded from the cache"""
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    config["settings"]["memory_budget"] = 100
+    config["experiments"]["mt_exp"] = {
+        "trials": {"t%d" % i: {"bar.y": "-t%d" % i} for i in range(5)},
+        "structure": {
+            "foo": {"sources": ["some_data"], "function": "foo"},
+            "bar": {"sources": ["foo"], "function": "bar"},
+        },
+        "results": ["bar"],
+    }
+
+    lab = Laboratory(config)
+    lab.run_experiments()
+    results = lab.get_results().set_index("trial")
+    assert results.loc["t3", "value"] == "EXAMPLE_DATA_foo_bar-t3"
+    assert lab.internal_data.size <= 100
+    assert lab.internal_data.stats()["misses"] > 0
+
+    shutil.rmtree(new_dir)
+
+
+def test_release_dead_data(mock_all_procs):
+    """Data should be dropped from memory once nothing else needs it"""
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    # A long chain of processes only ever needs the latest result
+    config["experiments"]["chain_exp"] = {
+        "structure": {
+            "p0": {"sources": ["some_data"], "function": "p0"},
+            **{
+                "p%d" % i: {"sources": ["p%d" % (i - 1)], "function": "p%d" % i}
+                for i in range(1, 20)
+            },
+        },
+        "results": ["p19"],
+    }
+
+    lab = Laboratory(config)
+    lab.run_experiments()
+    assert lab.peak_live_set["count"] <= 2
+    assert len(lab.internal_data) == 0
+    assert lab.get_results()["value"][0].endswith("_p18_p19")
+
+    shutil.rmtree(new_dir)
+
+
+def test_parallel_lab(mock_all_procs):
+    """Running processes in parallel should give the same results"""
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    config["experiments"]["mt_exp"] = {
+        "trials": {"t%d" % i: {"bar.y": "-t%d" % i} for i in range(8)},
+        "structure": {
+            "foo": {"sources": ["some_data"], "function": "foo"},
+            "bar": {"sources": ["foo"], "function": "bar"},
+            "baz": {"sources": ["foo", "bar"], "function": "baz"},
+        },
+        "results": ["baz"],
+    }
+
+    lab = Laboratory(config)
+    lab.run_experiments(jobs=4)
+    results = lab.get_results().set_index("trial")
+    assert len(results) == 9
+    assert results.loc["t3", "value"] == "EXAMPLE_DATA_foo_bazEXAMPLE_DATA_foo_bar-t3"
+    # Every trial should still be recorded as a source of the shared result
+    foo_hash = lab.structure["result_hashes"].iloc[0][0]
+    foo_row = CM.load_cache_metadata_rows(cache_dir, [foo_hash])[foo_hash]
+    assert len(foo_row["sources"]) == 9
+    assert foo_row["compute_time"] >= 0
+
+    shutil.rmtree(new_dir)
+
+
+def test_parallel_executors(mock_config):
+    """Processes should run where they were registered to, sharing data in threads"""
+    produced_arrays, run_threads = [], {}
+
+    @register_process(executor="thread")
+    def make_shared_array(x):
+        run_threads["make"] = threading.current_thread()
+        produced_arrays.append(np.arange(10))
+        return produced_arrays[-1]
+
+    @register_process(executor="thread", lazy_inputs=True)
+    def check_shared_array(array):
+        run_threads["check"] = threading.current_thread()
+        return array is produced_arrays[-1]
+
+    @register_process(executor="inline")
+    def sum_inline(array):
+        run_threads["sum"] = threading.current_thread()
+        return int(array.sum())
+
+    mock_config["experiments"]["some_experiment"] = {
+        "structure": {
+            "make_shared_array": {"sources": ["some_data"], "results": ["array"]},
+            "check_shared_array": {"sources": ["array"], "results": ["shared"]},
+            "sum_inline": {"sources": ["array"], "results": ["total"]},
+        },
+        "results": ["shared", "total"],
+    }
+    lab = Laboratory(mock_config)
+    lab.run_experiments(jobs=2)
+    results = lab.get_results().set_index("name")
+    assert results.loc["shared", "value"] == True
+    assert results.loc["total", "value"] == 45
+    assert run_threads["make"] is not threading.main_thread()
+    assert run_threads["check"] is not threading.main_thread()
+    assert run_threads["sum"] is threading.main_thread()
+
+
+def test_parallel_live_set(mock_config, caplog):
+    """The most data kept in memory at once should be recorded in parallel too"""
+
+    @register_process(executor="thread")
+    def make_live_array(x, offset=0):
+        return np.zeros(1000) + offset
+
+    @register_process(executor="thread")
+    def sum_live_array(array):
+        return float(array.sum())
+
+    mock_config["experiments"]["some_experiment"] = {
+        "trials": {"t%d" % i: {"make_live_array.offset": i} for i in range(4)},
+        "structure": {
+            "make_live_array": {"sources": ["some_data"], "results": ["array"]},
+            "sum_live_array": {"sources": ["array"], "results": ["total"]},
+        },
+        "results": ["total"],
+    }
+    lab = Laboratory(mock_config)
+    with caplog.at_level(logging.INFO):
+        lab.run_experiments(jobs=2)
+    assert lab.peak_live_set["count"] >= 2
+    assert lab.peak_live_set["size"] >= 8000
+    assert len(lab.internal_data) == 0
+    assert "Peak live set of %d items" % lab.peak_live_set["count"] in caplog.text
+    # Each run records its own peak, so a run with nothing to do keeps nothing
+    lab.run_experiments(jobs=2)
+    assert lab.peak_live_set == {"count": 0, "size": 0}
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="Needs fork"
+)
+def test_parallel_jobs_limit(mock_config):
+    """No more processes should run at once than jobs, across threads and workers"""
+    running, max_running = multiprocessing.Value("i", 0), multiprocessing.Value("i", 0)
+
+    def track_running(n):
+        with running.get_lock():
+            running.value += 1
+            max_running.value = max(max_running.value, running.value)
+        time.sleep(0.05)
+        with running.get_lock():
+            running.value -= 1
+        return n
+
+    @register_process(executor="thread")
+    def limited_thread_job(x, n=0):
+        return track_running(n)
+
+    @register_process(executor="process")
+    def limited_process_job(x, n=0):
+        return track_running(n)
+
+    mock_config["experiments"]["some_experiment"] = {
+        "trials": {
+            "t%d" % i: {"limited_thread_job.n": i, "limited_process_job.n": i}
+            for i in range(4)
+        },
+        "structure": {
+            "limited_thread_job": {"sources": ["some_data"]},
+            "limited_process_job": {"sources": ["some_data"]},
+        },
+        "results": ["limited_thread_job", "limited_process_job"],
+    }
+    lab = Laboratory(mock_config)
+    lab.run_experiments(jobs=2)
+    assert len(lab.get_results()) == 2 * 5
+    assert max_running.value == 2
+
+
+def spawned_process(x):
+    return os.getpid()
+
+
+def test_unforkable_workers(mock_config, mocker):
+    """Without fork, processes should be sent to workers, or run in threads if they can't"""
+    mocker.patch("yaht.executors.can_fork_workers", return_value=False)
+    mocker.patch("yaht.laboratory.can_fork_workers", return_value=False)
+
+    def unpicklable_process(x):
+        return threading.current_thread() is not threading.main_thread()
+
+    mocker.patch(
+        "yaht.structure.get_process",
+        lambda proc_name: (
+            spawned_process if proc_name == "spawn" else unpicklable_process
+        ),
+    )
+    mock_config["experiments"]["some_experiment"] = {
+        "structure": {
+            "spawn": {"sources": ["some_data"], "function": "spawn"},
+            "local": {"sources": ["some_data"], "function": "local"},
+        },
+        "results": ["spawn", "local"],
+    }
+    lab = Laboratory(mock_config)
+    lab.run_experiments(jobs=2)
+    results = lab.get_results().set_index("name")
+    assert results.loc["spawn", "value"] != os.getpid()
+    assert results.loc["local", "value"] == True
+
+
+def test_prefetch_sources(mock_config, mock_all_procs):
+    """Sources of upcoming processes should be loaded ahead of time"""
+    cache_dir = mock_config["settings"]["cache_dir"]
+    structure = {}
+    for i in range(5):
+        CM.store_cache_data(cache_dir, "source_key_%d" % i, "SOURCE_%d" % i)
+        mock_config["sources"]["source_%d" % i] = "hash:source_key_%d" % i
+        structure["p%d" % i] = {"sources": ["source_%d" % i], "function": "p%d" % i}
+    mock_config["experiments"]["some_experiment"] = {
+        "structure": structure,
+        "results": ["p4"],
+    }
+
+    lab = Laboratory(mock_config)
+    lab.run_experiments()
+    assert lab.prefetch_stats["hits"] == 4  # Everything but the first source
+    assert lab.get_results()["value"][0] == "SOURCE_4_p4"
+
+
+def test_shared_processes_run_once(mocker):
+    """Processes with the same results should only run once per run"""
+    proc_calls = []
+
+    def mock_get_process(proc_name):
+        def mock_process(x, y=""):
+            proc_calls.append(proc_name)
+            return "%s_%s%s" % (x, proc_name, y)
+
+        mock_process.__name__ = proc_name
+        return mock_process
+
+    mocker.patch("yaht.structure.get_process", mock_get_process)
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    for exp_name in ["exp1", "exp2"]:
+        config["experiments"][exp_name] = {
+            "trials": {"t%d" % i: {"bar.y": "-t%d" % i} for i in range(3)},
+            "structure": {
+                "foo": {"sources": ["some_data"], "function": "foo"},
+                "bar": {"sources": ["foo"], "function": "bar"},
+            },
+            "results": ["bar"],
+        }
+
+    lab = Laboratory(config)
+    lab.run_experiments()
+    # The shared foo should run once, and bar once per unique trial
+    assert proc_calls.count("foo") == 1
+    assert proc_calls.count("bar") == 4
+    # But every process it's shared between should be recorded as a source
+    foo_hash = lab.structure["result_hashes"].iloc[0][0]
+    foo_row = CM.load_cache_metadata_rows(cache_dir, [foo_hash])[foo_hash]
+    assert len(foo_row["sources"]) == 2 * 4
+    assert len(lab.get_results()) == 2 * 4
+
+    shutil.rmtree(new_dir)
+
+
+def test_remap_legacy_hashes(mock_config, mocker):
+    """Results cached under hashes from before canonical encoding should be reused"""
+    proc_calls = []
+
+    def mock_get_process(proc_name):
+        def mock_process(x, z=0, y=""):
+            proc_calls.append(proc_name)
+            return "%s_%s%s%s" % (x, proc_name, y, z)
+
+        return mock_process
+
+    mocker.patch("yaht.structure.get_process", mock_get_process)
+    cache_dir = mock_config["settings"]["cache_dir"]
+    mock_config["experiments"]["some_experiment"]["parameters"] = {"y": "-", "z": 1}
+    lab = Laboratory(copy.deepcopy(mock_config))
+    lab.run_experiments()
+
+    # Move the results to where a cache from before would have them
+    result_hashes = [h for r in lab.structure["result_hashes"] for h in r]
+    legacy_hashes = [h for r in gen_legacy_result_hashes(lab.structure) for h in r]
+    assert set(result_hashes).isdisjoint(legacy_hashes)
+    CM.remap_cache_hashes(cache_dir, dict(zip(result_hashes, legacy_hashes)))
+    CM.store_hash_version(cache_dir, 0)
+
+    # Planning counts the legacy results as cached, without moving them
+    lab = Laboratory(copy.deepcopy(mock_config))
+    _, summary = lab.plan_experiments()
+    assert summary["cached"] == 2
+    assert CM.find_cached_hashes(cache_dir, legacy_hashes) == set(legacy_hashes)
+
+    # Nothing should need to run, as the legacy results are moved back
+    proc_calls.clear()
+    lab.run_experiments()
+    assert proc_calls == []
+    assert CM.find_cached_hashes(cache_dir, result_hashes) == set(result_hashes)
+    assert CM.find_cached_hashes(cache_dir, legacy_hashes) == set()
+    assert CM.load_hash_version(cache_dir) == CM.CACHE_HASH_VERSION
+    assert lab.get_results()["value"][0] == "EXAMPLE_DATA_foo-1_bar-1"
+
+    # Which is only done once
+    legacy_spy = mocker.spy(yaht.laboratory, "gen_legacy_result_hashes")
+    mock_config["experiments"]["some_experiment"]["parameters"]["z"] = 2
+    Laboratory(copy.deepcopy(mock_config)).run_experiments()
+    assert legacy_spy.call_count == 0
+
+
+def test_new_cache_hash_version(tmp_path):
+    """New caches never need their hashes remapping, unlike older ones"""
+    CM.store_cache_data(str(tmp_path / "new_cache"), "DATA_KEY", "DATA")
+    assert CM.load_hash_version(str(tmp_path / "new_cache")) == CM.CACHE_HASH_VERSION
+    legacy_cache = tmp_path / "legacy_cache"
+    legacy_cache.mkdir()
+    (legacy_cache / CM.LEGACY_METADATA_FILE).write_text("hash,filename\n")
+    assert CM.load_hash_version(str(legacy_cache)) == 0
+
+
+def test_batched_sweep_lab(mocker):
+    """Labs with more trials than a batch should run a batch at a time"""
+    proc_calls = []
+
+    def mock_get_process(proc_name):
+        def mock_process(x, y=""):
+            proc_calls.append(proc_name)
+            return "%s_%s%s" % (x, proc_name, y)
+
+        mock_process.__name__ = proc_name
+        return mock_process
+
+    mocker.patch("yaht.structure.get_process", mock_get_process)
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    config["settings"]["trial_batch_size"] = 2
+    config["experiments"]["sweep_exp"] = {
+        "trials": SweepTrials({"params": {"bar.y": ["-a", "-b", "-c", "-d", "-e"]}}),
+        "structure": {
+            "foo": {"sources": ["some_data"], "function": "foo"},
+            "bar": {"sources": ["foo"], "function": "bar"},
+        },
+        "results": ["bar"],
+    }
+    lab = Laboratory(copy.deepcopy(config))
+    assert lab.batched and lab.structure is None
+    build_spy = mocker.spy(yaht.laboratory, "structure_from_records")
+
+    # The shared foo is only planned to run in the first batch
+    plan, summary = lab.plan_experiments()
+    assert len(plan) == 6 * 2
+    assert summary["run"] == 1 + 6
+    assert summary["shared"] == 5
+    assert max(len(c.args[0]) for c in build_spy.call_args_list) <= 2 * 2
+
+    lab.run_experiments()
+    assert proc_calls.count("foo") == 1
+    assert proc_calls.count("bar") == 6
+    results = lab.get_results().set_index("trial")
+    assert len(results) == 6
+    assert results.loc["control", "value"] == "EXAMPLE_DATA_foo_bar"
+    assert results.loc["sweep_4", "value"] == "EXAMPLE_DATA_foo_bar-e"
+
+    # Nothing needs running again, and the batches aren't generated again either
+    generate_spy = mocker.spy(yaht.structure, "iter_laboratory_trial_records")
+    lab = Laboratory(copy.deepcopy(config))
+    _, summary = lab.plan_experiments()
+    assert summary["cached"] == 6 * 2
+    assert generate_spy.call_count == 0
+
+    shutil.rmtree(new_dir)
+
+
+@pytest.fixture
+def mock_schedule_config(mocker):
+    """A lab of trials training at a budget of epochs, scored by their accuracy"""
+    proc_calls = []
+    failing_budgets = set()
+
+    def train(x, epochs=1, lr=0.0):
+        if epochs in failing_budgets:
+            raise RuntimeError("Interrupted")
+        proc_calls.append((lr, epochs))
+        # Accuracy improves with epochs, and is best with a learning rate of 0.3
+        return epochs - abs(lr - 0.3)
+
+    mocker.patch("yaht.structure.get_process", lambda proc_name: train)
+    new_dir, cache_dir, source_fname = create_mock_cache_file()
+    config = create_mock_base_config(cache_dir, source_fname)
+    config["experiments"]["schedule_exp"] = {
+        "trials": {"t%d" % i: {"train.lr": i / 10} for i in range(9)},
+        "structure": {
+            "train": {
+                "sources": ["some_data"],
+                "function": "train",
+                "results": ["accuracy"],
+            }
+        },
+        "results": ["accuracy"],
+        "schedule": {
+            "budget": "train.epochs",
+            "metric": "accuracy",
+            "method": "successive_halving",
+            "mode": "max",
+            "min_budget": 1,
+            "max_budget": 9,
+            "eta": 3,
+        },
+    }
+    yield config, proc_calls, failing_budgets
+    shutil.rmtree(new_dir)
+
+
+def test_scheduled_lab(mock_schedule_config):
+    """Only the best trials at each budget should be promoted to the next"""
+    config, proc_calls, _ = mock_schedule_config
+    lab = Laboratory(copy.deepcopy(config))
+    lab.run_experiments()
+    # 9 trials at 1 epoch, the best 3 at 3 epochs then the best at 9, with controls
+    assert sorted(proc_calls) == sorted(
+        [(i / 10, 1) for i in range(9)]
+        + [(0.2, 3), (0.3, 3), (0.4, 3), (0.3, 9)]
+        + [(0.0, 1), (0.0, 3), (0.0, 9)]
+    )
+    rungs = lab.schedule_history["schedule_exp"]
+    assert [r["experiment"] for r in rungs] == [
+        "schedule_exp@1",
+        "schedule_exp@3",
+        "schedule_exp@9",
+    ]
+    assert [r["promoted"] for r in rungs[:2]] == [["t2", "t3", "t4"], ["t3"]]
+    assert rungs[2]["scores"] == {"t3": 9.0}
+
+    # Results come from every rung
+    results = lab.get_results()
+    assert len(results) == (9 + 1) + (3 + 1) + (1 + 1)
+    final_results = results[results["experiment"] == "schedule_exp@9"]
+    assert set(final_results["trial"]) == {"t3", "control"}
+
+
+def test_recompute_evicted_metric(mock_schedule_config):
+    """Evicted metrics a schedule ranks trials by should be recomputed"""
+    config, proc_calls, _ = mock_schedule_config
+    # The metric is also consumed by another process
+    config["experiments"]["schedule_exp"]["structure"]["report"] = {
+        "sources": ["accuracy"],
+        "function": "report",
+        "results": ["report"],
+    }
+    config["experiments"]["schedule_exp"]["results"] = ["report"]
+    lab = Laboratory(copy.deepcopy(config))
+    lab.run_experiments()
+    cache_dir = config["settings"]["cache_dir"]
+    first_rung = lab.schedule_history["schedule_exp"][0]
+    lab = Laboratory(copy.deepcopy(config))
+    metric_hashes = {}
+    for structure in lab.iter_structures():
+        metric_hashes |= {
+            (r["experiment"], r["trial"]): r["result_hashes"][0]
+            for _, r in structure.iterrows()
+            if r["name"] == "train"
+        }
+    evicted_hash = metric_hashes[("schedule_exp@1", "t0")]
+    evicted_row = CM.load_cache_metadata_rows(cache_dir, [evicted_hash])[evicted_hash]
+    os.remove(CM.get_cache_path(cache_dir, evicted_row))
+    CM.append_metadata_journal(cache_dir, [{"deleted": evicted_hash}])
+
+    proc_calls.clear()
+    lab = Laboratory(copy.deepcopy(config))
+    lab.run_experiments()
+    assert proc_calls == [(0.0, 1)]
+    assert lab.schedule_history["schedule_exp"][0] == first_rung
+
+
+def test_resume_scheduled_lab(mock_schedule_config):
+    """Rerunning a schedule should resume from the last completed rung"""
+    config, proc_calls, failing_budgets = mock_schedule_config
+    failing_budgets.add(3)
+    lab = Laboratory(copy.deepcopy(config))
+    with pytest.raises(RuntimeError):
+        lab.run_experiments()
+    assert len(proc_calls) == 9 + 1
+
+    # Planning only goes as far as the first rung that hasn't finished
+    failing_budgets.clear()
+    lab = Laboratory(copy.deepcopy(config))
+    plan, summary = lab.plan_experiments()
+    assert set(plan["experiment"]) == {"schedule_exp@1", "schedule_exp@3"}
+    assert summary["cached"] == 9 + 1
+    assert summary["run"] == 3 + 1
+
+    proc_calls.clear()
+    lab.run_experiments()
+    assert sorted(proc_calls) == [
+        (0.0, 3),
+        (0.0, 9),
+        (0.2, 3),
+        (0.3, 3),
+        (0.3, 9),
+        (0.4, 3),
+    ]
+    proc_calls.clear()
+    lab = Laboratory(copy.deepcopy(config))
+    lab.run_experiments()
+    assert proc_calls == []
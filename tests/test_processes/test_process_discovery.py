@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import os
+import sys
+import pytest
+import textwrap
+import yaht.discovery
+from yaht.processes import PROCESSES, find_processes
+from yaht.outputs import OUTPUTS, find_outputs
+
+PROJECT_FILES = {
+    "discovered_procs.py": """
+        from yaht.processes import register_process
+
+        @register_process
+        def discovered_proc(x):
+            return x
+
+        @register_process(executor="thread")
+        def discovered_thread_proc(x):
+            return x
+    """,
+    "side_effects.py": """
+        import yaht.processes as P
+        open("side_effects_ran", "w").close()
+
+        @P.register_process
+        def side_effect_proc(x):
+            return x
+    """,
+    "dynamic_procs.py": """
+        from yaht.processes import register_process
+
+        for name in ["dynamic_proc"]:
+            register_process(type(lambda: 0)((lambda: name).__code__, {}, name))
+    """,
+    "discovered_outputs.py": """
+        from yaht.outputs import register_output
+
+        @register_output
+        def discovered_output(value, metadata):
+            print(value)
+    """,
+    "notes.py": "this isn't python",
+    "venv/lib/vendored.py": """
+        from yaht.processes import register_process
+
+        @register_process
+        def vendored_proc(x):
+            return x
+    """,
+    ".ipynb_checkpoints/checkpoint.py": """
+        raise RuntimeError("Checkpoints shouldn't be imported")
+    """,
+}
+
+
+@pytest.fixture
+def project_dir(tmp_path, monkeypatch):
+    for file_path, file_source in PROJECT_FILES.items():
+        full_path = tmp_path / file_path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_text(textwrap.dedent(file_source))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    # Forget everything that was discovered
+    for name in list(PROCESSES) + list(OUTPUTS):
+        if "discovered" in name or name.endswith("_proc"):
+            PROCESSES.pop(name, None)
+            OUTPUTS.pop(name, None)
+    for module_name in [os.path.splitext(f)[0] for f in PROJECT_FILES]:
+        sys.modules.pop(module_name.replace("/", "."), None)
+
+
+def test_scan_module_file(project_dir):
+    """Registered functions should be found without importing their files"""
+    entry = yaht.discovery.scan_module_file("discovered_procs.py")
+    assert entry["register_process"] == ["discovered_proc", "discovered_thread_proc"]
+    assert entry["uses"] == ["register_process"]
+    entry = yaht.discovery.scan_module_file("side_effects.py")
+    assert entry["register_process"] == ["side_effect_proc"]
+    assert yaht.discovery.scan_module_file("notes.py")["uses"] == []
+
+
+def test_find_named_processes(project_dir):
+    """Only the modules defining the named processes should be imported"""
+    find_processes(["discovered_proc"], {"cache_dir": ".yaht_cache"})
+    assert "discovered_proc" in PROCESSES
+    assert "discovered_thread_proc" in PROCESSES
+    assert "side_effect_proc" not in PROCESSES
+    assert not os.path.exists("side_effects_ran")
+    assert os.path.exists(".yaht_cache/discovery/manifest.json")
+
+
+def test_default_manifest_cache(project_dir, mocker):
+    """The manifest should be cached in the default cache dir if none is set"""
+    find_processes(["discovered_proc"])
+    assert os.path.exists(".yaht_cache/discovery/manifest.json")
+    scan_spy = mocker.spy(yaht.discovery, "scan_module_file")
+    find_processes(["side_effect_proc"], {"jobs": 2})
+    assert scan_spy.call_count == 0
+
+
+def test_find_all_processes(project_dir):
+    """Without names, every module in scope registering processes is imported"""
+    find_processes()
+    assert "side_effect_proc" in PROCESSES
+    assert "dynamic_proc" in PROCESSES
+    assert os.path.exists("side_effects_ran")
+    # Excluded directories are never searched
+    assert "vendored_proc" not in PROCESSES
+
+
+def test_find_unscannable_processes(project_dir):
+    """Processes the scan can't see should be found by importing what might have them"""
+    find_processes(["dynamic_proc"])
+    assert "dynamic_proc" in PROCESSES
+
+
+def test_include_exclude_globs(project_dir):
+    """Which files are searched should be set by include and exclude globs"""
+    settings = {"discovery": {"include": ["venv/**/*.py"], "exclude": []}}
+    find_processes(None, settings)
+    assert "vendored_proc" in PROCESSES
+    assert "discovered_proc" not in PROCESSES
+
+
+def test_cached_manifest(project_dir, mocker):
+    """Files should only be scanned again once they change"""
+    scan_spy = mocker.spy(yaht.discovery, "scan_module_file")
+    settings = {"cache_dir": ".yaht_cache"}
+    manifest = yaht.discovery.load_manifest(".yaht_cache", {})
+    assert scan_spy.call_count == len(manifest) == 5
+    yaht.discovery.load_manifest(".yaht_cache", {})
+    assert scan_spy.call_count == 5
+
+    with open("discovered_procs.py", "a") as f:
+        f.write("\n\n@register_process\ndef appended_proc(x):\n    return x\n")
+    find_processes(["appended_proc"], settings)
+    assert scan_spy.call_count == 6
+    assert "appended_proc" in PROCESSES
+
+
+def test_entry_points(project_dir, mocker):
+    """Processes and outputs should be loadable from installed packages"""
+
+    def entry_point_proc(x):
+        return x
+
+    entry_point = mocker.Mock(load=lambda: entry_point_proc)
+    entry_point.name = "entry_point_proc"
+    mocker.patch("importlib.metadata.entry_points", return_value=[entry_point])
+    find_processes(["entry_point_proc"])
+    assert PROCESSES["entry_point_proc"] == entry_point_proc
+
+    # Which can be turned off
+    PROCESSES.pop("entry_point_proc")
+    find_processes(["entry_point_proc"], {"discovery": {"entry_points": False}})
+    assert "entry_point_proc" not in PROCESSES
+
+
+def test_find_named_outputs(project_dir):
+    """Outputs should be discovered in the same way"""
+    find_outputs(["discovered_output"])
+    assert "discovered_output" in OUTPUTS
+    assert "discovered_proc" not in PROCESSES
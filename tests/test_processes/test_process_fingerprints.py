@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import pytest
+import tempfile
+import importlib.util
+from yaht.processes import get_process_fingerprint, register_process
+
+
+@pytest.fixture
+def module_dir():
+    new_dir = tempfile.mkdtemp()
+    yield new_dir
+    shutil.rmtree(new_dir)
+
+
+def load_module(module_dir, module_name, module_source):
+    """Load some source code as a module, as if it were found in a project"""
+    file_path = os.path.join(module_dir, module_name + ".py")
+    with open(file_path, "w") as f:
+        f.write(module_source)
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+PROCESS_SOURCE = """
+from yaht.processes import register_process
+
+@register_process
+def helper_process(x):
+    return x + %(helper_change)s
+
+@register_process%(options)s
+def fingerprinted_process(x):
+    %(docstring)s
+    # %(comment)s
+    return helper_process(x) * %(change)s
+"""
+
+
+def get_fingerprint(module_dir, module_name, **changes):
+    source_parts = {
+        "helper_change": 1,
+        "options": "",
+        "docstring": '"""A process"""',
+        "comment": "A comment",
+        "change": 2,
+    } | changes
+    module = load_module(module_dir, module_name, PROCESS_SOURCE % source_parts)
+    return get_process_fingerprint(module.fingerprinted_process)
+
+
+def test_fingerprint_ignores_formatting(module_dir):
+    """Comments, docstrings and decorators shouldn't change a fingerprint"""
+    fingerprint = get_fingerprint(module_dir, "original")
+    assert fingerprint == get_fingerprint(
+        module_dir,
+        "reformatted",
+        docstring='"""Another docstring"""',
+        comment="Another comment",
+        options="(executor='thread')",
+    )
+
+
+def test_fingerprint_changes_with_code(module_dir):
+    """Changing the code of a process or processes it calls changes its fingerprint"""
+    fingerprint = get_fingerprint(module_dir, "original")
+    assert fingerprint != get_fingerprint(module_dir, "changed", change=3)
+    assert fingerprint != get_fingerprint(module_dir, "helper", helper_change=2)
+
+
+def test_fingerprint_version(module_dir):
+    """Processes with an explicit version are fingerprinted by it instead"""
+    fingerprint = get_fingerprint(module_dir, "v1", options="(version=1)")
+    assert fingerprint == get_fingerprint(
+        module_dir, "v1_changed", options="(version=1)", change=3
+    )
+    assert fingerprint != get_fingerprint(module_dir, "v2", options="(version=2)")
+
+
+def test_fingerprint_without_source():
+    """Functions without source code should be fingerprinted by their bytecode"""
+    double = eval("lambda x: x * 2")
+    triple = eval("lambda x: x * 3")
+    assert get_process_fingerprint(double) != get_process_fingerprint(triple)
+    assert get_process_fingerprint(double) == get_process_fingerprint(
+        eval("lambda x: x * 2")
+    )
@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
-from yaht.processes import register_process, get_process
+import pytest
+from yaht.processes import (
+    register_process,
+    get_process,
+    get_process_options,
+    get_input_flags,
+    get_process_executor,
+)
 
 
 def test_register_process():
@@ -11,3 +18,32 @@ def test_register_process():
 
     proc = get_process("foo")
     assert proc == foo
+
+
+def test_register_process_options():
+    """Test that processes can be registered with options"""
+
+    @register_process(mmap_inputs=["y"])
+    def foo_with_options(x, y, z=0):
+        return "bar"
+
+    assert get_process("foo_with_options") == foo_with_options
+    assert get_process_options("foo_with_options") == {"mmap_inputs": ["y"]}
+    # Options for inputs should be matched to the positional arguments
+    flags = get_input_flags(foo_with_options, "mmap_inputs", 2)
+    assert flags == [False, True]
+    flags = get_input_flags(foo_with_options, "lazy_inputs", 2)
+    assert flags == [False, False]
+
+
+def test_register_process_executor():
+    """Processes can be registered to run in a particular executor"""
+
+    @register_process(executor="thread")
+    def threaded_foo():
+        return "bar"
+
+    assert get_process_executor(threaded_foo) == "thread"
+    assert get_process_executor(get_process("foo_with_options")) == "process"
+    with pytest.raises(ValueError):
+        register_process(executor="gpu")(lambda: "bar")
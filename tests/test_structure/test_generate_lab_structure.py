@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import pytest
+import inspect
 import pandas as pd
-from yaht.structure import generate_laboratory_structure
+from yaht.processes import register_process
+from yaht.structure import generate_laboratory_structure, generate_laboratory_records
 
 
 @pytest.fixture
@@ -77,3 +79,50 @@ def test_multiple_experiments(mock_all_procs):
         structure.loc[("exp2", "bar"), "source_hashes"]
         == [structure.loc[("exp2", "foo"), "result_hashes"]][0]
     )
+
+
+def test_many_trials_records(mocker):
+    """Records should be generated per process, only inspecting functions once"""
+
+    @register_process
+    def scale_trial(x, scale=1):
+        return x * scale
+
+    signature_spy = mocker.spy(inspect, "signature")
+    config = {
+        "source_hashes": {"in": "DATA_HASH"},
+        "experiments": {
+            "exp1": {
+                "structure": {
+                    "first": {"sources": ["in"], "function": "scale_trial"},
+                    "second": {"sources": ["first"], "function": "scale_trial"},
+                },
+                "results": ["second"],
+                "trials": {"t%d" % i: {"second.scale": i} for i in range(100)},
+            },
+        },
+    }
+    records = generate_laboratory_records(config)
+
+    # There should be a record for both processes of every trial (and the control)
+    assert type(records) == list
+    assert len(records) == 2 * 101
+    assert signature_spy.call_count == 1
+    first_hashes = {r["result_hashes"][0] for r in records if r["name"] == "first"}
+    second_hashes = {r["result_hashes"][0] for r in records if r["name"] == "second"}
+    assert len(first_hashes) == 1
+    assert len(second_hashes) == 101
+    assert records[-1] == {
+        "name": "second",
+        "function": scale_trial,
+        "function_name": "scale_trial",
+        "order": 1,
+        "params": {},
+        "source_names": ["first"],
+        "result_names": ["second"],
+        "source_hashes": list(first_hashes),
+        "result_hashes": records[-1]["result_hashes"],
+        "trial": "control",
+        "results": [True],
+        "experiment": "exp1",
+    }
@@ -55,6 +55,7 @@ def test_single_process_structure(simple_proc):
         # Essential for processing
         "order": 0,
         "function": simple_proc,
+        "function_name": "foobar",
         "params": {},
         "source_hashes": ["INPUT_HASH"],
         "result_hashes": [hash_key],
@@ -244,6 +245,7 @@ def test_empty_sources(simple_proc):
         # Essential for processing
         "order": 0,
         "function": simple_proc,
+        "function_name": "foobar",
         "params": {},
         "source_hashes": [],
         "result_hashes": [hash_key],
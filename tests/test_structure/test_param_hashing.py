@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import pytest
+import numpy as np
+from hashlib import sha256
+from yaht.processes import register_process
+from yaht.hashing import encode_canonical
+from yaht.structure import generate_trial_structure, gen_legacy_result_hashes
+
+
+@pytest.fixture
+def proc_with_params():
+    @register_process
+    def scale_value(x, scale=1, offset=0):
+        return x * scale + offset
+
+    yield scale_value
+
+
+def get_result_hash(params):
+    config = {
+        "source_hashes": {"source_1": "INPUT_HASH"},
+        "structure": {
+            "scale_value": {
+                "sources": ["source_1"],
+                "results": ["scale_value"],
+            },
+        },
+        "parameters": params,
+    }
+    structure = generate_trial_structure(config)
+    return structure["result_hashes"].item()[0]
+
+
+def test_encode_equal_values_alike():
+    """Logically identical values should be encoded the same"""
+    assert encode_canonical({"a": 1, "b": 2}) == encode_canonical({"b": 2, "a": 1})
+    assert encode_canonical(1e-2) == encode_canonical(0.01)
+    assert encode_canonical(np.float32(0.5)) == encode_canonical(0.5)
+    assert encode_canonical(np.int64(3)) == encode_canonical(3)
+    assert encode_canonical(3.0) == encode_canonical(3)
+    assert encode_canonical((1, 2)) == encode_canonical([1, 2])
+    assert encode_canonical({2, 1}) == encode_canonical({1, 2})
+    assert encode_canonical(np.arange(3)) == encode_canonical(np.arange(3))
+
+
+def test_encode_different_values_apart():
+    """Different values should be encoded differently"""
+    assert encode_canonical(1) != encode_canonical("1")
+    assert encode_canonical(True) != encode_canonical(1)
+    assert encode_canonical(None) != encode_canonical("None")
+    assert encode_canonical(0.1) != encode_canonical(0.10000001)
+    assert encode_canonical(np.arange(3)) != encode_canonical(np.arange(1, 4))
+    assert encode_canonical(np.zeros(4)) != encode_canonical(np.zeros((2, 2)))
+    assert encode_canonical(np.zeros(2)) != encode_canonical(np.zeros(2, dtype=int))
+
+
+def test_encode_simple_values_like_str():
+    """Simple values should be encoded as before, so their hashes don't change"""
+    for value in [{}, {"a": 1, "b": "c"}, [1.5, None, True], ["text"]]:
+        assert encode_canonical(value) == str(value)
+
+
+def test_equal_params_hash_alike(proc_with_params):
+    """Processes with logically identical parameters should have the same hash"""
+    base_hash = get_result_hash({"scale": 0.01, "offset": 1})
+    assert get_result_hash({"offset": 1, "scale": 1e-2}) == base_hash
+    assert get_result_hash({"scale": np.float64(0.01), "offset": 1.0}) == base_hash
+    assert get_result_hash({"scale": 0.02, "offset": 1}) != base_hash
+
+
+def test_legacy_result_hashes(proc_with_params):
+    """Legacy hashes should be made exactly as before, without code fingerprints"""
+    config = {
+        "source_hashes": {"source_1": "INPUT_HASH"},
+        "structure": {
+            "scale_value": {
+                "sources": ["source_1"],
+                "results": ["scale_value"],
+            },
+        },
+        "parameters": {"scale": 2, "offset": 1},
+    }
+    structure = generate_trial_structure(config)
+    structure["experiment"] = "exp"
+    structure["trial"] = "control"
+    legacy_hashes = gen_legacy_result_hashes(structure)
+    # Current hashes also fingerprint the code of the process, so the hash changed
+    assert legacy_hashes.iloc[0] != structure["result_hashes"].iloc[0]
+    assert len(legacy_hashes.iloc[0]) == 1
+    legacy_hash = sha256(b"scale_value")
+    legacy_hash.update(str(["INPUT_HASH"]).encode())
+    legacy_hash.update(str({"scale": 2, "offset": 1}).encode())
+    legacy_hash.update(b"scale_value")
+    assert legacy_hashes.iloc[0] == [legacy_hash.hexdigest()]
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import copy
+import pytest
+import shutil
+import tempfile
+import yaht.structure
+import yaht.cache_management as CM
+from yaht.processes import register_process
+from yaht.structure import (
+    load_laboratory_records,
+    load_laboratory_batches,
+    STRUCTURE_CACHE_DIR,
+)
+
+
+@pytest.fixture
+def mock_all_procs(mocker):
+    def mock_get_process(proc_name):
+        return lambda x, y="": "%s_%s%s" % (x, proc_name, y)
+
+    mocker.patch("yaht.structure.get_process", mock_get_process)
+
+
+@pytest.fixture
+def cache_dir():
+    new_dir = tempfile.mkdtemp()
+    yield os.path.join(new_dir, "cache")
+    shutil.rmtree(new_dir)
+
+
+@pytest.fixture
+def lab_config():
+    config = {
+        "source_hashes": {"in": "DATA_HASH"},
+        "experiments": {
+            "exp1": {
+                "structure": {
+                    "foo": {"sources": ["in"]},
+                    "bar": {"sources": ["foo"]},
+                },
+                "results": ["bar"],
+                "trials": {"t%d" % i: {"bar.y": str(i)} for i in range(10)},
+            },
+        },
+    }
+    yield config
+
+
+def test_reuse_cached_structure(mock_all_procs, cache_dir, lab_config, mocker):
+    """The structure compiled for a config should be reused the next time"""
+    generate_spy = mocker.spy(yaht.structure, "generate_laboratory_records")
+    records = load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    cached_records = load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    assert generate_spy.call_count == 1
+    assert len(os.listdir(os.path.join(cache_dir, STRUCTURE_CACHE_DIR))) == 1
+
+    # The cached records should be the same, with their functions looked up again
+    assert len(cached_records) == len(records) == 2 * 11
+    for record, cached_record in zip(records, cached_records):
+        assert cached_record["result_hashes"] == record["result_hashes"]
+        assert cached_record["params"] == record["params"]
+        assert cached_record["function"]("in", "") == record["function"]("in", "")
+
+
+def test_recompile_changed_structure(mock_all_procs, cache_dir, lab_config, mocker):
+    """Changing the config or the code of a process should recompile the structure"""
+    generate_spy = mocker.spy(yaht.structure, "generate_laboratory_records")
+    load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    lab_config["experiments"]["exp1"]["trials"]["t0"]["bar.y"] = "changed"
+    load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    assert generate_spy.call_count == 2
+
+    def mock_changed_process(proc_name):
+        return lambda x, y="": "%s_%s%s-CHANGED" % (x, proc_name, y)
+
+    mocker.patch("yaht.structure.get_process", mock_changed_process)
+    records = load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    assert generate_spy.call_count == 3
+    assert records[0]["function"]("in") == "in_foo-CHANGED"
+
+
+def test_recompile_versioned_signature(cache_dir, lab_config, mocker):
+    """Changing the parameters of a versioned process should recompile the structure"""
+
+    @register_process(version="1")
+    def versioned_proc(x, y=""):
+        return x + y
+
+    mocker.patch("yaht.structure.get_process", lambda proc_name: versioned_proc)
+    generate_spy = mocker.spy(yaht.structure, "generate_laboratory_records")
+    records = load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    assert {"y": "9"} in [r["params"] for r in records]
+
+    # The version is the same, but the process no longer takes y
+    @register_process(version="1")
+    def versioned_proc(x, z=""):
+        return x + z
+
+    records = load_laboratory_records(copy.deepcopy(lab_config), cache_dir)
+    assert generate_spy.call_count == 2
+    assert all(r["params"] == {} for r in records)
+
+
+def test_reuse_cached_batches(mock_all_procs, cache_dir, lab_config, mocker):
+    """Batches compiled for a config should be reused, once they've all been made"""
+    generate_spy = mocker.spy(yaht.structure, "iter_laboratory_trial_records")
+    # Batches that weren't all needed aren't cached
+    next(load_laboratory_batches(copy.deepcopy(lab_config), 4, cache_dir))
+    assert os.listdir(os.path.join(cache_dir, STRUCTURE_CACHE_DIR)) == []
+
+    batches = list(load_laboratory_batches(copy.deepcopy(lab_config), 4, cache_dir))
+    cached_batches = list(
+        load_laboratory_batches(copy.deepcopy(lab_config), 4, cache_dir)
+    )
+    assert generate_spy.call_count == 2
+    assert [len(b) for b in cached_batches] == [2 * 4, 2 * 4, 2 * 3]
+    for batch, cached_batch in zip(batches, cached_batches):
+        assert [r["result_hashes"] for r in cached_batch] == [
+            r["result_hashes"] for r in batch
+        ]
+        assert cached_batch[0]["function"]("in") == batch[0]["function"]("in")
+
+
+def test_cached_structures_not_data(mock_all_procs, cache_dir, lab_config):
+    """Cached structures shouldn't be mistaken for cached data"""
+    load_laboratory_records(lab_config, cache_dir)
+    CM.sync_cache_metadata(cache_dir)
+    assert len(CM.load_cache_metadata_rows(cache_dir)) == 0
@@ -1,54 +1,291 @@
 #!/usr/bin/env python3
 import os
 import re
+import json
+import time
 import shutil
-import pickle
+import uuid
+import queue
 import sqlite3
+import threading
+import contextlib
 import logging
 import datetime
 import numpy as np
 import pandas as pd
+from yaht.serializers import (
+    find_serializer,
+    get_serializer,
+    get_serializer_exts,
+    DEFAULT_SERIALIZER,
+)
+from yaht.compression import get_codec, CompressingWriter
 
-METADATA_FILE = "metadata.csv"
+METADATA_FILE = "metadata.db"
+METADATA_JOURNAL_FILE = "metadata.journal"
+COMPACTING_JOURNAL_FILE = "metadata.journal.compacting"
+LEGACY_METADATA_FILE = "metadata.csv"
+# Files in the cache dir that are used by the cache itself rather than storing data
+METADATA_FILES = [
+    METADATA_FILE,
+    METADATA_FILE + "-journal",
+    METADATA_JOURNAL_FILE,
+    COMPACTING_JOURNAL_FILE,
+    LEGACY_METADATA_FILE,
+]
+# Data is dumped to files with this suffix, which are renamed once complete
+TEMP_FILE_SUFFIX = ".tmp"
+# Version of the layout of data files in the cache, where 0 is a flat directory
+CACHE_LAYOUT_VERSION = 1
+# Version of how results are hashed, where 0 is before parameters were encoded
+# canonically and process code was fingerprinted
+CACHE_HASH_VERSION = 1
+# The journal is folded into the metadata database once it grows past this size
+JOURNAL_COMPACTION_SIZE = 4 * 1024 * 1024
 METADATA_COLUMNS = [
     "hash",
     "filename",
     "sources",
     "time_created",
     "time_modified",
+    "serializer",
+    "codec",
+    "size",
+    "compute_time",
+    "access_count",
+    "time_accessed",
 ]
+# Units that cache budgets can be given in, e.g. "500MB" or "2G"
+BYTE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+# Journal replays and compactions shared by everything in this process
+_METADATA_LOCK = threading.RLock()
+_JOURNAL_REPLAYS = {}
+_COMPACTIONS = {}
 
 
-def store_cache_data(cache_dir, data_hash, data):
-    """Store the given data in the cache"""
+def store_cache_data(
+    cache_dir, data_hash, data, compression=None, compression_threshold=None
+):
+    """
+    Store the given data in the cache, compressing it if it's worth it
+    when compression is set to "speed", "size" or the name of a codec
+    """
     # Check if the data alread exists in the cache
-    try:
-        metadata = load_cache_metadata(cache_dir).set_index("hash").loc[data_hash]
-        metadata = dict(metadata.dropna().items())
-    except KeyError:
-        metadata = {}
+    metadata = load_cache_metadata_rows(cache_dir, [data_hash]).get(data_hash, {})
 
     # Create a file in the cache dir with the data
-    data_filename = metadata.get("filename", data_hash)
-    with open(os.path.join(cache_dir, data_filename), "wb") as data_file:
-        pickle.dump(data, data_file)
+    new_metadata = write_cache_file(
+        cache_dir, data_hash, data, metadata, compression, compression_threshold
+    )
 
     # Save relevant meatadata
-    new_metadata = pd.DataFrame.from_dict({"hash": [data_hash]}, orient="columns")
-    store_cache_metadata(cache_dir, new_metadata)
+    store_cache_metadata_rows(cache_dir, [new_metadata])
 
 
-def load_cache_data(cache_dir, data_hash):
-    """Load data from the cache"""
+def load_cache_data(cache_dir, data_hash, mmap=False):
+    """
+    Load data from the cache, memory mapping it instead
+    if requested and possible for the type of the data
+    """
     # Retrieve the data filename from the metadata
-    metadata = load_cache_metadata(cache_dir).set_index("hash").loc[data_hash]
-    metadata = dict(metadata.dropna().items())
-    data_filename = metadata.get("filename", data_hash)
+    metadata = load_cache_metadata_rows(cache_dir, [data_hash])[data_hash]
     # Load the data from the cache
-    with open(os.path.join(cache_dir, data_filename), "rb") as data_file:
-        loaded_data = pickle.load(data_file)
-    # Return the data
-    return loaded_data
+    return read_cache_file(cache_dir, metadata, mmap)
+
+
+def write_cache_file(
+    cache_dir,
+    data_hash,
+    data,
+    old_metadata=None,
+    compression=None,
+    compression_threshold=None,
+):
+    """
+    Write data to a file in the cache using the serializer for its type,
+    returning the metadata needed to read it back
+    """
+    old_metadata = old_metadata or {}
+    serializer = find_serializer(data)
+    try:
+        new_metadata = {"hash": data_hash, "serializer": serializer["name"]}
+        data_path = get_cache_path(cache_dir, new_metadata)
+        codec = dump_cache_file(
+            data_path, serializer, data, compression, compression_threshold
+        )
+    except Exception:
+        # Anything a specialised serializer can't handle is pickled instead
+        if serializer["name"] == DEFAULT_SERIALIZER:
+            raise
+        serializer = get_serializer(DEFAULT_SERIALIZER)
+        new_metadata = {"hash": data_hash, "serializer": serializer["name"]}
+        data_path = get_cache_path(cache_dir, new_metadata)
+        codec = dump_cache_file(
+            data_path, serializer, data, compression, compression_threshold
+        )
+
+    # Data previously stored in another format would otherwise be left behind
+    if old_metadata and get_cache_path(cache_dir, old_metadata) != data_path:
+        try:
+            os.remove(get_cache_path(cache_dir, old_metadata))
+        except FileNotFoundError:
+            pass
+
+    # Keep the existing filename of the data, defaulting to its hash
+    new_metadata["filename"] = old_metadata.get("filename") or data_hash
+    new_metadata["codec"] = codec
+    new_metadata["size"] = os.path.getsize(data_path)
+    return new_metadata
+
+
+def get_cache_path(cache_dir, metadata):
+    """
+    Get the path of the file some data is stored in, which is based on its hash;
+    files are sharded across directories by the start of their hash, e.g. ab/cd/abcd..
+    """
+    data_hash = metadata["hash"]
+    data_ext = get_serializer(metadata.get("serializer", None))["ext"]
+    return os.path.join(cache_dir, get_cache_shard(data_hash), data_hash + data_ext)
+
+
+def get_cache_shard(data_hash):
+    """Get the directory, relative to the cache, that a hash is sharded into"""
+    return os.path.join(data_hash[:2], data_hash[2:4])
+
+
+def dump_cache_file(data_path, serializer, data, compression, compression_threshold):
+    """
+    Dump data to a file, returning the codec it was compressed with (if any);
+    data is dumped to a temporary file that only replaces the file once it's
+    complete, so a failed dump never leaves a partial file to be synced
+    """
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    temp_path = "%s.%s%s" % (data_path, uuid.uuid4().hex, TEMP_FILE_SUFFIX)
+    try:
+        with open(temp_path, "wb") as data_file:
+            if compression is None or compression == "none":
+                serializer["dump"](data, data_file)
+                codec = None
+            else:
+                compressing_file = CompressingWriter(
+                    data_file, compression, compression_threshold
+                )
+                serializer["dump"](data, compressing_file)
+                codec = compressing_file.close()
+        os.replace(temp_path, data_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    return codec
+
+
+def read_cache_file(cache_dir, metadata, mmap=False):
+    """Read the data in a cache file using the serializer recorded in its metadata"""
+    data_path = get_cache_path(cache_dir, metadata)
+    serializer = get_serializer(metadata.get("serializer", None))
+    codec = metadata.get("codec", None)
+    # Compressed data can't be memory mapped
+    if is_empty_metadata_value(codec):
+        codec = None
+    if mmap and codec is None and serializer["mmap_load"] is not None:
+        return serializer["mmap_load"](data_path)
+
+    with open(data_path, "rb") as data_file:
+        if codec is None:
+            return serializer["load"](data_file)
+        # Decompress while loading rather than decompressing the whole file first
+        with get_codec(codec)["reader"](data_file) as decompressing_file:
+            return serializer["load"](decompressing_file)
+
+
+@contextlib.contextmanager
+def open_cache_metadata(cache_dir):
+    """
+    Open a transaction on the metadata database of a cache,
+    creating the cache (and migrating any legacy metadata) if it doesn't exist
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    new_cache = not any(
+        os.path.exists(os.path.join(cache_dir, f))
+        for f in [METADATA_FILE, LEGACY_METADATA_FILE]
+    )
+    connection = sqlite3.connect(os.path.join(cache_dir, METADATA_FILE))
+    try:
+        with connection:
+            initialize_metadata_db(connection)
+            # New caches never hold results hashed the ways older caches did
+            if new_cache:
+                upsert_version(connection, "hash", CACHE_HASH_VERSION)
+        migrate_legacy_metadata(cache_dir, connection)
+        # Everything done with the connection is committed in one go
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def initialize_metadata_db(connection):
+    """Create the metadata table, adding any columns missing from older caches"""
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS metadata (hash TEXT PRIMARY KEY NOT NULL)"
+    )
+    existing_columns = [r[1] for r in connection.execute("PRAGMA table_info(metadata)")]
+    for c in METADATA_COLUMNS:
+        if c not in existing_columns:
+            connection.execute("ALTER TABLE metadata ADD COLUMN %s" % c)
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS metadata_filename ON metadata (filename)"
+    )
+    # The modification times of shards when they were last synced
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS shards (shard TEXT PRIMARY KEY NOT NULL, mtime)"
+    )
+    # Versions of how parts of the cache are stored, which are migrated once
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY NOT NULL, version)"
+    )
+
+
+def upsert_version(connection, name, version):
+    connection.execute(
+        "INSERT OR REPLACE INTO versions (name, version) VALUES (?, ?)",
+        (name, version),
+    )
+
+
+def load_hash_version(cache_dir):
+    """Get the version of how the results in a cache are hashed"""
+    with open_cache_metadata(cache_dir) as connection:
+        row = connection.execute(
+            "SELECT version FROM versions WHERE name = 'hash'"
+        ).fetchone()
+    return 0 if row is None else row[0]
+
+
+def store_hash_version(cache_dir, version):
+    """Record that the results in a cache are hashed as of a version"""
+    with open_cache_metadata(cache_dir) as connection:
+        upsert_version(connection, "hash", version)
+
+
+def migrate_legacy_metadata(cache_dir, connection):
+    """One-time conversion of a metadata.csv cache into the metadata database"""
+    legacy_path = os.path.join(cache_dir, LEGACY_METADATA_FILE)
+    if not os.path.exists(legacy_path):
+        return
+    legacy_metadata = pd.read_csv(legacy_path, converters={"sources": pd.eval})
+    legacy_metadata = legacy_metadata.astype(object).where(legacy_metadata.notnull())
+    legacy_rows = legacy_metadata.to_dict("records")
+    for row in legacy_rows:
+        row["sources"] = list(row.get("sources", None) or [])
+        for c in ["time_created", "time_modified"]:
+            row[c] = pd.to_datetime(row.get(c, None)) if row.get(c, None) else None
+    with connection:
+        upsert_metadata_rows(connection, legacy_rows)
+    # Only remove the old metadata once the new one has been committed
+    os.remove(legacy_path)
 
 
 def load_cache_metadata(cache_dir):
@@ -56,24 +293,69 @@ def load_cache_metadata(cache_dir):
     Load the metadata for a cache,
     generating it if it doesn't exist
     """
-    metadata_path = os.path.join(cache_dir, METADATA_FILE)
-    try:
-        metadata = pd.read_csv(metadata_path, converters={"sources": pd.eval})
-    # If the cache doesn't exist, create it
-    except FileNotFoundError:
-        metadata = pd.DataFrame(columns=METADATA_COLUMNS)
-        os.makedirs(cache_dir, exist_ok=True)
-        metadata.to_csv(metadata_path, index=False)
+    rows = load_cache_metadata_rows(cache_dir)
+    metadata = pd.DataFrame.from_records(list(rows.values()), columns=METADATA_COLUMNS)
 
     # Some columns need to have specific datatypes
     metadata["hash"] = metadata["hash"].astype("string")
     metadata["filename"] = metadata["filename"].astype("string")
+    metadata["sources"] = metadata["sources"].astype(object)
     metadata["time_created"] = pd.to_datetime(metadata["time_created"])
     metadata["time_modified"] = pd.to_datetime(metadata["time_modified"])
+    metadata["time_accessed"] = pd.to_datetime(metadata["time_accessed"])
 
     return metadata
 
 
+def load_cache_metadata_rows(cache_dir, data_hashes=None):
+    """
+    Load the metadata of specific hashes (or every hash by default)
+    as a dict of rows keyed by hash
+    """
+    # The journal is replayed before reading the snapshot it applies to, so changes
+    # compacted into the snapshot in between are seen twice (which is harmless)
+    # rather than missed
+    changes = replay_metadata_journal(cache_dir)
+    with open_cache_metadata(cache_dir) as connection:
+        if data_hashes is None:
+            cursor = connection.execute(
+                "SELECT %s FROM metadata" % ", ".join(METADATA_COLUMNS)
+            )
+            rows = {r[0]: decode_metadata_row(r) for r in cursor}
+        else:
+            data_hashes = set(data_hashes)
+            changes = {h: c for h, c in changes.items() if h in data_hashes}
+            rows = select_metadata_rows(connection, data_hashes)
+    return apply_metadata_changes(rows, changes)
+
+
+def find_cached_hashes(cache_dir, data_hashes):
+    """Return the subset of the given hashes that exist in the cache"""
+    return set(load_cache_metadata_rows(cache_dir, data_hashes))
+
+
+def find_filename_hash(cache_dir, filename):
+    """Find the hash of the data stored under a given filename"""
+    # The filename could have been set in either the journal or the snapshot
+    changes = replay_metadata_journal(cache_dir)
+    candidate_hashes = [
+        h
+        for h, c in changes.items()
+        if c["row"] is not None and c["row"]["filename"] == filename
+    ]
+    with open_cache_metadata(cache_dir) as connection:
+        cursor = connection.execute(
+            "SELECT hash FROM metadata WHERE filename = ?", (filename,)
+        )
+        candidate_hashes += [r[0] for r in cursor]
+    # Make sure the candidates haven't since been renamed or removed
+    candidate_rows = load_cache_metadata_rows(cache_dir, candidate_hashes)
+    for data_hash, row in candidate_rows.items():
+        if row["filename"] == filename:
+            return data_hash
+    raise KeyError(filename)
+
+
 def store_cache_metadata(cache_dir, new_metadata):
     """Add one or more rows to the metadata"""
     # First verify that the columns match
@@ -86,28 +368,264 @@ def store_cache_metadata(cache_dir, new_metadata):
         # Ensure columns abide to certain formatting
         new_metadata["hash"] = new_metadata["hash"].apply(str.strip)
 
+    # Convert to rows with python-native empty values
+    new_metadata = new_metadata.astype(object).where(new_metadata.notnull())
+    store_cache_metadata_rows(cache_dir, new_metadata.to_dict("records"))
+
+
+def store_cache_metadata_rows(cache_dir, new_rows):
+    """Add one or more rows, given as dicts, to the metadata"""
     # Make sure columns have correct default values
-    default_fname = lambda r: r["hash"] if pd.isnull(r["filename"]) else r["filename"]
-    default_sources = lambda s: [] if type(s) is not list else s
     modified_time = datetime.datetime.now()
-    default_time_modified = lambda t: modified_time
-    default_time_created = lambda t: t if pd.notnull(t) else modified_time
-    new_metadata["filename"] = new_metadata.apply(default_fname, axis=1)
-    new_metadata["sources"] = new_metadata["sources"].apply(default_sources)
-    new_metadata["time_modified"] = new_metadata["time_modified"].apply(
-        default_time_modified
+    new_rows = [default_metadata_row(row, modified_time) for row in new_rows]
+
+    # Record the rows in the journal, to be combined with existing metadata later
+    append_metadata_rows(cache_dir, new_rows)
+
+
+def append_metadata_rows(cache_dir, rows):
+    """Append rows to the journal as a single batch that is either read whole or not"""
+    if len(rows) == 0:
+        return
+    journal_records = [
+        dict(zip(METADATA_COLUMNS, encode_metadata_row(r))) for r in rows
+    ]
+    append_metadata_journal(cache_dir, [{"batch": journal_records}])
+
+
+def default_metadata_row(row, modified_time):
+    """Fill in the default values of a new metadata row"""
+    row = {c: row.get(c, None) for c in METADATA_COLUMNS}
+    if is_empty_metadata_value(row["filename"]):
+        row["filename"] = row["hash"]
+    if type(row["sources"]) is not list:
+        row["sources"] = []
+    row["time_modified"] = modified_time
+    if is_empty_metadata_value(row["time_created"]):
+        row["time_created"] = modified_time
+    return row
+
+
+def upsert_metadata_rows(connection, new_rows):
+    """Merge rows into the metadata database, combining with existing rows by hash"""
+    existing_rows = select_metadata_rows(connection, [r["hash"] for r in new_rows])
+    for new_row in new_rows:
+        old_row = existing_rows.get(new_row["hash"], None)
+        existing_rows[new_row["hash"]] = combine_metadata_rows(old_row, new_row)
+    connection.executemany(
+        "INSERT OR REPLACE INTO metadata (%s) VALUES (%s)"
+        % (", ".join(METADATA_COLUMNS), ", ".join("?" * len(METADATA_COLUMNS))),
+        [encode_metadata_row(r) for r in existing_rows.values()],
     )
-    new_metadata["time_created"] = new_metadata["time_created"].apply(
-        default_time_created
+
+
+def combine_metadata_rows(old_row, new_row):
+    """Combine two versions of the same row, column by column"""
+    if old_row is None:
+        return new_row
+    combined_row = {
+        c: combine_metadata_values(c, old_row.get(c, None), new_row.get(c, None))
+        for c in METADATA_COLUMNS
+    }
+    combined_row["hash"] = new_row["hash"]
+    return combined_row
+
+
+def append_metadata_journal(cache_dir, journal_records):
+    """
+    Append records to the end of the metadata journal,
+    compacting it in the background if it has grown too large
+    """
+    if len(journal_records) == 0:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    journal_path = os.path.join(cache_dir, METADATA_JOURNAL_FILE)
+    # Every record gets its own line, and a leading newline means
+    # a record torn by a crash can't corrupt the ones appended after it
+    journal_lines = [json.dumps(r) for r in journal_records]
+    with _METADATA_LOCK:
+        # New journals start with an id, so replays can tell them apart
+        if not os.path.exists(journal_path):
+            with open(journal_path, "a") as journal:
+                journal.write(json.dumps({"journal": uuid.uuid4().hex}) + "\n")
+        with open(journal_path, "a") as journal:
+            journal.write("\n" + "\n".join(journal_lines) + "\n")
+            journal_size = journal.tell()
+    if journal_size >= JOURNAL_COMPACTION_SIZE:
+        request_metadata_compaction(cache_dir)
+
+
+def replay_metadata_journal(cache_dir):
+    """
+    Rebuild the changes recorded in the metadata journal since the last compaction,
+    as a dict of {"reset": bool, "row": dict or None} changes keyed by hash
+    """
+    # The current journal is read before the one mid-compaction, since a compaction
+    # starting in between moves its changes there rather than losing them
+    current_changes = replay_journal_file(
+        os.path.join(cache_dir, METADATA_JOURNAL_FILE)
     )
+    compacting_changes = replay_journal_file(
+        os.path.join(cache_dir, COMPACTING_JOURNAL_FILE)
+    )
+    # A journal mid-compaction contains older changes than the current journal
+    return combine_metadata_changes(compacting_changes, current_changes)
+
+
+def replay_journal_file(journal_path):
+    """Replay a single journal file, only reading records added since the last replay"""
+    journal_path = os.path.abspath(journal_path)
+    with _METADATA_LOCK:
+        try:
+            with open(journal_path, "rb") as journal:
+                journal_id = journal.readline()
+                replay = _JOURNAL_REPLAYS.get(journal_path, {})
+                # Start again if the journal was replaced since the last replay
+                if replay.get("id") != journal_id:
+                    replay = {"id": journal_id, "offset": journal.tell(), "changes": {}}
+                journal.seek(replay["offset"])
+                journal_tail = journal.read()
+        except FileNotFoundError:
+            _JOURNAL_REPLAYS.pop(journal_path, None)
+            return {}
+
+        # Only replay complete records, the rest may still be being written
+        journal_tail = journal_tail[: journal_tail.rfind(b"\n") + 1]
+        tail_changes = {}
+        for line in journal_tail.splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Empty or torn records are skipped
+            for r in record["batch"] if "batch" in record else [record]:
+                if "deleted" in r:
+                    tail_changes[r["deleted"]] = {"reset": True, "row": None}
+                    continue
+                row = decode_metadata_row([r.get(c, None) for c in METADATA_COLUMNS])
+                change = {"reset": False, "row": row}
+                old_change = tail_changes.get(row["hash"], None)
+                tail_changes[row["hash"]] = combine_metadata_change(old_change, change)
+
+        replay["offset"] += len(journal_tail)
+        replay["changes"] = combine_metadata_changes(replay["changes"], tail_changes)
+        _JOURNAL_REPLAYS[journal_path] = replay
+        return replay["changes"]
 
-    # Combine with existing metadata
-    old_metadata = load_cache_metadata(cache_dir)
-    metadata = combine_metadata(old_metadata, new_metadata)
 
-    # Save the new metadata
-    metadata_path = os.path.join(cache_dir, METADATA_FILE)
-    metadata.to_csv(metadata_path, index=False)
+def combine_metadata_changes(old_changes, new_changes):
+    """Combine two sets of journal changes, the new ones happening after the old"""
+    combined_changes = dict(old_changes)
+    for data_hash, new_change in new_changes.items():
+        old_change = combined_changes.get(data_hash, None)
+        combined_changes[data_hash] = combine_metadata_change(old_change, new_change)
+    return combined_changes
+
+
+def combine_metadata_change(old_change, new_change):
+    """Combine two journal changes to the same hash"""
+    # Anything before a reset (i.e. deletion) is irrelevant
+    if old_change is None or new_change["reset"]:
+        return new_change
+    return {
+        "reset": old_change["reset"],
+        "row": combine_metadata_rows(old_change["row"], new_change["row"]),
+    }
+
+
+def apply_metadata_changes(rows, changes):
+    """Apply journal changes to a dict of metadata rows keyed by hash"""
+    for data_hash, change in changes.items():
+        if change["reset"]:
+            rows.pop(data_hash, None)
+        if change["row"] is not None:
+            rows[data_hash] = combine_metadata_rows(rows.get(data_hash), change["row"])
+    return rows
+
+
+def request_metadata_compaction(cache_dir):
+    """Start compacting the metadata in a background thread if it isn't already"""
+    with _METADATA_LOCK:
+        compaction = _COMPACTIONS.get(cache_dir, None)
+        if compaction is None or not compaction.is_alive():
+            compaction = threading.Thread(
+                target=compact_cache_metadata, args=(cache_dir,), daemon=True
+            )
+            _COMPACTIONS[cache_dir] = compaction
+            compaction.start()
+    return compaction
+
+
+def compact_cache_metadata(cache_dir):
+    """Fold the metadata journal into the metadata database"""
+    journal_path = os.path.join(cache_dir, METADATA_JOURNAL_FILE)
+    compacting_path = os.path.join(cache_dir, COMPACTING_JOURNAL_FILE)
+    with _METADATA_LOCK:
+        # A journal left over from an interrupted compaction is finished first,
+        # otherwise new records are directed to a new journal while compacting
+        if not os.path.exists(compacting_path):
+            if not os.path.exists(journal_path):
+                return
+            os.replace(journal_path, compacting_path)
+    changes = replay_journal_file(compacting_path)
+
+    # Applying the changes again is harmless, so a crash at any point is recoverable
+    with open_cache_metadata(cache_dir) as connection:
+        reset_hashes = [(h,) for h, c in changes.items() if c["reset"]]
+        connection.executemany("DELETE FROM metadata WHERE hash = ?", reset_hashes)
+        changed_rows = [c["row"] for c in changes.values() if c["row"] is not None]
+        upsert_metadata_rows(connection, changed_rows)
+    with _METADATA_LOCK:
+        os.remove(compacting_path)
+        _JOURNAL_REPLAYS.pop(os.path.abspath(compacting_path), None)
+
+
+def select_metadata_rows(connection, data_hashes):
+    """Look up the rows for a list of hashes using the hash index"""
+    data_hashes = list(set(data_hashes))
+    selected_rows = {}
+    # Sqlite limits the number of parameters in a single query
+    for i in range(0, len(data_hashes), 500):
+        hash_chunk = data_hashes[i : i + 500]
+        cursor = connection.execute(
+            "SELECT %s FROM metadata WHERE hash IN (%s)"
+            % (", ".join(METADATA_COLUMNS), ", ".join("?" * len(hash_chunk))),
+            hash_chunk,
+        )
+        for r in cursor:
+            row = decode_metadata_row(r)
+            selected_rows[row["hash"]] = row
+    return selected_rows
+
+
+def encode_metadata_row(row):
+    """Convert a metadata row into values that can be stored by sqlite"""
+    encoded_row = []
+    for c in METADATA_COLUMNS:
+        value = row.get(c, None)
+        if c == "sources":
+            value = json.dumps(list(value) if type(value) is list else [])
+        elif is_empty_metadata_value(value):
+            value = None
+        elif c.startswith("time_"):
+            value = pd.Timestamp(value).isoformat()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        encoded_row.append(value)
+    return encoded_row
+
+
+def decode_metadata_row(encoded_row):
+    """Convert values loaded from sqlite back into a metadata row"""
+    row = dict(zip(METADATA_COLUMNS, encoded_row))
+    row["sources"] = json.loads(row["sources"]) if row["sources"] else []
+    for c in ["time_created", "time_modified", "time_accessed"]:
+        row[c] = pd.Timestamp(row[c]) if row[c] else None
+    return row
+
+
+def is_empty_metadata_value(value):
+    """Lists are empty if they have no items, anything else if it is null"""
+    return (len(value) == 0) if type(value) == list else pd.isnull(value)
 
 
 def combine_metadata(old_metadata, new_metadata):
@@ -132,6 +650,17 @@ def combine_metadata(old_metadata, new_metadata):
 
 def combine_metadata_columns(c_name, old_column, new_column):
     """Combine different columns based on the data they are supposed to store"""
+    # Put the columns into a single df and combine
+    old_new_df = pd.DataFrame({"old": old_column, "new": new_column})
+    combined_column = old_new_df.apply(
+        lambda r: combine_metadata_values(c_name, r["old"], r["new"]), axis=1
+    )
+
+    return combined_column
+
+
+def combine_metadata_values(c_name, old_value, new_value):
+    """Combine a pair of values based on the column they are supposed to be in"""
     # Detrmine the merge function and default empty value for the column
     match c_name:
         case "sources":
@@ -140,91 +669,455 @@ def combine_metadata_columns(c_name, old_column, new_column):
         case "time_created":
             default_value = pd.NaT
             combine_function = lambda old, new: min(old, new)
-        case "time_modified":
+        case "time_modified" | "time_accessed":
             default_value = pd.NaT
             combine_function = lambda old, new: max(old, new)
+        case "access_count":
+            default_value = np.nan
+            combine_function = lambda old, new: max(old, new)
         case _:
             default_value = np.nan
             combine_function = lambda old, new: new
 
-    # But this will only apply to rows where both old and new columns have values
-    is_empty = lambda x: (len(x) == 0) if type(x) == list else pd.isnull(x)
-    merge_function = (
-        # Default if both columns "empty"
-        lambda r: (
-            default_value
-            if is_empty(r["new"]) and is_empty(r["old"])
-            # If only one is empty, use non-empty one
-            else (
-                (r["new"] if is_empty(r["old"]) else r["old"])
-                if is_empty(r["new"]) or is_empty(r["old"])
-                # If both aren't empty, combine them as necessary
-                else combine_function(r["old"], r["new"])
-            )
-        )
-    )
-
-    # Put the columns into a single df and combine
-    old_new_df = pd.DataFrame({"old": old_column, "new": new_column})
-    combined_column = old_new_df.apply(merge_function, axis=1)
-
-    return combined_column
+    # But this will only apply to values where both old and new have values
+    is_empty = is_empty_metadata_value
+    # Default if both values "empty"
+    if is_empty(new_value) and is_empty(old_value):
+        return default_value
+    # If only one is empty, use non-empty one
+    if is_empty(new_value) or is_empty(old_value):
+        return new_value if is_empty(old_value) else old_value
+    # If both aren't empty, combine them as necessary
+    return combine_function(old_value, new_value)
 
 
 def update_cache_filenames(cache_dir):
-    """Update the filenames of files in the cache based on metadata"""
+    """
+    Update the filenames of data in the cache based on metadata;
+    these are readable names for the data rather than where it is stored
+    """
     # First load the existing ones
-    metadata = load_cache_metadata(cache_dir)
-    filenames = metadata["filename"]
-    # Then generate what they should be
-    hashes = metadata["hash"]
-    sources = metadata["sources"]
-    # Hackyish fix to prune sources
-    get_first_source = lambda s: s[0] if type(s) == list and len(s) > 0 else np.nan
-    sources = sources.apply(get_first_source)
-    source_to_fname = lambda x: re.sub(r"[^a-zA-Z0-9]", "_", str(x).lower())
-    expected_filenames = sources.apply(source_to_fname)
-    expected_filenames += "_" + hashes.str.slice(0, 4)
-    # hacky fix for nans
-    expected_filenames = expected_filenames.apply(
-        lambda x: np.nan if x.startswith("nan") else x
-    )
+    metadata = load_cache_metadata_rows(cache_dir)
+    # Then save the ones that should change
+    renamed_rows = rename_cache_rows(metadata.values())
+    store_cache_metadata_rows(cache_dir, renamed_rows)
 
-    # Find the filenames that don't match
-    filename_mask = filenames != expected_filenames
-    filename_mask = filename_mask & expected_filenames.apply(pd.notnull)
-    filenames_from = filenames[filename_mask]
-    filenames_to = expected_filenames[filename_mask]
-    # Rename the relevant files
-    for fname_from, fname_to in zip(filenames_from, filenames_to):
-        fname_from = os.path.join(cache_dir, fname_from)
-        fname_to = os.path.join(cache_dir, fname_to)
-        # Hacky fix for file being the wrong name
-        try:
-            os.rename(fname_from, fname_to)
-        except:
+
+def rename_cache_rows(rows):
+    """Return the rows whose filenames don't match what they should be, renamed"""
+    renamed_rows = []
+    for row in rows:
+        # Find the filenames that don't match
+        expected_filename = expected_cache_filename(row)
+        if expected_filename is None or expected_filename == row["filename"]:
             continue
+        renamed_rows.append({"hash": row["hash"], "filename": expected_filename})
+    return renamed_rows
 
-    # Save the new filenames
-    metadata["filename"] = expected_filenames
-    store_cache_metadata(cache_dir, metadata)
+
+def expected_cache_filename(row):
+    """Generate a readable filename from the first source of some data"""
+    sources = row["sources"]
+    # Hackyish fix to prune sources
+    if type(sources) != list or len(sources) == 0:
+        return None
+    source_fname = re.sub(r"[^a-zA-Z0-9]", "_", str(sources[0]).lower())
+    # Keep the extension of the serializer the data was stored with
+    data_ext = get_serializer(row.get("serializer", None))["ext"]
+    return source_fname + "_" + row["hash"][:4] + data_ext
 
 
 def sync_cache_metadata(cache_dir):
     """
     Check through the files in the cache
-    adding any new ones and deleting missing ones from the metadata
-    """
-    metadata = load_cache_metadata(cache_dir)
-    recorded_files = metadata["filename"]
-    files_in_cache = os.listdir(cache_dir)
-    files_in_cache.remove(METADATA_FILE)
-    # Remove missing file metadata
-    missing_files = [f for f in recorded_files if f not in files_in_cache]
-    if len(missing_files):
-        metadata = metadata[~metadata["filename"].isin(missing_files)]
-        metadata_path = os.path.join(cache_dir, METADATA_FILE)
-        metadata.to_csv(metadata_path, index=False)
-    # Add missing files
-    unsaved_files = [f for f in files_in_cache if f not in recorded_files]
-    store_cache_metadata(cache_dir, pd.DataFrame({"hash": unsaved_files}))
+    adding any new ones and deleting missing ones from the metadata;
+    only shards that have changed since the last sync are checked
+    """
+    migrate_cache_layout(cache_dir)
+    metadata = load_cache_metadata_rows(cache_dir)
+
+    # Files added to the top of the cache (e.g. by hand) are moved into their shard
+    new_rows = {}
+    for filename in os.listdir(cache_dir):
+        file_path = os.path.join(cache_dir, filename)
+        if filename in METADATA_FILES or not os.path.isfile(file_path):
+            continue
+        new_row = {"hash": filename, "filename": filename}
+        move_cache_file(file_path, get_cache_path(cache_dir, new_row))
+        new_rows[filename] = metadata.get(filename, {}) | new_row
+
+    # Group the files that should exist by the shard they should be in
+    expected_files = {}
+    for data_hash, row in (metadata | new_rows).items():
+        shard = get_cache_shard(data_hash)
+        data_filename = os.path.basename(get_cache_path(cache_dir, row))
+        expected_files.setdefault(shard, {})[data_filename] = data_hash
+
+    # Only list the shards that have changed since they were last synced
+    with open_cache_metadata(cache_dir) as connection:
+        synced_shards = dict(connection.execute("SELECT shard, mtime FROM shards"))
+    missing_hashes = []
+    shard_mtimes = {}
+    for shard in set(expected_files) | set(synced_shards):
+        shard_mtime = get_mtime(os.path.join(cache_dir, shard))
+        shard_mtimes[shard] = shard_mtime
+        if shard_mtime is not None and shard_mtime == synced_shards.get(shard, None):
+            continue
+        shard_files = expected_files.get(shard, {})
+        files_in_shard = set()
+        if shard_mtime is not None:
+            files_in_shard = set(os.listdir(os.path.join(cache_dir, shard)))
+        # Remove missing file metadata
+        missing_hashes += [h for f, h in shard_files.items() if f not in files_in_shard]
+        # Add missing files
+        for filename in sorted(files_in_shard - set(shard_files)):
+            # Temporary files are only left behind by dumps that crashed
+            if filename.endswith(TEMP_FILE_SUFFIX):
+                continue
+            new_row = parse_cache_filename(filename)
+            new_rows[new_row["hash"]] = new_row
+
+    if len(missing_hashes):
+        append_metadata_journal(cache_dir, [{"deleted": h} for h in missing_hashes])
+    store_cache_metadata_rows(cache_dir, list(new_rows.values()))
+    with open_cache_metadata(cache_dir) as connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO shards (shard, mtime) VALUES (?, ?)",
+            list(shard_mtimes.items()),
+        )
+
+
+def parse_cache_filename(filename):
+    """Work out the metadata of an unrecorded file in a shard from its name"""
+    for serializer_name, data_ext in get_serializer_exts().items():
+        if data_ext and filename.endswith(data_ext):
+            data_hash = filename[: -len(data_ext)]
+            return {
+                "hash": data_hash,
+                "filename": data_hash,
+                "serializer": serializer_name,
+            }
+    return {"hash": filename, "filename": filename}
+
+
+def migrate_cache_layout(cache_dir):
+    """One-time conversion of a flat cache directory into sharded directories"""
+    with open_cache_metadata(cache_dir) as connection:
+        layout_version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if layout_version >= CACHE_LAYOUT_VERSION:
+        return
+
+    # Flat caches store each file directly in the cache under its filename
+    for row in load_cache_metadata_rows(cache_dir).values():
+        flat_path = os.path.join(cache_dir, row["filename"] or row["hash"])
+        if os.path.isfile(flat_path):
+            move_cache_file(flat_path, get_cache_path(cache_dir, row))
+
+    with open_cache_metadata(cache_dir) as connection:
+        connection.execute("PRAGMA user_version = %d" % CACHE_LAYOUT_VERSION)
+
+
+def remap_cache_hashes(cache_dir, hash_map):
+    """
+    Move cached data from old hashes to new ones, given as {old: new},
+    returning the new hashes of the data that was moved
+    """
+    old_rows = load_cache_metadata_rows(cache_dir, list(hash_map))
+    new_rows = {}
+    moved_hashes = []
+    for old_hash, row in old_rows.items():
+        new_row = row | {"hash": hash_map[old_hash]}
+        if new_row["hash"] in new_rows:
+            continue
+        try:
+            move_cache_file(
+                get_cache_path(cache_dir, row), get_cache_path(cache_dir, new_row)
+            )
+        except FileNotFoundError:
+            continue
+        new_row["filename"] = expected_cache_filename(new_row) or new_row["hash"]
+        new_rows[new_row["hash"]] = new_row
+        moved_hashes.append(old_hash)
+
+    append_metadata_journal(cache_dir, [{"deleted": h} for h in moved_hashes])
+    store_cache_metadata_rows(cache_dir, list(new_rows.values()))
+    return set(new_rows)
+
+
+def evict_cache_data(cache_dir, cache_budget, kept_hashes=()):
+    """
+    Delete cached data until the cache fits within a budget of bytes,
+    other than the given hashes (e.g. results), returning the hashes of the
+    data that was evicted
+    """
+    metadata = load_cache_metadata_rows(cache_dir)
+    data_sizes = {h: get_cache_size(cache_dir, r) for h, r in metadata.items()}
+    cache_size = sum(data_sizes.values())
+    if cache_size <= cache_budget:
+        return []
+
+    # Only data computed by a process can be recomputed, so nothing else is evicted
+    now = pd.Timestamp.now()
+    kept_hashes = set(kept_hashes)
+    evictable_rows = [
+        r
+        for r in metadata.values()
+        if not is_empty_metadata_value(r["compute_time"])
+        and r["hash"] not in kept_hashes
+    ]
+    evictable_rows.sort(key=lambda r: get_eviction_score(r, data_sizes[r["hash"]], now))
+    evicted_hashes = []
+    for row in evictable_rows:
+        if cache_size <= cache_budget:
+            break
+        try:
+            os.remove(get_cache_path(cache_dir, row))
+        except FileNotFoundError:
+            pass
+        cache_size -= data_sizes[row["hash"]]
+        evicted_hashes.append(row["hash"])
+
+    append_metadata_journal(cache_dir, [{"deleted": h} for h in evicted_hashes])
+    logging.info(
+        "Evicted %d files from the cache, which is now %d bytes"
+        % (len(evicted_hashes), cache_size)
+    )
+    return evicted_hashes
+
+
+def get_eviction_score(row, data_size, now):
+    """
+    Score how worthwhile it is to keep some data in the cache,
+    as (recompute time * access frequency) / size, where data that hasn't
+    been accessed for a while is treated as being accessed less frequently
+    """
+    access_count = row["access_count"]
+    access_count = 0 if is_empty_metadata_value(access_count) else access_count
+    last_accessed = row["time_accessed"]
+    if is_empty_metadata_value(last_accessed):
+        last_accessed = row["time_created"]
+    if is_empty_metadata_value(last_accessed):
+        last_accessed = now
+    days_unaccessed = max((now - last_accessed).total_seconds(), 0) / 86400
+    access_frequency = (access_count + 1) / (days_unaccessed + 1)
+    return row["compute_time"] * access_frequency / max(data_size, 1)
+
+
+def get_cache_size(cache_dir, row):
+    """Get the size of some data in the cache, checking the file if it's unrecorded"""
+    if not is_empty_metadata_value(row["size"]):
+        return row["size"]
+    try:
+        return os.path.getsize(get_cache_path(cache_dir, row))
+    except FileNotFoundError:
+        return 0
+
+
+def parse_byte_size(size):
+    """Convert a size like 2048, "500MB" or "2G" into a number of bytes"""
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size_match = re.fullmatch(r"\s*([0-9.]+)\s*([kmgt]?)i?b?\s*", str(size).lower())
+    if size_match is None:
+        raise ValueError("Unknown size %s" % size)
+    return int(float(size_match[1]) * BYTE_UNITS[size_match[2]])
+
+
+def move_cache_file(path_from, path_to):
+    """Move a file within the cache, creating its new directory if necessary"""
+    os.makedirs(os.path.dirname(path_to), exist_ok=True)
+    os.replace(path_from, path_to)
+
+
+def get_mtime(path):
+    """Get the modification time of a path, or None if it doesn't exist"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class CacheSession:
+    """
+    Keep changes to the metadata of a cache in memory while data is being stored,
+    writing them all at once when the session ends, or every flush_interval seconds;
+    with a write_queue_size, data is written by a background thread while the
+    caller carries on, holding up the caller if that many writes are queued
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        flush_interval=None,
+        update_filenames=False,
+        compression=None,
+        compression_threshold=None,
+        write_queue_size=None,
+    ):
+        self.cache_dir = cache_dir
+        self.flush_interval = flush_interval
+        self.update_filenames = update_filenames
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.write_queue_size = write_queue_size
+        self.pending_rows = {}
+        self.last_flush = time.monotonic()
+        # Data queued to be written, kept so it can be read before it's written
+        self.pending_writes = {}
+        self.write_queue = None
+        self.writer = None
+        self.write_error = None
+        self.lock = threading.RLock()
+        self.writes_changed = threading.Condition(self.lock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Data that was stored before any error should still be recorded
+        try:
+            self.flush()
+        finally:
+            self.stop_writer()
+
+    def store_data(self, data_hash, data):
+        """Store the given data in the cache, recording its metadata in the session"""
+        if not self.write_queue_size:
+            self.write_data(data_hash, data)
+            return
+        self.raise_write_error()
+        if self.writer is None:
+            self.write_queue = queue.Queue(self.write_queue_size)
+            self.writer = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer.start()
+        with self.lock:
+            write_number = self.pending_writes.get(data_hash, (None, 0))[1] + 1
+            self.pending_writes[data_hash] = (data, write_number)
+        # Waits for space in the queue if the writer has fallen behind
+        self.write_queue.put((data_hash, data, write_number))
+
+    def write_data(self, data_hash, data):
+        """Write data to a file in the cache and record its metadata"""
+        new_metadata = write_cache_file(
+            self.cache_dir,
+            data_hash,
+            data,
+            self.get_metadata(data_hash, wait=False),
+            self.compression,
+            self.compression_threshold,
+        )
+        self.store_metadata_rows([new_metadata])
+
+    def run_writer(self):
+        """Write queued data to the cache until told to stop"""
+        while True:
+            queued_write = self.write_queue.get()
+            if queued_write is None:
+                self.write_queue.task_done()
+                return
+            data_hash, data, write_number = queued_write
+            try:
+                self.write_data(data_hash, data)
+            except Exception as e:
+                self.write_error = e
+            with self.lock:
+                # Only stop reading the data from memory once its latest write is done
+                if self.pending_writes.get(data_hash, (None, 0))[1] == write_number:
+                    del self.pending_writes[data_hash]
+                self.writes_changed.notify_all()
+            self.write_queue.task_done()
+
+    def wait_for_writes(self, data_hash=None):
+        """Wait until some data (or all data by default) has been written"""
+        if self.writer is None:
+            return
+        if data_hash is None:
+            self.write_queue.join()
+        else:
+            with self.lock:
+                self.writes_changed.wait_for(
+                    lambda: data_hash not in self.pending_writes
+                )
+        self.raise_write_error()
+
+    def raise_write_error(self):
+        """Raise any error the writer came across in the caller"""
+        if self.write_error is not None:
+            write_error, self.write_error = self.write_error, None
+            raise write_error
+
+    def stop_writer(self):
+        if self.writer is not None:
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def load_data(self, data_hash, mmap=False):
+        """Load data from the cache, including data stored in this session"""
+        with self.lock:
+            if data_hash in self.pending_writes:
+                return self.pending_writes[data_hash][0]
+        return read_cache_file(self.cache_dir, self.get_metadata(data_hash), mmap)
+
+    def get_metadata(self, data_hash, wait=True):
+        """
+        Get the metadata of some data, including changes made in this session,
+        waiting for the data to be written first unless told not to
+        """
+        if wait:
+            self.wait_for_writes(data_hash)
+        cached_row = load_cache_metadata_rows(self.cache_dir, [data_hash]).get(
+            data_hash
+        )
+        with self.lock:
+            pending_row = self.pending_rows.get(data_hash, None)
+        if pending_row is None:
+            return cached_row or {"hash": data_hash}
+        return combine_metadata_rows(cached_row, pending_row)
+
+    def store_metadata_rows(self, new_rows):
+        """Add rows, given as dicts, to the metadata to be written"""
+        modified_time = datetime.datetime.now()
+        with self.lock:
+            for row in new_rows:
+                # Filenames are left empty so they don't override existing ones
+                filename = row.get("filename", None)
+                row = default_metadata_row(row, modified_time) | {"filename": filename}
+                pending_row = self.pending_rows.get(row["hash"], None)
+                self.pending_rows[row["hash"]] = combine_metadata_rows(pending_row, row)
+
+            # Write the metadata if it's been long enough since it was last written
+            since_flush = time.monotonic() - self.last_flush
+            if self.flush_interval is not None and since_flush >= self.flush_interval:
+                self.write_metadata()
+
+    def flush(self):
+        """Wait for all data to be written, then write its metadata"""
+        self.wait_for_writes()
+        self.write_metadata()
+
+    def write_metadata(self):
+        """Write every pending metadata change to the cache in a single batch"""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if len(self.pending_rows) == 0:
+                return
+            rows = self.pending_rows
+            cached_rows = load_cache_metadata_rows(self.cache_dir, rows)
+            # Data that isn't in the cache yet defaults to its hash as a filename
+            for data_hash, row in rows.items():
+                if (
+                    is_empty_metadata_value(row["filename"])
+                    and data_hash not in cached_rows
+                ):
+                    row["filename"] = data_hash
+            if self.update_filenames:
+                # Filenames are based on all the sources of the data, not only new ones
+                combined_rows = [
+                    combine_metadata_rows(cached_rows.get(h), r)
+                    for h, r in rows.items()
+                ]
+                for renamed_row in rename_cache_rows(combined_rows):
+                    rows[renamed_row["hash"]] |= renamed_row
+            append_metadata_rows(self.cache_dir, list(rows.values()))
+            self.pending_rows = {}
@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 import os
-import yaml
+import sys
+import time
 import shutil
 import argparse
-from matplotlib import pyplot as plt
-import yaht.cache_management as CM
+import builtins
+import contextlib
 from yaht.defaults import *
-from yaht.config_processing import read_config_file
-from yaht.processes import find_processes
-from yaht.outputs import output_results, find_outputs
-from yaht.laboratory import Laboratory
+
+# Heavy modules (pandas, networkx etc) are only imported by the commands that need
+# them, so the cli starts quickly; set this to report where startup time goes
+PROFILE_IMPORTS_VAR = "YAHT_PROFILE_IMPORTS"
 
 
 def cli():
@@ -37,26 +38,50 @@ def cli():
     run_parser = subparsers.add_parser(
         "run", help="Run experiments specified in the config"
     )
+    run_parser.add_argument(
+        "-j", "--jobs", help="Number of processes to run in parallel", type=int
+    )
+    # Plan parser to show what running experiments would do
+    plan_parser = subparsers.add_parser(
+        "plan", help="Show which processes would run, and estimate their cost"
+    )
+    plan_parser.add_argument(
+        "-j", "--jobs", help="Number of processes to run in parallel", type=int
+    )
     # Results parser to get previous results
     result_parser = subparsers.add_parser("results", help="Output latest results")
     # Clear cache parser to clear the cache
     result_parser = subparsers.add_parser("clear-cache", help="Clear the cache")
+    # Migrate cache parser to convert caches made by older versions of yaht
+    migrate_parser = subparsers.add_parser(
+        "migrate-cache", help="Convert the cache to the current layout"
+    )
     # TODO: Aggregate cache commands into a cache subcommand
 
     args = parser.parse_args()
-    # Execute relevant commands
+    if os.environ.get(PROFILE_IMPORTS_VAR):
+        with profile_imports():
+            run_command(args)
+    else:
+        run_command(args)
+
+
+def run_command(args):
+    """Execute the command given to the cli"""
     if args.command == "init":
         gen_scaffold()
     if args.command == "add":
         add_file(args.path)
     if args.command == "run":
-        find_processes()
-        run_experiments()
+        run_experiments(jobs=args.jobs)
+    if args.command == "plan":
+        plan_experiments(jobs=args.jobs)
     if args.command == "results":
-        find_outputs()
         output_experiment_results()
     if args.command == "clear-cache":
         clear_cache()
+    if args.command == "migrate-cache":
+        migrate_cache()
 
 
 def gen_scaffold(config_file=DEFAULT_CONFIG_FILE, cache_dir=DEFAULT_CACHE_DIR):
@@ -100,6 +125,8 @@ def add_file(
         shutil.copy(file_path, target_path)
 
     # Add the file to the config
+    import yaml
+
     with open(config_file, "r") as config_stream:
         config = yaml.safe_load(config_stream)
     if not config.get("SOURCES"):
@@ -109,17 +136,83 @@ def add_file(
         yaml.dump(config, config_stream, default_flow_style=False)
 
 
-def run_experiments(config_file=DEFAULT_CONFIG_FILE, cache_dir=DEFAULT_CACHE_DIR):
+def run_experiments(
+    config_file=DEFAULT_CONFIG_FILE, cache_dir=DEFAULT_CACHE_DIR, jobs=None
+):
     """Run all the experiments specified in the config file"""
+    from yaht.config_processing import read_config_file
+    from yaht.laboratory import Laboratory
+
     config = read_config_file(config_file)
+    find_config_processes(config)
     lab = Laboratory(config)
     # Run the experiments
-    lab.run_experiments()
+    lab.run_experiments(jobs=jobs)
+
+
+def plan_experiments(config_file=DEFAULT_CONFIG_FILE, jobs=None):
+    """Print what running the experiments would do, without running anything"""
+    from yaht.config_processing import read_config_file
+    from yaht.laboratory import Laboratory
+
+    config = read_config_file(config_file)
+    find_config_processes(config)
+    lab = Laboratory(config)
+    plan, summary = lab.plan_experiments(jobs=jobs)
+    print(plan.astype(object).fillna("-").to_string(index=False))
+    print(
+        "\n%(run)d processes to run, %(cached)d cached "
+        "and %(shared)d shared with other processes" % summary
+    )
+    if summary["unestimated"]:
+        print("%(unestimated)d processes have never run before" % summary)
+    print(
+        "Estimated %s of processing, taking %s with %d jobs, writing %s"
+        % (
+            format_duration(summary["total_time"]),
+            format_duration(summary["wall_time"]),
+            summary["jobs"],
+            format_size(summary["total_size"]),
+        )
+    )
+    return plan, summary
+
+
+def find_config_processes(config):
+    """Import only the modules defining the processes a config uses"""
+    from yaht.processes import find_processes
+    from yaht.structure import get_config_function_names
+
+    process_names = get_config_function_names(config)
+    find_processes(process_names, config.get("settings", {}))
+
+
+def format_duration(seconds):
+    """Format a number of seconds to be readable"""
+    hours, remainder = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def format_size(n_bytes):
+    """Format a number of bytes to be readable"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n_bytes < 1024:
+            return "%.1f%s" % (n_bytes, unit)
+        n_bytes /= 1024
+    return "%.1fTB" % n_bytes
 
 
 def output_experiment_results(config_file=DEFAULT_CONFIG_FILE):
     """Load the results from any experiments performed as defined in the config file"""
+    from yaht.config_processing import read_config_file
+    from yaht.laboratory import Laboratory
+    from yaht.outputs import output_results, find_outputs
+
     config = read_config_file(config_file)
+    find_config_processes(config)
+    output_names = set(config.get("outputs", {}).values()) - {None}
+    find_outputs(output_names, config.get("settings", {}))
     lab = Laboratory(config)
     # Get the results and pass them to output functions
     results = lab.get_results()
@@ -135,5 +228,67 @@ def clear_cache(cache_dir=DEFAULT_CACHE_DIR):
             os.rmdir(os.path.join(root, name))
 
 
+def migrate_cache(cache_dir=DEFAULT_CACHE_DIR):
+    """Convert a cache made by an older version of yaht to the current layout"""
+    if cache_dir == DEFAULT_CACHE_DIR:
+        cache_dir = os.environ.get("YAHT_CACHE_DIR", DEFAULT_CACHE_DIR)
+    import yaht.cache_management as CM
+
+    CM.migrate_cache_layout(cache_dir)
+    CM.sync_cache_metadata(cache_dir)
+
+
+@contextlib.contextmanager
+def profile_imports(report_stream=None, n_modules=15):
+    """
+    Time the first import of every module while running a command, then report
+    the slowest, both including and excluding the modules they imported
+    """
+    report_stream = report_stream or sys.stderr
+    original_import = builtins.__import__
+    import_times = {}
+    # Time spent importing other modules, for each import in progress
+    nested_times = [0.0]
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+        start_time = time.perf_counter()
+        nested_times.append(0.0)
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            import_time = time.perf_counter() - start_time
+            self_time = import_time - nested_times.pop()
+            nested_times[-1] += import_time
+            import_times.setdefault(name, (import_time, self_time))
+
+    start_time = time.perf_counter()
+    builtins.__import__ = timed_import
+    try:
+        yield import_times
+    finally:
+        builtins.__import__ = original_import
+        total_time = time.perf_counter() - start_time
+        report_import_times(
+            report_stream, import_times, nested_times[0], total_time, n_modules
+        )
+
+
+def report_import_times(report_stream, import_times, import_time, total_time, n):
+    """Print the n slowest imports, and how much of the total time went to imports"""
+    print("Slowest imports (total, self):", file=report_stream)
+    slowest_imports = sorted(import_times.items(), key=lambda i: -i[1][0])
+    for name, (module_time, self_time) in slowest_imports[:n]:
+        print(
+            "  %8.3fs %8.3fs  %s" % (module_time, self_time, name), file=report_stream
+        )
+    print(
+        "Imported %d modules in %.3fs, of the %.3fs the command took"
+        % (len(import_times), import_time, total_time),
+        file=report_stream,
+    )
+
+
 if __name__ == "__main__":
     cli()
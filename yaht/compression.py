@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import bz2
+import gzip
+import lzma
+import importlib.util
+
+CODECS = {}
+# The codecs tried when favouring speed or size, in order of preference
+CODEC_PREFERENCES = {
+    "speed": ["lz4", "zstd", "gzip"],
+    "size": ["zstd", "lzma", "bz2", "gzip"],
+}
+# Data is only compressed if it is at least this big...
+DEFAULT_COMPRESSION_THRESHOLD = 1024 * 1024
+# ...and if trial compressing its start shrinks it to this fraction or less
+MAX_COMPRESSION_RATIO = 0.9
+TRIAL_SAMPLE_SIZE = 256 * 1024
+
+
+def register_codec(name, writer, reader, compress):
+    """
+    Register a compression codec for cached data;
+    writer(file, favour) and reader(file) wrap binary files to stream through the
+    codec, and compress(data, favour) compresses bytes for trial compressions
+    """
+    CODECS[name] = {
+        "name": name,
+        "writer": writer,
+        "reader": reader,
+        "compress": compress,
+    }
+    return CODECS[name]
+
+
+def get_codec(codec_name):
+    """Function to return a codec by name"""
+    return CODECS[codec_name]
+
+
+def check_compression(compression):
+    """Raise an error if compression isn't "none", "speed", "size" or a codec name"""
+    valid_names = ["none", *CODEC_PREFERENCES, *CODECS]
+    if compression is not None and compression not in valid_names:
+        raise ValueError(
+            "Unknown compression %s, expected one of %s"
+            % (compression, ", ".join(valid_names))
+        )
+
+
+def choose_codec(sample, compression):
+    """
+    Choose the codec to use for data based on a sample of it,
+    returning None if it isn't worth compressing
+    """
+    # Compression can either favour speed or size, or name a specific codec
+    codec_names = CODEC_PREFERENCES.get(compression, [compression])
+    codec_names = [c for c in codec_names if c in CODECS]
+    if compression == "speed":
+        codec_names = codec_names[:1]
+    favour = "speed" if compression == "speed" else "size"
+
+    # Trial compress the sample with each codec and pick the one that shrinks it most
+    best_codec, best_size = None, MAX_COMPRESSION_RATIO * len(sample)
+    for codec_name in codec_names:
+        compressed_size = len(CODECS[codec_name]["compress"](sample, favour))
+        if compressed_size <= best_size:
+            best_codec, best_size = codec_name, compressed_size
+    return best_codec
+
+
+class CompressingWriter:
+    """
+    Binary file wrapper that holds back what is written to it until it reaches
+    the threshold, so it can decide on a codec from a sample of its start before
+    streaming everything through that codec
+    """
+
+    def __init__(self, data_file, compression, threshold=None):
+        check_compression(compression)
+        self.data_file = data_file
+        self.compression = compression
+        self.threshold = threshold or DEFAULT_COMPRESSION_THRESHOLD
+        self.sample_size = min(self.threshold, TRIAL_SAMPLE_SIZE)
+        self.held_back = bytearray()
+        self.position = 0
+        self.stream = None
+        self.codec = None
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self.position += len(data)
+        # Decide once there's enough data to know it's worth compressing,
+        # sampling the write that reaches the threshold without copying all of it
+        if self.stream is None and self.position >= self.threshold:
+            sample_rest = max(self.sample_size - len(self.held_back), 0)
+            sample = bytes(self.held_back[: self.sample_size]) + bytes(
+                data[:sample_rest]
+            )
+            self.start_stream(choose_codec(sample, self.compression))
+        if self.stream is None:
+            self.held_back += data
+        else:
+            self.stream.write(data)
+        return len(data)
+
+    def start_stream(self, codec_name):
+        """Start writing through the given codec, beginning with the held back data"""
+        self.codec = codec_name
+        if codec_name is None:
+            self.stream = self.data_file
+        else:
+            favour = "speed" if self.compression == "speed" else "size"
+            self.stream = CODECS[codec_name]["writer"](self.data_file, favour)
+        self.stream.write(self.held_back)
+        self.held_back = bytearray()
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Finish writing, returning the name of the codec used (if any)"""
+        # Anything that never reached the threshold isn't compressed
+        if self.stream is None:
+            self.start_stream(None)
+        if self.stream is not self.data_file:
+            self.stream.close()
+        return self.codec
+
+
+# Codecs that come with python
+register_codec(
+    "gzip",
+    lambda f, favour: gzip.GzipFile(
+        fileobj=f, mode="wb", compresslevel=1 if favour == "speed" else 9
+    ),
+    lambda f: gzip.GzipFile(fileobj=f, mode="rb"),
+    lambda data, favour: gzip.compress(
+        data, compresslevel=1 if favour == "speed" else 9
+    ),
+)
+register_codec(
+    "bz2",
+    lambda f, favour: bz2.BZ2File(f, "wb"),
+    lambda f: bz2.BZ2File(f, "rb"),
+    lambda data, favour: bz2.compress(data),
+)
+register_codec(
+    "lzma",
+    lambda f, favour: lzma.LZMAFile(f, "wb"),
+    lambda f: lzma.LZMAFile(f, "rb"),
+    lambda data, favour: lzma.compress(data),
+)
+# Faster codecs are only available if they are installed
+if importlib.util.find_spec("zstandard") is not None:
+    import zstandard
+
+    zstd_level = lambda favour: 1 if favour == "speed" else 19
+    register_codec(
+        "zstd",
+        lambda f, favour: zstandard.open(
+            f, "wb", cctx=zstandard.ZstdCompressor(level=zstd_level(favour))
+        ),
+        lambda f: zstandard.open(f, "rb"),
+        lambda data, favour: zstandard.compress(data, zstd_level(favour)),
+    )
+if importlib.util.find_spec("lz4") is not None:
+    import lz4.frame
+
+    register_codec(
+        "lz4",
+        lambda f, favour: lz4.frame.open(f, "wb"),
+        lambda f: lz4.frame.open(f, "rb"),
+        lambda data, favour: lz4.frame.compress(data),
+    )
@@ -1,5 +1,22 @@
 #!/usr/bin/env python3
+import re
 import yaml
+from yaht.sweeps import SweepTrials
+from yaht.scheduling import parse_schedule
+
+
+class ConfigLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+    """
+    Yaml loader which also reads numbers like 1e-2 as floats, as yaml 1.2 does,
+    using libyaml to read large configs quickly where it is available
+    """
+
+
+ConfigLoader.add_implicit_resolver(
+    "tag:yaml.org,2002:float",
+    re.compile(r"^[-+]?[0-9][0-9_]*(?:\.[0-9_]*)?[eE][-+]?[0-9]+$"),
+    list("-+0123456789"),
+)
 
 
 def read_config_file(config_fname):
@@ -7,7 +24,7 @@ def read_config_file(config_fname):
 
     # First simply load the file into a dictionary
     with open(config_fname, "r") as config_stream:
-        raw_config = yaml.safe_load(config_stream)
+        raw_config = yaml.load(config_stream, Loader=ConfigLoader)
 
     # Then process every item in the config
     config = {
@@ -44,9 +61,17 @@ def process_experiment_config(raw_experiment_config):
     results_list = list(map(str.strip, results_list))
     experiment_config["results"] = results_list
 
-    # Trials
+    # Trials, which can include the points of a sweep that are generated lazily
     raw_trials_config = raw_experiment_config.get("trials", {})
     experiment_config["trials"] = raw_trials_config
+    if "sweep" in raw_experiment_config:
+        raw_sweep_config = raw_experiment_config["sweep"]
+        experiment_config["trials"] = SweepTrials(raw_sweep_config, raw_trials_config)
+
+    # Schedule, which promotes only the best trials to larger budgets
+    if "schedule" in raw_experiment_config:
+        raw_schedule_config = raw_experiment_config["schedule"]
+        experiment_config["schedule"] = parse_schedule(raw_schedule_config)
 
     # Parameters
     raw_parameters_config = raw_experiment_config.get("parameters", {})
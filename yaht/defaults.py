@@ -4,6 +4,28 @@ DEFAULT_CACHE_DIR = ".yaht_cache"
 DEFAULT_CONFIG = """
 SETTINGS:
   cache_dir: .yaht_cache
+  # Compress large cached data favouring "speed" or "size", or "none"
+  compression: none
+  # Keep the cache within a size (e.g. "10GB") by evicting data that can be recomputed
+  # cache_budget: 10GB
+  # Limit the data kept in memory during a run, reloading the rest from the cache
+  # memory_budget: 2GB
+  # Load the sources of this many upcoming processes while others run
+  prefetch_depth: 2
+  # Write up to this many results in the background while processes run (0 to wait)
+  write_queue_size: 4
+  # Run up to this many processes in parallel (overridden by yaht run --jobs)
+  jobs: 1
+  # Reuse the structure compiled from an unchanged config and process code
+  structure_cache: true
+  # Labs with more trials than this (e.g. large sweeps) are run a batch at a time
+  trial_batch_size: 5000
+  # Which files are searched for processes and outputs, and whether installed
+  # packages can provide them through the yaht.processes/yaht.outputs entry points
+  # discovery:
+  #   include: ["**/*.py"]
+  #   exclude: ["**/.*", "**/*venv*", "**/site-packages"]
+  #   entry_points: true
 
 default_experiment:
   results: M, X
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import ast
+import sys
+import json
+import fnmatch
+import logging
+import importlib.util
+import importlib.metadata
+from yaht.defaults import DEFAULT_CACHE_DIR
+
+# Which files are searched for processes and outputs, relative to the working dir
+DEFAULT_INCLUDE = ["**/*.py"]
+DEFAULT_EXCLUDE = [
+    "**/.*",
+    "**/__pycache__",
+    "**/*venv*",
+    "**/site-packages",
+    "**/node_modules",
+    "**/build",
+    "**/dist",
+]
+# Entry point groups installed packages can provide processes and outputs through
+ENTRY_POINT_GROUPS = {
+    "register_process": "yaht.processes",
+    "register_output": "yaht.outputs",
+}
+# Where the manifest of what each file registers is kept, within the cache
+MANIFEST_DIR = "discovery"
+MANIFEST_FILE = "manifest.json"
+# Version of the format of the manifest, so older ones are rebuilt
+MANIFEST_VERSION = 1
+
+
+def discover_modules(registry_name, registered, names=None, settings=None):
+    """
+    Import the modules that register the given names with a registry decorator
+    (e.g. register_process) into the registered dict, or every module that uses
+    the registry if no names are given; modules are found by a cached static scan
+    of the files in scope, or by entry points of installed packages
+    """
+    settings = settings or {}
+    discovery_settings = settings.get("discovery", {}) or {}
+    cache_dir = settings.get("cache_dir", DEFAULT_CACHE_DIR)
+    names = None if names is None else set(names) - set(registered)
+    if names is not None and len(names) == 0:
+        return
+
+    manifest = load_manifest(cache_dir, discovery_settings)
+    if names is None:
+        module_files = [f for f, e in manifest.items() if registry_name in e["uses"]]
+    else:
+        module_files = [f for f, e in manifest.items() if names & set(e[registry_name])]
+    for module_file in module_files:
+        import_module_file(module_file)
+
+    if names is None or not names <= set(registered):
+        if discovery_settings.get("entry_points", True):
+            load_entry_points(ENTRY_POINT_GROUPS[registry_name], registered, names)
+    # Names registered in ways the scan can't see are found by importing
+    # every other module that uses the registry
+    if names is not None and not names <= set(registered):
+        for module_file, entry in manifest.items():
+            if registry_name in entry["uses"] and module_file not in module_files:
+                import_module_file(module_file)
+
+
+def load_manifest(cache_dir, discovery_settings):
+    """
+    Get what every file in scope registers, only rescanning files
+    which have changed since the manifest was cached
+    """
+    include = discovery_settings.get("include", DEFAULT_INCLUDE)
+    exclude = discovery_settings.get("exclude", DEFAULT_EXCLUDE)
+    if cache_dir is not None:
+        # The cache is never searched
+        exclude = exclude + [os.path.relpath(cache_dir).replace(os.sep, "/")]
+    manifest_path = None
+    cached_manifest = {}
+    if cache_dir is not None:
+        manifest_path = os.path.join(cache_dir, MANIFEST_DIR, MANIFEST_FILE)
+        cached_manifest = read_manifest(manifest_path)
+
+    manifest = {}
+    for module_file in find_module_files(include, exclude):
+        module_stat = os.stat(module_file)
+        entry = cached_manifest.get(module_file, {})
+        if (
+            entry.get("mtime") != module_stat.st_mtime_ns
+            or entry.get("size") != module_stat.st_size
+        ):
+            entry = scan_module_file(module_file)
+            entry["mtime"] = module_stat.st_mtime_ns
+            entry["size"] = module_stat.st_size
+        manifest[module_file] = entry
+
+    if manifest_path is not None and manifest != cached_manifest:
+        write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def read_manifest(manifest_path):
+    """Read a cached manifest, which is empty if there isn't a valid one"""
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("files", {})
+
+
+def write_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "files": manifest}, manifest_file)
+    os.replace(temp_path, manifest_path)
+
+
+def find_module_files(include, exclude):
+    """Find the python files under the working dir that are included and not excluded"""
+    module_files = []
+    for dirpath, dirnames, filenames in os.walk("."):
+        rel_dir = os.path.relpath(dirpath).replace(os.sep, "/")
+        # Excluded directories aren't walked into at all
+        dirnames[:] = sorted(
+            d for d in dirnames if not matches_globs(join_rel_path(rel_dir, d), exclude)
+        )
+        for filename in sorted(filenames):
+            rel_path = join_rel_path(rel_dir, filename)
+            if matches_globs(rel_path, include) and not matches_globs(
+                rel_path, exclude
+            ):
+                module_files.append(rel_path)
+    return module_files
+
+
+def join_rel_path(rel_dir, name):
+    return name if rel_dir == "." else rel_dir + "/" + name
+
+
+def matches_globs(rel_path, globs):
+    """Check if a path matches any of some globs, where **/ can also match nothing"""
+    for glob in globs:
+        if fnmatch.fnmatch(rel_path, glob):
+            return True
+        if glob.startswith("**/") and fnmatch.fnmatch(rel_path, glob[3:]):
+            return True
+    return False
+
+
+def scan_module_file(module_file):
+    """
+    Statically find the names of the functions a file registers with each registry,
+    and which registries it uses at all, without importing it
+    """
+    entry = {r: [] for r in ENTRY_POINT_GROUPS}
+    entry["uses"] = []
+    try:
+        with open(module_file, "rb") as source_file:
+            module_tree = ast.parse(source_file.read(), filename=module_file)
+    except (OSError, SyntaxError, ValueError) as e:
+        logging.warning("Couldn't scan %s for processes: %s" % (module_file, e))
+        return entry
+
+    for node in ast.walk(module_tree):
+        match node:
+            case ast.Name(id=name) | ast.Attribute(attr=name) if (
+                name in ENTRY_POINT_GROUPS
+            ):
+                if name not in entry["uses"]:
+                    entry["uses"].append(name)
+            case ast.FunctionDef(name=name, decorator_list=decorators):
+                for decorator in decorators:
+                    registry_name = get_registry_name(decorator)
+                    if registry_name in ENTRY_POINT_GROUPS:
+                        entry[registry_name].append(name)
+            case ast.Call(args=[ast.Name(id=name)]):
+                # Functions can also be registered by calling the decorator
+                registry_name = get_registry_name(node.func)
+                if registry_name in ENTRY_POINT_GROUPS:
+                    entry[registry_name].append(name)
+    return entry
+
+
+def get_registry_name(node):
+    """Get the name of the registry a decorator (possibly given options) refers to"""
+    match node:
+        case ast.Call(func=func):
+            return get_registry_name(func)
+        case ast.Name(id=name) | ast.Attribute(attr=name):
+            return name
+    return None
+
+
+def import_module_file(module_file):
+    """Import a python file under the working dir as a module, at most once"""
+    cwd = os.getcwd()
+    if cwd not in sys.path:
+        sys.path.insert(0, cwd)
+    module_name = os.path.splitext(module_file)[0].replace("/", ".")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, module_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except ModuleNotFoundError as e:
+        del sys.modules[module_name]
+        print(f"Error importing {module_file}: {e}")
+    return module
+
+
+def load_entry_points(group, registered, names=None):
+    """
+    Load the entry points of installed packages in a group, which are either
+    modules that register functions or the functions themselves
+    """
+    for entry_point in importlib.metadata.entry_points(group=group):
+        if names is not None and entry_point.name not in names:
+            continue
+        loaded = entry_point.load()
+        if callable(loaded):
+            registered.setdefault(entry_point.name, loaded)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import time
+import pickle
+import functools
+import multiprocessing
+import concurrent.futures
+import yaht.cache_management as CM
+from yaht.processes import get_process_executor
+from yaht.lazy_data import LazyData, unwrap_lazy_data
+
+# Functions of the processes being run, inherited by forked worker processes
+# so that processes which can't be pickled (e.g. lambdas) can still be run
+_JOB_FUNCTIONS = {}
+
+
+def execute_process(proc_function, source_data, params, n_results):
+    """Run a process, returning a list of its results and how long it took"""
+    start_time = time.perf_counter()
+    result_data = proc_function(*source_data, **params)
+    compute_time = time.perf_counter() - start_time
+    # If there is only one result, the result is placed in a list of one
+    if n_results == 1:
+        result_data = [result_data]
+    # Lazy inputs passed straight through are loaded so they can be stored
+    result_data = [unwrap_lazy_data(d) for d in result_data]
+    return result_data, compute_time
+
+
+def can_fork_workers():
+    """Check if worker processes can be forked, inheriting the process functions"""
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def get_job_executor(proc_function):
+    """
+    Get where a process is run when running in parallel; without fork,
+    processes that can't be pickled to send to a worker are run in threads instead
+    """
+    executor = get_process_executor(proc_function)
+    if executor == "process" and not can_fork_workers():
+        try:
+            pickle.dumps(proc_function)
+        except Exception:
+            return "thread"
+    return executor
+
+
+def create_process_pool(jobs, proc_functions):
+    """
+    Create a pool of worker processes to run jobs in, which are forked where
+    possible so they share the given process functions; forked workers are all
+    started straight away, so they should be created before any background
+    threads (e.g. writing to the cache) whose locks they could copy
+    """
+    _JOB_FUNCTIONS.clear()
+    _JOB_FUNCTIONS.update(proc_functions)
+    if not can_fork_workers():
+        return concurrent.futures.ProcessPoolExecutor(jobs)
+    mp_context = multiprocessing.get_context("fork")
+    process_pool = concurrent.futures.ProcessPoolExecutor(jobs, mp_context=mp_context)
+    process_pool.submit(int).result()
+    return process_pool
+
+
+def run_process_job(job):
+    """
+    Run a process in a worker, loading its sources from the cache
+    and storing its results there, returning the metadata of the results
+    and how long the process took
+    """
+    proc_function = job["function"] or _JOB_FUNCTIONS[job["key"]]
+    cache_dir = job["cache_dir"]
+    source_data = []
+    for metadata, mmap, lazy in job["sources"]:
+        load = functools.partial(CM.read_cache_file, cache_dir, metadata, mmap)
+        source_data.append(LazyData(load) if lazy else load())
+
+    result_data, compute_time = execute_process(
+        proc_function, source_data, job["params"], len(job["results"])
+    )
+    result_metadata = [
+        CM.write_cache_file(
+            cache_dir,
+            metadata["hash"],
+            data,
+            metadata,
+            job["compression"],
+            job["compression_threshold"],
+        )
+        for metadata, data in zip(job["results"], result_data)
+    ]
+    return result_metadata, compute_time
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import math
+import numbers
+import numpy as np
+from hashlib import sha256
+
+
+def encode_canonical(value):
+    """
+    Encode a value (e.g. the parameters of a process) as a string that is the
+    same for logically identical values, so they hash the same; dict keys are
+    sorted, numbers that are equal are encoded the same whatever their type,
+    sequences are encoded alike and arrays are encoded by a digest of their content.
+    Containers of simple values are encoded as str() would encode them,
+    so the hashes of most processes don't change
+    """
+    match value:
+        case None | bool() | np.bool_():
+            return str(value if value is None else bool(value))
+        case numbers.Integral():
+            return str(int(value))
+        case numbers.Real():
+            return encode_float(float(value))
+        case str():
+            return repr(value)
+        case bytes():
+            return repr(bytes(value))
+        case np.ndarray():
+            return encode_array(value)
+        case np.generic():
+            return encode_canonical(value.item())
+        case dict():
+            encoded_items = sorted(
+                (encode_canonical(k), encode_canonical(v)) for k, v in value.items()
+            )
+            return "{%s}" % ", ".join("%s: %s" % item for item in encoded_items)
+        case list() | tuple():
+            return "[%s]" % ", ".join(encode_canonical(v) for v in value)
+        case set() | frozenset():
+            return "{%s}" % ", ".join(sorted(encode_canonical(v) for v in value))
+        case _:
+            return str(value)
+
+
+def encode_float(value):
+    """Encode a float, as an integer if it is a whole number"""
+    if math.isfinite(value) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def encode_array(array):
+    """Encode an array by its type, shape and a digest of its content"""
+    if array.dtype.hasobject:
+        content = encode_canonical(array.tolist()).encode()
+    else:
+        content = np.ascontiguousarray(array).tobytes()
+    return "array(%s, %s, %s)" % (
+        array.dtype.str,
+        array.shape,
+        sha256(content).hexdigest(),
+    )
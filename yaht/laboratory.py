@@ -1,7 +1,40 @@
 #!/usr/bin/env python3
+import datetime
+import logging
+import functools
+import contextlib
+import collections
+import concurrent.futures
 import pandas as pd
 import yaht.cache_management as CM
-from yaht.structure import generate_laboratory_structure
+from yaht.processes import get_input_flags
+from yaht.executors import (
+    execute_process,
+    can_fork_workers,
+    get_job_executor,
+    create_process_pool,
+    run_process_job,
+)
+from yaht.lazy_data import LazyData
+from yaht.memory_cache import MemoryCache
+from yaht.prefetching import Prefetcher
+from yaht.compression import check_compression
+from yaht.structure import (
+    generate_laboratory_records,
+    load_laboratory_records,
+    load_laboratory_batches,
+    structure_from_records,
+    count_laboratory_trials,
+    iter_laboratory_batches,
+    gen_legacy_result_hashes,
+)
+from yaht.scheduling import (
+    RungTrials,
+    get_schedule_brackets,
+    count_promoted,
+    select_top_trials,
+    get_rung_name,
+)
 from yaht.defaults import DEFAULT_CACHE_DIR
 
 
@@ -11,10 +44,33 @@ class Laboratory:
         settings = config.get("settings", {})
         self.lab_name = settings.get("lab_name", "lab")
         self.cache_dir = settings.get("cache_dir", DEFAULT_CACHE_DIR)
+        # How often metadata is written during a run, by default only at the end
+        self.metadata_flush_interval = settings.get("metadata_flush_interval", None)
+        # Whether to compress cached data favouring "speed" or "size" (or "none")
+        self.compression = settings.get("compression", None)
+        check_compression(self.compression)
+        self.compression_threshold = settings.get("compression_threshold", None)
+        # The size the cache is kept within by evicting data that can be recomputed
+        self.cache_budget = CM.parse_byte_size(settings.get("cache_budget", None))
+        # The amount of data kept in memory, beyond which it is reloaded from the cache
+        self.memory_budget = CM.parse_byte_size(settings.get("memory_budget", None))
+        # How many processes ahead to load sources for, and how much to load at once
+        self.prefetch_depth = settings.get("prefetch_depth", 2)
+        self.prefetch_budget = CM.parse_byte_size(
+            settings.get("prefetch_budget", "256MB")
+        )
+        # How many results can be queued to be written in the background
+        self.write_queue_size = settings.get("write_queue_size", 4)
+        # How many processes can be run in parallel
+        self.jobs = settings.get("jobs", 1)
+        # Whether the compiled structure is cached, to be reused for the same config
+        self.structure_cache = settings.get("structure_cache", True)
+        # Labs with more trials than this (e.g. large sweeps) are generated
+        # and run a batch of this many trials at a time
+        self.trial_batch_size = settings.get("trial_batch_size", 5000)
         # Override cache dir with custom option if necessary
         # if cache_dir:
         #     self.cache_dir = cache_dir
-        self.existing_metadata = CM.load_cache_metadata(self.cache_dir)
         # Record the output function names specified in the config
         self.outputs = config.get("outputs", {})
 
@@ -25,112 +81,844 @@ class Laboratory:
         # Generate the lab structure
         structure_config = {}
         structure_config["source_hashes"] = source_hashes
-        structure_config["experiments"] = config["experiments"]
-        self.structure = generate_laboratory_structure(structure_config)
+        # Scheduled experiments are run a rung at a time, promoting the best trials
+        self.scheduled_experiments = {
+            exp_name: exp_config
+            for exp_name, exp_config in config["experiments"].items()
+            if exp_config.get("schedule") is not None
+        }
+        self.schedule_history = {}
+        # The metric of the schedule the current structure is a rung of, if any
+        self.schedule_metric = None
+        # Whether the cache may hold results under hashes from before they were
+        # hashed the way they are now, which are moved the first time the lab runs
+        self.legacy_cache = False
+        structure_config["experiments"] = {
+            exp_name: exp_config
+            for exp_name, exp_config in config["experiments"].items()
+            if exp_name not in self.scheduled_experiments
+        }
+        self.structure_config = structure_config
+        self.batched = count_laboratory_trials(structure_config) > self.trial_batch_size
+        if self.batched:
+            # Batches are generated as they're needed
+            self.structure = None
+        else:
+            if self.structure_cache:
+                structure_records = load_laboratory_records(
+                    structure_config, self.cache_dir
+                )
+            else:
+                structure_records = generate_laboratory_records(structure_config)
+            self.structure = structure_from_records(structure_records)
 
         # Setup internal data storage
-        self.internal_data = {}
+        self.internal_data = MemoryCache(self.memory_budget)
+        self.peak_live_set = {"count": 0, "size": 0}
+        self.cache_session = None
+        self.prefetcher = None
+        self.prefetch_stats = {}
 
     def get_source_hash(self, source_hash):
         """Turn a reference to a source into its hash"""
-        (hash_type, hash_label, *_) = source_hash.split(":")
+        hash_type, hash_label, *_ = source_hash.split(":")
         match hash_type:
             case "hash":
                 return hash_label
             case "file":
-                return self.existing_metadata.set_index("filename").loc[
-                    hash_label, "hash"
-                ]
+                return CM.find_filename_hash(self.cache_dir, hash_label)
             case _:
                 raise ValueError("Unknown hash type %s" % hash_type)
 
-    def run_experiments(self):
-        """Run every process that needs running"""
+    def run_experiments(self, jobs=None):
+        """Run every process that needs running, using a number of jobs if given"""
+        jobs = jobs or self.jobs
         # Identify parameters relevant to the current moment
         CM.sync_cache_metadata(self.cache_dir)
+        self.legacy_cache = CM.load_hash_version(self.cache_dir) < CM.CACHE_HASH_VERSION
+        if self.legacy_cache:
+            self.remap_legacy_hashes()
+        kept_hashes = set()
+        for _ in self.iter_structures():
+            self.run_structure(jobs)
+            kept_hashes |= self.find_needed_results()
+
+        # Evicted data is recomputed the next time it's needed, but results
+        # are kept so they can be loaded without rerunning anything
+        if self.cache_budget is not None:
+            CM.evict_cache_data(self.cache_dir, self.cache_budget, kept_hashes)
+
+    def iter_structures(self):
+        """
+        Go through the structure of the lab, setting it as the current structure;
+        batched labs go through it a batch of trials at a time, generating each
+        batch as it's needed so the whole structure is never held at once;
+        scheduled experiments follow, a rung at a time
+        """
+        self.schedule_metric = None
+        if len(self.structure_config["experiments"]) == 0:
+            pass
+        elif not self.batched:
+            yield self.structure
+        else:
+            if self.structure_cache:
+                batches = load_laboratory_batches(
+                    self.structure_config, self.trial_batch_size, self.cache_dir
+                )
+            else:
+                batches = iter_laboratory_batches(
+                    self.structure_config, self.trial_batch_size
+                )
+            for batch_records in batches:
+                self.structure = structure_from_records(batch_records)
+                yield self.structure
+        for exp_name in self.scheduled_experiments:
+            yield from self.iter_schedule_structures(exp_name)
+
+    def iter_schedule_structures(self, exp_name):
+        """
+        Go through the rungs of a scheduled experiment, setting each as the current
+        structure; once a rung's metric results are all cached (e.g. after the rung
+        is run), the best trials are promoted to the next rung, so rerunning resumes
+        from the first rung that hasn't finished
+        """
+        exp_config = self.scheduled_experiments[exp_name]
+        schedule = exp_config["schedule"]
+        self.schedule_metric = schedule["metric"]
+        trials = exp_config.get("trials", {})
+        # The control is run at every rung as a baseline, rather than competing
+        trial_names = [t for t in trials if t != "control"]
+        brackets = get_schedule_brackets(schedule, trial_names)
+        rung_history = []
+        self.schedule_history[exp_name] = rung_history
+        for bracket, (budgets, rung_trial_names) in enumerate(brackets):
+            for budget in budgets:
+                rung_name = get_rung_name(
+                    exp_name,
+                    budget,
+                    bracket if schedule["method"] == "hyperband" else None,
+                )
+                rung_config = exp_config | {
+                    "trials": RungTrials(
+                        trials, rung_trial_names, schedule["budget"], budget
+                    ),
+                    "parameters": exp_config.get("parameters", {})
+                    | {schedule["budget"]: budget},
+                }
+                rung_structure_config = {
+                    "source_hashes": self.structure_config["source_hashes"],
+                    "experiments": {rung_name: rung_config},
+                }
+                metric_hashes = {}
+                for batch_records in iter_laboratory_batches(
+                    rung_structure_config, self.trial_batch_size
+                ):
+                    self.structure = structure_from_records(batch_records)
+                    metric_hashes |= get_metric_hashes(
+                        self.structure, schedule["metric"]
+                    )
+                    yield self.structure
+
+                rung = {"experiment": rung_name, "budget": budget}
+                rung["trials"] = rung_trial_names
+                rung_history.append(rung)
+                missing_trials = set(rung_trial_names) - set(metric_hashes)
+                if len(missing_trials) > 0:
+                    raise ValueError(
+                        "%s isn't a result of %s in %s"
+                        % (schedule["metric"], exp_name, sorted(missing_trials)[0])
+                    )
+                rung_hashes = [metric_hashes[t] for t in rung_trial_names]
+                if CM.find_cached_hashes(self.cache_dir, rung_hashes) != set(
+                    rung_hashes
+                ):
+                    # Later rungs can't be known until this one has run
+                    break
+                rung["scores"] = {
+                    t: self.get_data(metric_hashes[t]) for t in rung_trial_names
+                }
+                rung_trial_names = select_top_trials(
+                    rung["scores"],
+                    count_promoted(len(rung_trial_names), schedule),
+                    schedule["mode"],
+                )
+                if budget != budgets[-1]:
+                    rung["promoted"] = rung_trial_names
+        self.schedule_metric = None
+
+    def run_structure(self, jobs):
+        """Run every process in the current structure that needs running"""
         self.determine_unrun_processes()
-        # Store metadata generated in the running of the experiments
-        generated_metadata = pd.DataFrame(columns=["hash", "sources"])
+        # Metadata generated in the running of the experiments is only
+        # written to the cache when the session ends (or is flushed),
+        # while results are written in the background as processes run
+        self.cache_session = CM.CacheSession(
+            self.cache_dir,
+            flush_interval=self.metadata_flush_interval,
+            update_filenames=True,
+            compression=self.compression,
+            compression_threshold=self.compression_threshold,
+            write_queue_size=self.write_queue_size,
+        )
 
         # Sort by experiment, trial and order, and then run
         sorted_structure = self.structure.sort_values(
             by=["experiment", "trial", "order"]
         )
-        for idx, proc_row in sorted_structure.iterrows():
-            # experiment_metadata = pd.DataFrame(columns=["hash", "sources"])
-            if proc_row["has_run"]:
-                continue
-            # Extract all relevant parameters and run the process
-            source_data = [self.get_data(h) for h in proc_row["source_hashes"]]
-            proc_params = proc_row["params"]
+        planned_structure = self.collapse_duplicate_processes(
+            sorted_structure[~sorted_structure["has_run"]]
+        )
+        if jobs > 1:
+            with contextlib.ExitStack() as pools:
+                # Worker processes are started before the cache session starts
+                # writing in the background, so they're never forked mid-write
+                process_pool = None
+                executors = planned_structure["function"].apply(get_job_executor)
+                if (executors == "process").any():
+                    proc_functions = planned_structure["function"].to_dict()
+                    process_pool = pools.enter_context(
+                        create_process_pool(jobs, proc_functions)
+                    )
+                with self.cache_session:
+                    self.run_processes_in_parallel(
+                        planned_structure, jobs, process_pool
+                    )
+        else:
+            self.run_processes_in_order(planned_structure)
+        self.cache_session = None
+
+    def plan_experiments(self, jobs=None):
+        """
+        Work out what running the experiments would do without running anything,
+        returning a dataframe of every process with its status (cached, run, or
+        shared with another process) and its estimated cost, plus a summary
+        """
+        jobs = jobs or self.jobs
+        CM.sync_cache_metadata(self.cache_dir)
+        # Results under legacy hashes are counted as cached, but left where they are
+        self.legacy_cache = CM.load_hash_version(self.cache_dir) < CM.CACHE_HASH_VERSION
+        # Estimate costs from how processes with the same name did before
+        process_history = summarise_process_history(
+            CM.load_cache_metadata_rows(self.cache_dir)
+        )
+        # Processes planned in earlier batches are shared with later ones
+        planned_hashes = set()
+        plans = []
+        summaries = []
+        for _ in self.iter_structures():
+            plan, summary = self.plan_structure(jobs, process_history, planned_hashes)
+            plans.append(plan)
+            summaries.append(summary)
+
+        plan = pd.concat(plans, ignore_index=self.batched)
+        summary = {k: sum(s[k] for s in summaries) for k in summaries[0] if k != "jobs"}
+        summary["jobs"] = jobs
+        return plan, summary
+
+    def plan_structure(self, jobs, process_history, planned_hashes):
+        """Plan running the current structure, adding the hashes it plans to make"""
+        self.determine_unrun_processes()
+        sorted_structure = self.structure.sort_values(
+            by=["experiment", "trial", "order"]
+        )
+        unrun_structure = sorted_structure[~sorted_structure["has_run"]]
+        planned_earlier = unrun_structure["result_hashes"].apply(
+            lambda r_hashes: planned_hashes.issuperset(r_hashes)
+        )
+        planned_structure = self.collapse_duplicate_processes(
+            unrun_structure[~planned_earlier.astype(bool)]
+        )
+        planned_hashes.update(
+            h for r_hashes in planned_structure["result_hashes"] for h in r_hashes
+        )
+
+        plan = sorted_structure[["experiment", "trial", "name"]].copy()
+        plan["status"] = "cached"
+        plan.loc[~sorted_structure["has_run"], "status"] = "shared"
+        plan.loc[planned_structure.index, "status"] = "run"
+        plan["stage"] = pd.Series(get_process_stages(planned_structure), dtype="Int64")
+        estimates = [
+            process_history.get(n, {"time": None, "size": None})
+            for n in planned_structure["name"]
+        ]
+        plan["estimated_time"] = pd.Series(
+            [e["time"] for e in estimates], index=planned_structure.index, dtype=float
+        )
+        plan["estimated_size"] = pd.Series(
+            [
+                None if e["size"] is None else e["size"] * len(r_hashes)
+                for e, r_hashes in zip(estimates, planned_structure["result_hashes"])
+            ],
+            index=planned_structure.index,
+            dtype=float,
+        )
+
+        # With enough jobs, the run takes as long as its slowest chain of processes
+        total_time = plan["estimated_time"].sum()
+        critical_time = get_critical_path_time(
+            planned_structure, plan["estimated_time"]
+        )
+        summary = {
+            "processes": len(plan),
+            "cached": int((plan["status"] == "cached").sum()),
+            "shared": int((plan["status"] == "shared").sum()),
+            "run": int((plan["status"] == "run").sum()),
+            "unestimated": int(
+                ((plan["status"] == "run") & plan["estimated_time"].isnull()).sum()
+            ),
+            "jobs": jobs,
+            "total_time": total_time,
+            "wall_time": (
+                max(total_time / jobs, critical_time) if jobs > 1 else total_time
+            ),
+            "total_size": plan["estimated_size"].sum(),
+        }
+        return plan, summary
+
+    def collapse_duplicate_processes(self, planned_structure):
+        """
+        Collapse processes with the same results (e.g. shared preprocessing)
+        across trials and experiments into the first of them, so they only run once;
+        the sources of all of them are kept to be recorded in the metadata
+        """
+        result_keys = planned_structure["result_hashes"].apply(tuple)
+        proc_sources = {}
+        for result_key, (idx, proc_row) in zip(
+            result_keys, planned_structure.iterrows()
+        ):
+            proc_source = self.get_proc_source(proc_row)
+            proc_sources.setdefault(result_key, []).append(proc_source)
+        unique_structure = planned_structure[~result_keys.duplicated()].copy()
+        unique_structure["proc_sources"] = [
+            proc_sources[tuple(r_hashes)]
+            for r_hashes in unique_structure["result_hashes"]
+        ]
+        return unique_structure
+
+    def run_processes_in_order(self, planned_structure):
+        """Run processes one after another, keeping their data in memory"""
+        # Data is dropped from memory once nothing left to run needs it
+        consumer_counts = count_consumers(planned_structure)
+        self.peak_live_set = {"count": 0, "size": 0}
+        # The sources of upcoming processes are loaded while earlier ones run
+        planned_rows = [proc_row for idx, proc_row in planned_structure.iterrows()]
+        produced_hashes = {
+            h for r_hashes in planned_structure["result_hashes"] for h in r_hashes
+        }
+        self.prefetcher = Prefetcher(self.cache_dir, self.prefetch_budget)
+        with self.cache_session, self.prefetcher:
+            for i, proc_row in enumerate(planned_rows):
+                upcoming_rows = planned_rows[i + 1 : i + 1 + self.prefetch_depth]
+                self.prefetch_sources(upcoming_rows, produced_hashes)
+                self.run_process(proc_row)
+                self.release_dead_data(proc_row, consumer_counts)
+        self.prefetch_stats = self.prefetcher.stats()
+        self.prefetcher = None
+        logging.info(
+            "Peak live set of %(count)d items taking up %(size)d bytes"
+            % self.peak_live_set
+        )
+        logging.info(
+            "Prefetching hid %(hidden_time).3fs of loading from the cache"
+            % self.prefetch_stats
+        )
+        logging.info("Data kept in memory: %s" % self.internal_data.stats())
+
+    def prefetch_sources(self, proc_rows, produced_hashes):
+        """
+        Start loading the sources of processes that are already in the cache,
+        apart from those that are memory mapped or loaded lazily
+        """
+        for proc_row in proc_rows:
             proc_function = proc_row["function"]
-            result_hashes = proc_row["result_hashes"]
-            result_data = proc_function(*source_data, **proc_params)
-            # If there is only one result, the result is placed in a list of one
-            if len(result_hashes) == 1:
-                result_data = [result_data]
-            for h, d in zip(result_hashes, result_data):
-                self.set_data(h, d)
-
-            # Store any relevant metadata
-            proc_source = "%s/%s.%s.%s" % (
-                self.lab_name,
-                proc_row["experiment"],
-                proc_row["trial"],
-                proc_row["name"],
-            )
-            novel_metadata = pd.DataFrame(
-                {"hash": result_hashes, "sources": [[proc_source]] * len(result_hashes)}
-            )
-            generated_metadata = CM.combine_metadata(generated_metadata, novel_metadata)
-        # Store the generated metadata in the cache
-        CM.store_cache_metadata(self.cache_dir, generated_metadata)
-        CM.update_cache_filenames(self.cache_dir)
+            source_hashes = proc_row["source_hashes"]
+            n_sources = len(source_hashes)
+            mmap_flags = get_input_flags(proc_function, "mmap_inputs", n_sources)
+            lazy_flags = get_input_flags(proc_function, "lazy_inputs", n_sources)
+            for h, m, l in zip(source_hashes, mmap_flags, lazy_flags):
+                if m or l or h in produced_hashes or h in self.internal_data:
+                    continue
+                self.prefetcher.prefetch(self.cache_session.get_metadata(h, wait=False))
 
-    def get_data(self, data_hash):
-        """First try to get the data from internal storage, then the cache"""
-        if data_hash in self.internal_data:
+    def run_processes_in_parallel(self, planned_structure, jobs, process_pool=None):
+        """
+        Run processes in a pool of threads or the pool of worker processes
+        (or inline), as each process was registered to be, starting each as soon as
+        the data it needs is available; at most jobs processes run at once
+        across all of them
+        """
+        # Find which processes are waiting for the results of others
+        producers = {
+            h: idx
+            for idx, r_hashes in planned_structure["result_hashes"].items()
+            for h in r_hashes
+        }
+        waiting_for = {}
+        consumers = collections.defaultdict(set)
+        for idx, s_hashes in planned_structure["source_hashes"].items():
+            waiting_for[idx] = {h for h in s_hashes if h in producers}
+            for h in waiting_for[idx]:
+                consumers[h].add(idx)
+        # Data run in this process is dropped once nothing left to run needs it
+        consumer_counts = count_consumers(planned_structure)
+        self.peak_live_set = {"count": 0, "size": 0}
+        ready = collections.deque(i for i, w in waiting_for.items() if len(w) == 0)
+
+        def finish_process(idx, compute_time):
+            proc_row = planned_structure.loc[idx]
+            self.record_process_metadata(proc_row, compute_time)
+            self.release_dead_data(proc_row, consumer_counts)
+            # Start anything that was only waiting for these results
+            for h in proc_row["result_hashes"]:
+                for c_idx in consumers[h]:
+                    waiting_for[c_idx].discard(h)
+                    if len(waiting_for[c_idx]) == 0 and c_idx not in ready:
+                        ready.append(c_idx)
+
+        with concurrent.futures.ThreadPoolExecutor(jobs) as thread_pool:
+            running = {}
+            while len(ready) or len(running):
+                # Threads and worker processes share the limit on how many run
+                while len(ready) and len(running) < jobs:
+                    idx = ready.popleft()
+                    proc_row = planned_structure.loc[idx]
+                    proc_function = proc_row["function"]
+                    n_results = len(proc_row["result_hashes"])
+                    match get_job_executor(proc_function):
+                        case "inline":
+                            source_data = self.load_sources(proc_row)
+                            result_data, compute_time = execute_process(
+                                proc_function,
+                                source_data,
+                                proc_row["params"],
+                                n_results,
+                            )
+                            self.store_results(proc_row, result_data)
+                            finish_process(idx, compute_time)
+                        case "thread":
+                            # Data in memory is shared with threads without copying
+                            source_data = self.load_sources(proc_row, threaded=True)
+                            future = thread_pool.submit(
+                                execute_process,
+                                proc_function,
+                                source_data,
+                                proc_row["params"],
+                                n_results,
+                            )
+                            running[future] = ("thread", idx)
+                            self.record_live_set()
+                        case "process":
+                            job = self.create_process_job(idx, proc_row)
+                            future = process_pool.submit(run_process_job, job)
+                            running[future] = ("process", idx)
+                if len(running) == 0:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    executor, idx = running.pop(future)
+                    if executor == "thread":
+                        result_data, compute_time = future.result()
+                        self.store_results(planned_structure.loc[idx], result_data)
+                    else:
+                        result_metadata, compute_time = future.result()
+                        self.cache_session.store_metadata_rows(result_metadata)
+                    finish_process(idx, compute_time)
+        logging.info(
+            "Peak live set of %(count)d items taking up %(size)d bytes"
+            % self.peak_live_set
+        )
+
+    def create_process_job(self, job_key, proc_row):
+        """Describe how to run a process in a worker, which works from the cache"""
+        proc_function = proc_row["function"]
+        source_hashes = proc_row["source_hashes"]
+        mmap_flags = get_input_flags(proc_function, "mmap_inputs", len(source_hashes))
+        lazy_flags = get_input_flags(proc_function, "lazy_inputs", len(source_hashes))
+        for h in source_hashes:
+            self.record_access(h)
+        return {
+            "key": job_key,
+            # Forked workers already have the function, otherwise it's pickled
+            "function": None if can_fork_workers() else proc_function,
+            "cache_dir": self.cache_dir,
+            "sources": [
+                (self.cache_session.get_metadata(h), m, l)
+                for h, m, l in zip(source_hashes, mmap_flags, lazy_flags)
+            ],
+            "params": proc_row["params"],
+            "results": [
+                self.cache_session.get_metadata(h) for h in proc_row["result_hashes"]
+            ],
+            "compression": self.compression,
+            "compression_threshold": self.compression_threshold,
+        }
+
+    def release_dead_data(self, proc_row, consumer_counts):
+        """Drop the data of a finished process that nothing left to run needs"""
+        self.record_live_set()
+        for h in proc_row["source_hashes"]:
+            consumer_counts[h] -= 1
+        for h in set(proc_row["source_hashes"] + proc_row["result_hashes"]):
+            if consumer_counts[h] <= 0:
+                self.internal_data.pop(h)
+
+    def record_live_set(self):
+        """Keep track of the most data that has been kept in memory at once"""
+        self.peak_live_set["count"] = max(
+            self.peak_live_set["count"], len(self.internal_data)
+        )
+        self.peak_live_set["size"] = max(
+            self.peak_live_set["size"], self.internal_data.size
+        )
+
+    def run_process(self, proc_row):
+        """Run a single process from the structure, storing its results"""
+        # Extract all relevant parameters and run the process
+        proc_function = proc_row["function"]
+        source_data = self.load_sources(proc_row)
+        result_data, compute_time = execute_process(
+            proc_function,
+            source_data,
+            proc_row["params"],
+            len(proc_row["result_hashes"]),
+        )
+        self.store_results(proc_row, result_data)
+        self.record_process_metadata(proc_row, compute_time)
+
+    def load_sources(self, proc_row, threaded=False):
+        """
+        Load the sources of a process, as lazy handles if it asked for them;
+        handles for other threads read from the cache directly, without touching
+        the data in memory (which isn't thread safe)
+        """
+        proc_function = proc_row["function"]
+        source_hashes = proc_row["source_hashes"]
+        mmap_flags = get_input_flags(proc_function, "mmap_inputs", len(source_hashes))
+        lazy_flags = get_input_flags(proc_function, "lazy_inputs", len(source_hashes))
+        source_data = []
+        for h, m, l in zip(source_hashes, mmap_flags, lazy_flags):
+            if not l:
+                source_data.append(self.get_data(h, mmap=m))
+            elif threaded and h not in self.internal_data:
+                self.record_access(h)
+                metadata = self.cache_session.get_metadata(h)
+                load = functools.partial(
+                    CM.read_cache_file, self.cache_dir, metadata, m
+                )
+                source_data.append(LazyData(load))
+            else:
+                source_data.append(self.get_lazy_data(h, mmap=m))
+        return source_data
+
+    def store_results(self, proc_row, result_data):
+        """Store the results of a process"""
+        for h, d in zip(proc_row["result_hashes"], result_data):
+            self.set_data(h, d)
+
+    def record_process_metadata(self, proc_row, compute_time):
+        """Record where the results of a process came from"""
+        proc_sources = proc_row.get("proc_sources", None)
+        if type(proc_sources) is not list:
+            proc_sources = [self.get_proc_source(proc_row)]
+        self.cache_session.store_metadata_rows(
+            [
+                {"hash": h, "sources": proc_sources, "compute_time": compute_time}
+                for h in proc_row["result_hashes"]
+            ]
+        )
+
+    def get_proc_source(self, proc_row):
+        """Get the name of a process in the lab, to record as a source of its results"""
+        return "%s/%s.%s.%s" % (
+            self.lab_name,
+            proc_row["experiment"],
+            proc_row["trial"],
+            proc_row["name"],
+        )
+
+    def get_data(self, data_hash, mmap=False):
+        """
+        First try to get the data from internal storage, then the cache;
+        memory mapped data is read from the cache without being stored internally
+        """
+        try:
             return self.internal_data[data_hash]
+        except KeyError:
+            pass
+        if mmap and self.cache_session is not None:
+            self.record_access(data_hash)
+            return self.cache_session.load_data(data_hash, mmap=True)
+        elif mmap:
+            return CM.load_cache_data(self.cache_dir, data_hash, mmap=True)
+        elif self.prefetcher is not None and data_hash in self.prefetcher:
+            self.record_access(data_hash)
+            data = self.prefetcher.take(data_hash)
+        elif self.cache_session is not None:
+            self.record_access(data_hash)
+            data = self.cache_session.load_data(data_hash)
         else:
             data = CM.load_cache_data(self.cache_dir, data_hash)
-            self.internal_data[data_hash] = data
-            return data
+        self.internal_data[data_hash] = data
+        return data
+
+    def get_lazy_data(self, data_hash, mmap=False):
+        """Get a handle to some data that only loads it when it is first used"""
+        if data_hash in self.internal_data:
+            return self.internal_data[data_hash]
+        return LazyData(functools.partial(self.get_data, data_hash, mmap=mmap))
+
+    def record_access(self, data_hash):
+        """Record that data was loaded from the cache, so it's less likely evicted"""
+        metadata = self.cache_session.get_metadata(data_hash, wait=False)
+        access_count = metadata.get("access_count")
+        access_count = 0 if pd.isnull(access_count) else access_count
+        self.cache_session.store_metadata_rows(
+            [
+                {
+                    "hash": data_hash,
+                    "access_count": access_count + 1,
+                    "time_accessed": datetime.datetime.now(),
+                }
+            ]
+        )
 
     def set_data(self, data_hash, data):
         """Set the data both internally and in the cache"""
         self.internal_data[data_hash] = data
-        CM.store_cache_data(self.cache_dir, data_hash, data)
+        if self.cache_session is not None:
+            self.cache_session.store_data(data_hash, data)
+        else:
+            CM.store_cache_data(
+                self.cache_dir,
+                data_hash,
+                data,
+                self.compression,
+                self.compression_threshold,
+            )
 
     def determine_unrun_processes(self):
-        """Check which of the processes in the structure need to be run"""
-        metadata = CM.load_cache_metadata(self.cache_dir)
+        """
+        Check which of the processes in the structure need to be run;
+        processes with missing results (e.g. because they were evicted) only need
+        to be rerun if something that needs running depends on them
+        """
+        all_hashes = [
+            h for r_hashes in self.structure["result_hashes"] for h in r_hashes
+        ]
+        cached_hashes = CM.find_cached_hashes(self.cache_dir, all_hashes)
+        if self.legacy_cache:
+            # Results still under their legacy hashes would be moved, not run
+            cached_hashes |= set(self.find_legacy_hashes(cached_hashes).values())
+        consumed_hashes = {
+            h for s_hashes in self.structure["source_hashes"] for h in s_hashes
+        }
+
+        # Results are always needed, even if other processes also consume them
+        needed_hashes = self.find_needed_results()
+
+        # Work backwards from the final processes to find what is needed,
+        # repeating until nothing new is found in case orders differ between trials
+        has_run = pd.Series(True, index=self.structure.index)
+        backwards_structure = self.structure.sort_values(by="order", ascending=False)
+        is_needed = lambda h: h in needed_hashes or h not in consumed_hashes
+        found_needed = True
+        while found_needed:
+            found_needed = False
+            for idx, proc_row in backwards_structure.iterrows():
+                if not has_run[idx]:
+                    continue
+                missing_hashes = [
+                    h for h in proc_row["result_hashes"] if h not in cached_hashes
+                ]
+                if not any(is_needed(h) for h in missing_hashes):
+                    continue
+                has_run[idx] = False
+                needed_hashes.update(proc_row["source_hashes"])
+                found_needed = True
+        self.structure["has_run"] = has_run
+
+    def find_needed_results(self):
+        """
+        Find the hashes of the results of the current structure,
+        and of the metric a schedule ranks trials by
+        """
+        needed_hashes = {
+            h
+            for flags, r_hashes in zip(
+                self.structure["results"], self.structure["result_hashes"]
+            )
+            for is_result, h in zip(flags, r_hashes)
+            if is_result
+        }
+        if self.schedule_metric is not None:
+            metric_hashes = get_metric_hashes(self.structure, self.schedule_metric)
+            needed_hashes.update(metric_hashes.values())
+        return needed_hashes
+
+    def remap_legacy_hashes(self):
+        """
+        Move results cached under the hashes processes had before their parameters
+        were encoded canonically and their code fingerprinted to their current
+        hashes, so caches from before stay valid; this is done once for a cache,
+        by the first lab to run with it
+        """
+        for _ in self.iter_structures():
+            all_hashes = [
+                h for r_hashes in self.structure["result_hashes"] for h in r_hashes
+            ]
+            cached_hashes = CM.find_cached_hashes(self.cache_dir, all_hashes)
+            hash_map = self.find_legacy_hashes(cached_hashes)
+            if len(hash_map) > 0:
+                CM.remap_cache_hashes(self.cache_dir, hash_map)
+        CM.store_hash_version(self.cache_dir, CM.CACHE_HASH_VERSION)
+        self.legacy_cache = False
 
-        verify_hash = lambda r_hashes: min(
-            [r_h in list(metadata["hash"]) for r_h in r_hashes]
-        )  # We chack the result hashes of every process against existing data
-        self.structure["has_run"] = self.structure["result_hashes"].apply(verify_hash)
+    def find_legacy_hashes(self, cached_hashes):
+        """
+        Find the results of the current structure that aren't cached,
+        but are cached under their legacy hashes, as {legacy hash: current hash}
+        """
+        all_hashes = {
+            h for r_hashes in self.structure["result_hashes"] for h in r_hashes
+        }
+        if all_hashes <= cached_hashes:
+            return {}
+        legacy_hashes = gen_legacy_result_hashes(self.structure)
+        hash_map = {}
+        for r_hashes, l_hashes in zip(self.structure["result_hashes"], legacy_hashes):
+            for r_hash, l_hash in zip(r_hashes, l_hashes):
+                # Hashes that haven't changed are still in use, so can't be moved
+                if r_hash not in cached_hashes and l_hash not in all_hashes:
+                    hash_map.setdefault(l_hash, r_hash)
+        legacy_cached = CM.find_cached_hashes(self.cache_dir, list(hash_map))
+        return {l: r for l, r in hash_map.items() if l in legacy_cached}
 
     def get_results(self):
         """Return the result of every process that is marked as 'result'"""
         CM.sync_cache_metadata(self.cache_dir)
-        result_df = pd.DataFrame(
-            columns=["experiment", "trial", "process", "name", "value"]
+        # Loading results is recorded as accessing them
+        self.cache_session = CM.CacheSession(self.cache_dir)
+        with self.cache_session:
+            result_rows = [
+                r for _ in self.iter_structures() for r in self.collect_results()
+            ]
+        self.cache_session = None
+        return pd.DataFrame(
+            result_rows,
+            columns=[
+                "experiment",
+                "trial",
+                "process",
+                "name",
+                "value",
+                "hash",
+                "output",
+            ],
+            dtype=object,
         )
+
+    def collect_results(self):
+        """Gather the results of the processes in the current structure into rows"""
+        result_rows = []
         for idx, proc_row in self.structure.iterrows():
             # For every row, check if there are any results marked as experimental results
             result_indeces = [i for (i, r) in enumerate(proc_row["results"]) if r]
-            if len(result_indeces) == 0:
-                continue
             # If so, find them and retrieve them
-            result_hashes = [proc_row["result_hashes"][idx] for idx in result_indeces]
-            results = [self.get_data(h) for h in result_hashes]
-            # Then add them to the result_df
-            new_rows = pd.DataFrame({"value": results, "hash": result_hashes})
-            new_rows["experiment"] = proc_row["experiment"]
-            new_rows["trial"] = proc_row["trial"]
-            new_rows["process"] = proc_row["name"]
-            new_rows["name"] = proc_row["result_names"]
-            new_rows["output"] = [self.outputs.get(n, None) for n in new_rows["name"]]
-            # Combine with the existing rows
-            result_df = pd.concat([result_df, new_rows], ignore_index=True)
-        return result_df
+            for result_idx in result_indeces:
+                result_hash = proc_row["result_hashes"][result_idx]
+                result_name = proc_row["result_names"][result_idx]
+                result_rows.append(
+                    {
+                        "experiment": proc_row["experiment"],
+                        "trial": proc_row["trial"],
+                        "process": proc_row["name"],
+                        "name": result_name,
+                        "value": self.get_data(result_hash),
+                        "hash": result_hash,
+                        "output": self.outputs.get(result_name, None),
+                    }
+                )
+        return result_rows
+
+
+def get_metric_hashes(structure, metric):
+    """Find the hash of a result (e.g. a schedule's metric) for each trial"""
+    metric_hashes = {}
+    for trial, result_names, result_hashes in zip(
+        structure["trial"], structure["result_names"], structure["result_hashes"]
+    ):
+        if metric in result_names:
+            metric_hashes[trial] = result_hashes[result_names.index(metric)]
+    return metric_hashes
+
+
+def count_consumers(planned_structure):
+    """Count how many of the planned processes use each hash as a source"""
+    consumer_counts = collections.Counter()
+    for source_hashes in planned_structure["source_hashes"]:
+        consumer_counts.update(source_hashes)
+    return consumer_counts
+
+
+def get_process_stages(planned_structure):
+    """
+    Work out the stage each planned process can run in, where every process
+    only depends on processes in earlier stages, so each stage can run in parallel
+    """
+    producers = {
+        h: idx
+        for idx, r_hashes in planned_structure["result_hashes"].items()
+        for h in r_hashes
+    }
+    stages = {}
+    # Processes always come after the processes they depend on in the plan
+    for idx, s_hashes in planned_structure["source_hashes"].items():
+        source_stages = [stages[producers[h]] for h in s_hashes if h in producers]
+        stages[idx] = max(source_stages, default=-1) + 1
+    return stages
+
+
+def get_critical_path_time(planned_structure, process_times):
+    """Estimate the time taken by the slowest chain of planned processes"""
+    producers = {
+        h: idx
+        for idx, r_hashes in planned_structure["result_hashes"].items()
+        for h in r_hashes
+    }
+    finish_times = {}
+    for idx, s_hashes in planned_structure["source_hashes"].items():
+        start_time = max(
+            [finish_times[producers[h]] for h in s_hashes if h in producers],
+            default=0,
+        )
+        process_time = process_times.get(idx, None)
+        finish_times[idx] = start_time + (
+            0 if pd.isnull(process_time) else process_time
+        )
+    return max(finish_times.values(), default=0)
+
+
+def summarise_process_history(metadata_rows):
+    """
+    Average how long processes took and how big their results were, by the
+    name of the process, from the sources recorded in the cache metadata
+    """
+    history = {}
+    for row in metadata_rows.values():
+        if CM.is_empty_metadata_value(row["compute_time"]):
+            continue
+        # Sources of results are recorded as lab/experiment.trial.process
+        for proc_name in {s.rsplit(".", 1)[-1] for s in row["sources"]}:
+            proc_history = history.setdefault(proc_name, {"times": [], "sizes": []})
+            proc_history["times"].append(row["compute_time"])
+            if not CM.is_empty_metadata_value(row["size"]):
+                proc_history["sizes"].append(row["size"])
+    return {
+        proc_name: {
+            "time": sum(h["times"]) / len(h["times"]),
+            "size": sum(h["sizes"]) / len(h["sizes"]) if len(h["sizes"]) else None,
+        }
+        for proc_name, h in history.items()
+    }
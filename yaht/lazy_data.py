@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import operator
+import numpy as np
+
+# Special methods are looked up on the type rather than the instance,
+# so the ones that should behave like the loaded data are forwarded explicitly
+FORWARDED_METHODS = {
+    "__len__": len,
+    "__iter__": iter,
+    "__reversed__": reversed,
+    "__contains__": lambda data, item: item in data,
+    "__getitem__": operator.getitem,
+    "__setitem__": operator.setitem,
+    "__delitem__": operator.delitem,
+    "__call__": lambda data, *args, **kwargs: data(*args, **kwargs),
+    "__bool__": bool,
+    "__int__": int,
+    "__float__": float,
+    "__index__": operator.index,
+    "__str__": str,
+    "__bytes__": bytes,
+    "__format__": format,
+    "__hash__": hash,
+    "__eq__": operator.eq,
+    "__ne__": operator.ne,
+    "__lt__": operator.lt,
+    "__le__": operator.le,
+    "__gt__": operator.gt,
+    "__ge__": operator.ge,
+    "__neg__": operator.neg,
+    "__pos__": operator.pos,
+    "__abs__": abs,
+    "__invert__": operator.invert,
+}
+FORWARDED_OPERATORS = [
+    "add",
+    "sub",
+    "mul",
+    "matmul",
+    "truediv",
+    "floordiv",
+    "mod",
+    "pow",
+    "and",
+    "or",
+    "xor",
+    "lshift",
+    "rshift",
+]
+
+
+class LazyData:
+    """
+    Handle to data in the cache that is only loaded when it is first used,
+    either explicitly with .load() or by using it like the data itself
+    """
+
+    __slots__ = ["_loader", "_data", "_is_loaded"]
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._data = None
+        self._is_loaded = False
+
+    def load(self):
+        """Load the data (if it hasn't been already) and return it"""
+        if not self._is_loaded:
+            self._data = self._loader()
+            self._is_loaded = True
+            self._loader = None
+        return self._data
+
+    @property
+    def is_loaded(self):
+        return self._is_loaded
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __array__(self, *args, **kwargs):
+        return np.asarray(self.load(), *args, **kwargs)
+
+    def __repr__(self):
+        if not self._is_loaded:
+            return "<LazyData (not loaded)>"
+        return repr(self._data)
+
+
+def unwrap_lazy_data(data):
+    """Return the loaded data if given a lazy handle, otherwise the data itself"""
+    return data.load() if isinstance(data, LazyData) else data
+
+
+def forward_method(method_name, function):
+    def forwarded(self, *args, **kwargs):
+        args = [unwrap_lazy_data(a) for a in args]
+        return function(self.load(), *args, **kwargs)
+
+    forwarded.__name__ = method_name
+    return forwarded
+
+
+def forward_operator(op_name):
+    op = getattr(operator, op_name, None) or getattr(operator, op_name + "_")
+    forwarded = lambda self, other: op(self.load(), unwrap_lazy_data(other))
+    reflected = lambda self, other: op(unwrap_lazy_data(other), self.load())
+    return forwarded, reflected
+
+
+for method_name, function in FORWARDED_METHODS.items():
+    setattr(LazyData, method_name, forward_method(method_name, function))
+for op_name in FORWARDED_OPERATORS:
+    forwarded, reflected = forward_operator(op_name)
+    setattr(LazyData, "__%s__" % op_name, forwarded)
+    setattr(LazyData, "__r%s__" % op_name, reflected)
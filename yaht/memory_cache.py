@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import sys
+import collections
+import numpy as np
+import pandas as pd
+
+
+class MemoryCache:
+    """
+    Keep recently used data in memory within a budget of bytes (if given),
+    evicting the least recently used data first; everything kept here
+    is already stored in the on-disk cache, so evicted data can be reloaded
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.data = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, data_hash):
+        return data_hash in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, data_hash):
+        """Get some data, counting whether it was in memory or not"""
+        if data_hash not in self.data:
+            self.misses += 1
+            raise KeyError(data_hash)
+        self.hits += 1
+        self.data.move_to_end(data_hash)
+        return self.data[data_hash]
+
+    def __setitem__(self, data_hash, data):
+        """Keep some data in memory, evicting older data if over budget"""
+        self.pop(data_hash)
+        data_size = estimate_data_size(data)
+        # Data that could never fit isn't kept at all
+        if self.budget is not None and data_size > self.budget:
+            return
+        self.data[data_hash] = data
+        self.sizes[data_hash] = data_size
+        self.size += data_size
+        while self.budget is not None and self.size > self.budget:
+            self.pop(next(iter(self.data)))
+            self.evictions += 1
+
+    def pop(self, data_hash, default=None):
+        """Remove some data from memory, returning it if it was there"""
+        if data_hash not in self.data:
+            return default
+        self.size -= self.sizes.pop(data_hash)
+        return self.data.pop(data_hash)
+
+    def clear(self):
+        self.data.clear()
+        self.sizes.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return the counters used to tune the budget"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self.size,
+            "budget": self.budget,
+        }
+
+
+def estimate_data_size(data, depth=0):
+    """Estimate the number of bytes some data takes up in memory"""
+    match data:
+        case np.ndarray():
+            return data.nbytes + sys.getsizeof(np.empty(0))
+        case pd.DataFrame() | pd.Series():
+            return int(np.sum(data.memory_usage(deep=True)))
+        case _ if depth > 2:
+            # Don't spend too long on deeply nested data
+            return sys.getsizeof(data)
+        case dict():
+            return sys.getsizeof(data) + sum(
+                estimate_data_size(k, depth + 1) + estimate_data_size(v, depth + 1)
+                for k, v in data.items()
+            )
+        case list() | tuple() | set() | frozenset():
+            return sys.getsizeof(data) + sum(
+                estimate_data_size(d, depth + 1) for d in data
+            )
+        case _:
+            return sys.getsizeof(data)
@@ -1,6 +1,4 @@
-import os
-import importlib.util
-
+from yaht.discovery import discover_modules
 
 OUTPUTS = {}
 
@@ -45,18 +43,12 @@ def default_output(value, metadata):
     print("┗" + "━" * overall_width + "┛")
 
 
-def find_outputs():
-    """Import files in current directory to find outputs"""
-    for dirpath, dirnames, filenames in os.walk("."):
-        for filename in [f for f in filenames if f.endswith(".py")]:
-            # Construct the module name from the file path
-            module_name = os.path.splitext(filename)[0]
-            # Construct the full path to the .py file
-            file_path = os.path.join(dirpath, filename)
-            # Import the module
-            spec = importlib.util.spec_from_file_location(module_name, file_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
+def find_outputs(output_names=None, settings=None):
+    """
+    Import the modules which register the named outputs,
+    or every module registering outputs if no names are given
+    """
+    discover_modules("register_output", OUTPUTS, output_names, settings)
 
 
 def output_results(result_df):
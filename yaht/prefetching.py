@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import time
+import threading
+import concurrent.futures
+import yaht.cache_management as CM
+from yaht.memory_cache import estimate_data_size
+
+
+class Prefetcher:
+    """
+    Load data from the cache in a background thread before it's needed,
+    keeping at most a budget of bytes of loaded data waiting to be used
+    """
+
+    def __init__(self, cache_dir, budget=None):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.loader = concurrent.futures.ThreadPoolExecutor(1)
+        self.prefetches = {}
+        self.sizes = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.hidden_time = 0.0
+        self.waited_time = 0.0
+
+    def __contains__(self, data_hash):
+        return data_hash in self.prefetches
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def prefetch(self, metadata):
+        """Start loading some data, unless it already is or the budget is used up"""
+        data_hash = metadata["hash"]
+        with self.lock:
+            if data_hash in self.prefetches:
+                return False
+            if self.budget is not None and self.size >= self.budget:
+                return False
+            # The size of the file stands in until the data is loaded
+            data_size = metadata.get("size", None)
+            self.reserve(
+                data_hash, 0 if CM.is_empty_metadata_value(data_size) else data_size
+            )
+        self.prefetches[data_hash] = self.loader.submit(self.load, metadata)
+        return True
+
+    def load(self, metadata):
+        """Load data in the background, timing how long it takes"""
+        start_time = time.perf_counter()
+        data = CM.read_cache_file(self.cache_dir, metadata)
+        load_time = time.perf_counter() - start_time
+        with self.lock:
+            if metadata["hash"] in self.sizes:
+                self.reserve(metadata["hash"], estimate_data_size(data))
+        return data, load_time
+
+    def reserve(self, data_hash, data_size):
+        self.size += data_size - self.sizes.get(data_hash, 0)
+        self.sizes[data_hash] = data_size
+
+    def take(self, data_hash):
+        """
+        Get some prefetched data, waiting for it if it's still loading,
+        and keep track of how much loading time was hidden by prefetching
+        """
+        prefetch = self.prefetches.pop(data_hash)
+        start_time = time.perf_counter()
+        try:
+            data, load_time = prefetch.result()
+        finally:
+            with self.lock:
+                self.size -= self.sizes.pop(data_hash)
+        waited_time = time.perf_counter() - start_time
+        self.hits += 1
+        self.hidden_time += max(load_time - waited_time, 0)
+        self.waited_time += waited_time
+        return data
+
+    def close(self):
+        """Stop loading anything that hasn't started, dropping what was prefetched"""
+        for prefetch in self.prefetches.values():
+            prefetch.cancel()
+        self.loader.shutdown(wait=True)
+        self.prefetches = {}
+        self.sizes = {}
+        self.size = 0
+
+    def stats(self):
+        """Return how useful prefetching was"""
+        return {
+            "hits": self.hits,
+            "hidden_time": self.hidden_time,
+            "waited_time": self.waited_time,
+        }
@@ -1,15 +1,39 @@
 #!/usr/bin/env python3
-import os
-import sys
-import importlib.util
+import ast
+import inspect
+import textwrap
+from hashlib import sha256
+from yaht.discovery import discover_modules
 
 
 PROCESSES = {}
+PROCESS_OPTIONS = {}
+# Where processes can be run when running in parallel, by default in worker processes
+EXECUTORS = ["inline", "thread", "process"]
+DEFAULT_EXECUTOR = "process"
+# Fingerprints of the code of process functions, by function
+_FINGERPRINTS = {}
+
+
+def register_process(proc=None, **options):
+    """
+    Decorator to register a process, which can also be given options;
+    - mmap_inputs: True or a list of argument names, to memory map those inputs
+    - lazy_inputs: True or a list of argument names, to only load those inputs
+      from the cache when they are first used
+    - executor: "process", "thread" or "inline", to run the process in a worker
+      process, a thread sharing data in memory, or the main thread when in parallel
+    - version: identifies the version of the process instead of its code,
+      so its results are only recomputed when the version changes
+    """
+    # Allow the decorator to be used as @register_process(option=...)
+    if proc is None:
+        return lambda proc: register_process(proc, **options)
+    if options.get("executor", DEFAULT_EXECUTOR) not in EXECUTORS:
+        raise ValueError("Unknown executor %s" % options["executor"])
 
-
-def register_process(proc):
-    """Decorator to register a process"""
     PROCESSES[proc.__name__] = proc
+    PROCESS_OPTIONS[proc.__name__] = options
     return proc
 
 
@@ -18,38 +42,116 @@ def get_process(proc_name):
     return PROCESSES[proc_name]
 
 
-# def find_processes():
-#     """Import files in current directory to find processes"""
-#     for dirpath, dirnames, filenames in os.walk("."):
-#         for filename in [f for f in filenames if f.endswith(".py")]:
-#             # Construct the module name from the file path
-#             module_name = os.path.splitext(filename)[0]
-#             # Construct the full path to the .py file
-#             file_path = os.path.join(dirpath, filename)
-#             # Import the module
-#             spec = importlib.util.spec_from_file_location(module_name, file_path)
-#             module = importlib.util.module_from_spec(spec)
-#             spec.loader.exec_module(module)
-
-
-def find_processes():
-    cwd = os.getcwd()
-    if cwd not in sys.path:
-        sys.path.insert(0, cwd)
-
-    for dirpath, _, filenames in os.walk("."):
-        for filename in [f for f in filenames if f.endswith(".py")]:
-            file_path = os.path.join(dirpath, filename)
-            module_name = os.path.splitext(os.path.relpath(file_path, cwd))[0].replace(
-                os.sep, "."
-            )
-
-            spec = importlib.util.spec_from_file_location(module_name, file_path)
-            module = importlib.util.module_from_spec(spec)
-            try:
-                spec.loader.exec_module(module)
-            except ModuleNotFoundError as e:
-                print(f"Error importing {file_path}: {e}")
+def get_process_options(proc_name):
+    """Function to return the options a process was registered with"""
+    return PROCESS_OPTIONS.get(proc_name, {})
+
+
+def get_process_executor(proc_function):
+    """Get where a process should be run when running in parallel"""
+    options = get_process_options(proc_function.__name__)
+    return options.get("executor", DEFAULT_EXECUTOR)
+
+
+def get_process_fingerprint(proc_function, visiting=None):
+    """
+    Fingerprint the code of a process and of any yaht processes it calls,
+    so changing them changes the hashes of the results of the process
+    """
+    if proc_function in _FINGERPRINTS:
+        return _FINGERPRINTS[proc_function]
+    options = get_process_options(proc_function.__name__)
+    if "version" in options:
+        fingerprint = sha256(("version:%s" % options["version"]).encode())
+        return _FINGERPRINTS.setdefault(proc_function, fingerprint.hexdigest())
+
+    fingerprint = sha256(get_normalized_code(proc_function).encode())
+    # Processes calling each other can't include each other's fingerprints
+    visiting = (visiting or set()) | {proc_function}
+    for called_process in get_called_processes(proc_function):
+        if called_process in visiting:
+            continue
+        fingerprint.update(get_process_fingerprint(called_process, visiting).encode())
+    # Only complete fingerprints are saved
+    if len(visiting) > 1:
+        return fingerprint.hexdigest()
+    return _FINGERPRINTS.setdefault(proc_function, fingerprint.hexdigest())
+
+
+def get_normalized_code(proc_function):
+    """
+    Get the code of a function without its formatting, comments, docstring or
+    decorators, falling back to its bytecode if the source can't be found
+    """
+    try:
+        proc_source = textwrap.dedent(inspect.getsource(proc_function))
+        function_node = ast.parse(proc_source).body[0]
+    except (OSError, TypeError, SyntaxError, IndexError):
+        function_node = None
+    if isinstance(function_node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        function_node.decorator_list = []
+        function_body = function_node.body
+        if (
+            len(function_body) > 1
+            and isinstance(function_body[0], ast.Expr)
+            and isinstance(function_body[0].value, ast.Constant)
+            and isinstance(function_body[0].value.value, str)
+        ):
+            function_node.body = function_body[1:]
+        return ast.dump(function_node)
+    # Lambdas and functions without source files are fingerprinted by bytecode
+    return get_bytecode(getattr(proc_function, "__code__", None))
+
+
+def get_bytecode(code):
+    """Get the bytecode of a code object and any code objects nested in it"""
+    if code is None:
+        return ""
+    constants = [
+        get_bytecode(c) if inspect.iscode(c) else repr(c) for c in code.co_consts
+    ]
+    return "%s|%s|%s" % (code.co_code.hex(), code.co_names, constants)
+
+
+def get_called_processes(proc_function):
+    """Find the yaht processes a function refers to by name"""
+    code_names = set()
+    code_objects = [getattr(proc_function, "__code__", None)]
+    while len(code_objects):
+        code = code_objects.pop()
+        if code is None:
+            continue
+        code_names.update(code.co_names)
+        code_objects += [c for c in code.co_consts if inspect.iscode(c)]
+    proc_globals = getattr(proc_function, "__globals__", {})
+    return [
+        PROCESSES[name]
+        for name in sorted(code_names)
+        if name in PROCESSES and proc_globals.get(name, None) is PROCESSES[name]
+    ]
+
+
+def get_input_flags(proc_function, option_name, n_inputs):
+    """
+    Turn an option set per input of a process, either True for every input
+    or a list of argument names, into a flag for each of the inputs it is given
+    """
+    option = get_process_options(proc_function.__name__).get(option_name, False)
+    if option is True or option is False:
+        return [option] * n_inputs
+    # Inputs are given positionally, so match them to the argument names in order
+    arg_names = list(inspect.signature(proc_function).parameters)[:n_inputs]
+    arg_names += [None] * (n_inputs - len(arg_names))
+    return [a in option for a in arg_names]
+
+
+def find_processes(process_names=None, settings=None):
+    """
+    Import the modules under the current directory (or installed packages) which
+    register the named processes, or every module registering processes if no
+    names are given; which files are searched is set by the discovery settings
+    """
+    discover_modules("register_process", PROCESSES, process_names, settings)
 
 
 # Collection of example processes
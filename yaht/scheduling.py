@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import math
+import collections.abc
+
+SCHEDULE_METHODS = ["successive_halving", "hyperband"]
+DEFAULT_SCHEDULE_METHOD = "successive_halving"
+SCHEDULE_MODES = ["max", "min"]
+
+
+class RungTrials(collections.abc.Mapping):
+    """
+    The trials promoted to a rung of a schedule, with their budget parameter
+    set to the rung's budget; parameters are only assembled when they are used
+    """
+
+    def __init__(self, trials, trial_names, budget_param, budget):
+        self.trials = trials
+        self.trial_names = list(trial_names)
+        self.budget_param = budget_param
+        self.budget = budget
+
+    def __len__(self):
+        return len(self.trial_names)
+
+    def __iter__(self):
+        return iter(self.trial_names)
+
+    def __getitem__(self, trial_name):
+        if trial_name not in self.trial_names:
+            raise KeyError(trial_name)
+        return self.trials[trial_name] | {self.budget_param: self.budget}
+
+
+def parse_schedule(schedule_config):
+    """
+    Parse the schedule of an experiment, which runs its trials at a small budget
+    first and promotes the best of them (by a result) to larger budgets
+    """
+    schedule = {
+        "method": schedule_config.get("method", DEFAULT_SCHEDULE_METHOD),
+        "mode": schedule_config.get("mode", "max"),
+        "min_budget": schedule_config.get("min_budget", 1),
+        "eta": schedule_config.get("eta", 3),
+    }
+    for key in ["budget", "metric", "max_budget"]:
+        if key not in schedule_config:
+            raise ValueError("Schedules need a %s" % key)
+        schedule[key] = schedule_config[key]
+    if schedule["method"] not in SCHEDULE_METHODS:
+        raise ValueError("Unknown schedule method %s" % schedule["method"])
+    if schedule["mode"] not in SCHEDULE_MODES:
+        raise ValueError("Unknown schedule mode %s" % schedule["mode"])
+    if not 0 < schedule["min_budget"] <= schedule["max_budget"]:
+        raise ValueError("Schedule budgets must be positive, with min <= max")
+    if schedule["eta"] <= 1:
+        raise ValueError("Schedules must keep a fraction (1/eta) with eta > 1")
+    return schedule
+
+
+def get_rung_budgets(schedule):
+    """
+    Get the budget of each rung, growing by eta up to the max budget,
+    e.g. 1, 3, 9, 27; budgets are whole numbers if both limits are
+    """
+    min_budget, max_budget, eta = (
+        schedule["min_budget"],
+        schedule["max_budget"],
+        schedule["eta"],
+    )
+    # A little leeway stops floating point error losing a rung
+    n_rungs = math.floor(math.log(max_budget / min_budget, eta) + 1e-9) + 1
+    budgets = [max_budget / eta**k for k in reversed(range(n_rungs))]
+    if type(min_budget) is int and type(max_budget) is int:
+        return [max(int(round(b)), min_budget) for b in budgets]
+    return budgets
+
+
+def get_schedule_brackets(schedule, trial_names):
+    """
+    Split trials into the brackets of a schedule, each a list of budgets
+    and the trials starting at the first of them; successive halving has a single
+    bracket, while hyperband also starts fewer trials at each larger budget,
+    in case a small budget isn't enough to tell trials apart
+    """
+    budgets = get_rung_budgets(schedule)
+    trial_names = list(trial_names)
+    if schedule["method"] == "successive_halving":
+        return [(budgets, trial_names)]
+    # Each bracket gets a share of the trials, as hyperband would sample for it
+    s_max = len(budgets) - 1
+    weights = [
+        math.ceil((s_max + 1) / (s + 1) * schedule["eta"] ** s)
+        for s in reversed(range(s_max + 1))
+    ]
+    brackets = []
+    start = 0
+    for i, weight in enumerate(weights):
+        end = round(len(trial_names) * sum(weights[: i + 1]) / sum(weights))
+        if end > start:
+            brackets.append((budgets[i:], trial_names[start:end]))
+        start = end
+    return brackets
+
+
+def count_promoted(n_trials, schedule):
+    """Count how many of the trials of a rung are promoted to the next"""
+    return max(math.floor(n_trials / schedule["eta"]), 1)
+
+
+def select_top_trials(scores, n_top, mode="max"):
+    """
+    Select the best scoring trials, keeping their order for ties;
+    trials without a score (e.g. nan) are never selected before ones with
+    """
+    is_missing = lambda s: s is None or s != s
+    ranked = sorted(
+        scores,
+        key=lambda t: (
+            is_missing(scores[t]),
+            0 if is_missing(scores[t]) else -scores[t] if mode == "max" else scores[t],
+        ),
+    )
+    top_trials = set(ranked[:n_top])
+    return [t for t in scores if t in top_trials]
+
+
+def get_rung_name(exp_name, budget, bracket=None):
+    """Name the experiment a rung is run as, e.g. some_experiment@9"""
+    if bracket is None:
+        return "%s@%s" % (exp_name, budget)
+    return "%s[%d]@%s" % (exp_name, bracket, budget)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import pickle
+import importlib.util
+import numpy as np
+import pandas as pd
+
+SERIALIZERS = {}
+TYPE_SERIALIZERS = {}
+DEFAULT_SERIALIZER = "pickle"
+
+
+def register_serializer(
+    data_type, dump, load, ext="", name=None, mmap_load=None, subtypes=True
+):
+    """
+    Register the functions used to store and load data of a given type in the cache;
+    dump(data, file) and load(file) are given binary files to write to or read from,
+    and mmap_load(path), if given, loads the data as a read-only memory map.
+    Serializers are used for subtypes of their type too, unless subtypes is False
+    """
+    name = name or ext.lstrip(".") or data_type.__name__
+    SERIALIZERS[name] = {
+        "name": name,
+        "type": data_type,
+        "dump": dump,
+        "load": load,
+        "ext": ext,
+        "mmap_load": mmap_load,
+        "subtypes": subtypes,
+    }
+    TYPE_SERIALIZERS[data_type] = name
+    return SERIALIZERS[name]
+
+
+def get_serializer(serializer_name):
+    """Function to return a serializer by name, defaulting to pickle"""
+    if pd.isnull(serializer_name):
+        return SERIALIZERS[DEFAULT_SERIALIZER]
+
+    return SERIALIZERS[serializer_name]
+
+
+def get_serializer_exts():
+    """Return the file extension of every registered serializer by name"""
+    return {name: s["ext"] for name, s in SERIALIZERS.items()}
+
+
+def find_serializer(data):
+    """Find the most specific serializer registered for the type of some data"""
+    for data_type in type(data).__mro__:
+        if data_type in TYPE_SERIALIZERS:
+            serializer = SERIALIZERS[TYPE_SERIALIZERS[data_type]]
+            if serializer["subtypes"] or data_type is type(data):
+                return serializer
+
+    return SERIALIZERS[DEFAULT_SERIALIZER]
+
+
+def mmap_load_npy(path):
+    """Memory map a .npy file, loading arrays of python objects normally"""
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Arrays of python objects can't be memory mapped
+        return np.load(path, allow_pickle=True)
+
+
+# Serializers that come with yaht
+register_serializer(
+    object,
+    lambda data, f: pickle.dump(data, f, protocol=5),
+    pickle.load,
+    name=DEFAULT_SERIALIZER,
+)
+register_serializer(
+    np.ndarray,
+    lambda data, f: np.save(f, data),
+    lambda f: np.load(f, allow_pickle=True),
+    ext=".npy",
+    mmap_load=mmap_load_npy,
+    # Subclasses like masked arrays would come back as plain arrays
+    subtypes=False,
+)
+# Columnar storage of dataframes is only available if pyarrow is installed
+if importlib.util.find_spec("pyarrow") is not None:
+    register_serializer(
+        pd.DataFrame,
+        lambda data, f: data.to_parquet(f),
+        pd.read_parquet,
+        ext=".parquet",
+        subtypes=False,
+    )
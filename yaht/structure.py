@@ -1,32 +1,30 @@
 #!/usr/bin/env python3
+import os
+import uuid
+import pickle
 import inspect
 import itertools
 import pandas as pd
-import networkx as nx
 from hashlib import sha256
-from yaht.processes import get_process
+from yaht.processes import get_process, get_process_fingerprint
+from yaht.hashing import encode_canonical
+from yaht.sweeps import SweepTrials
+
+# Compiled structures are cached in this directory of the cache, by config and code
+STRUCTURE_CACHE_DIR = "structures"
+# Version of the format of cached structures, so older ones aren't loaded
+STRUCTURE_CACHE_VERSION = 1
+# How many compiled structures are kept, removing the least recently used first
+STRUCTURE_CACHE_SIZE = 8
+# Names of the parameters of process functions, by function
+_FUNCTION_PARAMS = {}
+# Orders processes must be run in, by their dependencies
+_PROC_ORDERS = {}
 
 
 def generate_laboratory_structure(config):
     """Convert a nested dictionary config into a dataframe structure"""
-    laboratory_structure = pd.DataFrame()
-
-    # Generate every experiment structure
-    source_hashes = config.get("source_hashes", {})
-    experiment_configs = config.get("experiments")
-    for exp_name, exp_config in experiment_configs.items():
-        # Substitute the global source hashes into the experiment config
-        exp_config["source_hashes"] = source_hashes
-        # Generate the experiment structure
-        exp_structure = generate_experiment_structure(exp_config)
-        # Set other values for the experiment
-        exp_structure["experiment"] = exp_name
-        # Append to the global lab structure
-        laboratory_structure = pd.concat(
-            [laboratory_structure, exp_structure], ignore_index=True
-        )
-
-    return laboratory_structure
+    return structure_from_records(generate_laboratory_records(config))
 
 
 def generate_experiment_structure(config):
@@ -34,42 +32,278 @@ def generate_experiment_structure(config):
     Generate the structure of an experiment given a config
     in the form of a pandas dataframe
     """
-    experiment_structure = pd.DataFrame()
+    return structure_from_records(generate_experiment_records(config))
+
+
+def generate_trial_structure(config):
+    """Generate a structure dataframe with a row for each process"""
+    return structure_from_records(generate_trial_records(config))
 
-    # Assemble the parameters for each trial
-    global_params = config.get("parameters", {})
-    trial_configs = config.get("trials", {})
-    trial_configs["control"] = {}  # Add a control trial
-    for trial in trial_configs:
-        trial_configs[trial] = global_params | trial_configs[trial]
 
-    # Generate the config for each trial
+def structure_from_records(records):
+    """Assemble the records of processes into a single structure dataframe"""
+    return pd.DataFrame.from_records(records)
+
+
+def load_laboratory_records(config, cache_dir):
+    """
+    Generate the records of every process in a lab, reusing the records
+    compiled before (and cached) for the same config and process code
+    """
+    structure_key = get_structure_key(config)
+    structure_path = os.path.join(
+        cache_dir, STRUCTURE_CACHE_DIR, structure_key + ".pkl"
+    )
+    try:
+        with open(structure_path, "rb") as structure_file:
+            laboratory_records = pickle.load(structure_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        laboratory_records = None
+
+    if laboratory_records is None:
+        laboratory_records = generate_laboratory_records(config)
+        store_laboratory_records(structure_path, laboratory_records)
+        return laboratory_records
+
+    os.utime(structure_path)
+    return link_record_functions(laboratory_records)
+
+
+def load_laboratory_batches(config, batch_size, cache_dir):
+    """
+    Generate the records of every process in a lab a batch of trials at a time,
+    reusing the batches compiled before (and cached) for the same config,
+    batch size and process code; batches are cached one after another in a
+    single file, so they can also be loaded a batch at a time
+    """
+    structure_key = get_structure_key(config)
+    structure_path = os.path.join(
+        cache_dir, STRUCTURE_CACHE_DIR, "%s-%d.pkl" % (structure_key, batch_size)
+    )
+    n_loaded = 0
+    try:
+        with open(structure_path, "rb") as structure_file:
+            os.utime(structure_path)
+            while True:
+                try:
+                    batch_records = pickle.load(structure_file)
+                except EOFError:
+                    return
+                n_loaded += 1
+                yield link_record_functions(batch_records)
+    except (OSError, pickle.UnpicklingError):
+        pass
+
+    # Batches that were already loaded from a broken cache aren't given again
+    batches = store_laboratory_batches(
+        structure_path, iter_laboratory_batches(config, batch_size)
+    )
+    yield from itertools.islice(batches, n_loaded, None)
+
+
+def link_record_functions(laboratory_records):
+    """Look up the functions of cached records again by name, as they aren't cached"""
+    proc_functions = {}
+    for record in laboratory_records:
+        function_name = record["function_name"]
+        if function_name not in proc_functions:
+            proc_functions[function_name] = get_process(function_name)
+        record["function"] = proc_functions[function_name]
+    return laboratory_records
+
+
+def store_laboratory_records(structure_path, laboratory_records):
+    """Cache compiled records, keeping only the most recently used structures"""
+    cached_records = [r | {"function": None} for r in laboratory_records]
+    os.makedirs(os.path.dirname(structure_path), exist_ok=True)
+    temp_path = structure_path + ".tmp"
+    try:
+        with open(temp_path, "wb") as structure_file:
+            pickle.dump(cached_records, structure_file)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        # Structures with parameters that can't be pickled aren't cached
+        os.remove(temp_path)
+        return
+    os.replace(temp_path, structure_path)
+    prune_structure_cache(os.path.dirname(structure_path))
+
+
+def store_laboratory_batches(structure_path, batches):
+    """
+    Cache batches of compiled records as they're generated, passing them on;
+    they're only cached once every batch has been generated
+    """
+    os.makedirs(os.path.dirname(structure_path), exist_ok=True)
+    # Batches can take a while to generate, so other labs get their own temp files
+    temp_path = "%s.%s.tmp" % (structure_path, uuid.uuid4().hex)
+    structure_file = open(temp_path, "wb")
+    try:
+        for batch_records in batches:
+            if structure_file is not None:
+                cached_records = [r | {"function": None} for r in batch_records]
+                try:
+                    pickle.dump(cached_records, structure_file)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    # Structures with parameters that can't be pickled aren't cached
+                    structure_file.close()
+                    os.remove(temp_path)
+                    structure_file = None
+            yield batch_records
+    except BaseException:
+        # Including the batches not all being needed
+        if structure_file is not None:
+            structure_file.close()
+            os.remove(temp_path)
+        raise
+    if structure_file is not None:
+        structure_file.close()
+        os.replace(temp_path, structure_path)
+        prune_structure_cache(os.path.dirname(structure_path))
+
+
+def prune_structure_cache(structure_dir):
+    """Remove all but the most recently used cached structures"""
+    structure_paths = [
+        os.path.join(structure_dir, f)
+        for f in os.listdir(structure_dir)
+        if f.endswith(".pkl")
+    ]
+    structure_paths.sort(key=os.path.getmtime, reverse=True)
+    for old_path in structure_paths[STRUCTURE_CACHE_SIZE:]:
+        os.remove(old_path)
+
+
+def get_structure_key(config):
+    """
+    Digest a lab config along with the code of the processes it uses,
+    which changes whenever the structure compiled from it would
+    """
+    structure_key = sha256(str(STRUCTURE_CACHE_VERSION).encode())
+    structure_key.update(encode_canonical(config).encode())
+    for function_name in sorted(get_config_function_names(config)):
+        proc_function = get_process(function_name)
+        structure_key.update(function_name.encode())
+        structure_key.update(get_process_fingerprint(proc_function).encode())
+        # Versioned processes aren't fingerprinted by their code,
+        # but their parameters still decide which params they're given
+        structure_key.update(get_function_signature(proc_function).encode())
+    return structure_key.hexdigest()
+
+
+def get_config_function_names(config):
+    """Get the name of every function the processes of a lab config could use"""
+    function_names = set()
+    for exp_config in config.get("experiments").values():
+        function_names.update(get_proc_function_names(exp_config["structure"]).values())
+        # Functions can also be overridden by parameters,
+        # which sweeps can choose between without generating every trial
+        trial_configs = exp_config.get("trials", {})
+        if isinstance(trial_configs, SweepTrials):
+            trial_params = trial_configs.possible_params()
+        else:
+            trial_params = trial_configs.values()
+        for params in [exp_config.get("parameters", {}), *trial_params]:
+            function_names.update(
+                v for p, v in params.items() if p.endswith(".FUNCTION")
+            )
+    return function_names
+
+
+def count_laboratory_trials(config):
+    """Count the trials of every experiment in a lab config, including controls"""
+    return sum(
+        len(exp_config.get("trials", {}))
+        + ("control" not in exp_config.get("trials", {}))
+        for exp_config in config.get("experiments").values()
+    )
+
+
+def generate_laboratory_records(config):
+    """Convert a nested dictionary config into a list of records for every process"""
+    return [
+        record
+        for trial_records in iter_laboratory_trial_records(config)
+        for record in trial_records
+    ]
+
+
+def iter_laboratory_batches(config, batch_size):
+    """
+    Generate the records of every process in a lab a batch of trials at a time,
+    so labs with many trials (e.g. large sweeps) don't need generating all at once
+    """
+    batch_records = []
+    batch_trials = 0
+    for trial_records in iter_laboratory_trial_records(config):
+        batch_records += trial_records
+        batch_trials += 1
+        if batch_trials == batch_size:
+            yield batch_records
+            batch_records = []
+            batch_trials = 0
+    if batch_trials > 0:
+        yield batch_records
+
+
+def iter_laboratory_trial_records(config):
+    """Generate the records of the processes of every trial of a lab in turn"""
+    # Generate every experiment structure, from the same global source hashes
+    source_hashes = dict(config.get("source_hashes", {}))
+    experiment_configs = config.get("experiments")
+    for exp_name, exp_config in experiment_configs.items():
+        # Substitute the global source hashes into (a copy of) the experiment config,
+        # leaving the lab config as it was so it gives the same structure key
+        exp_config = exp_config | {"source_hashes": source_hashes}
+        # Generate the experiment structure, setting other values for the experiment
+        for trial_records in iter_experiment_trial_records(exp_config):
+            for record in trial_records:
+                record["experiment"] = exp_name
+            yield trial_records
+
+
+def generate_experiment_records(config):
+    """Generate the records of the processes of every trial of an experiment"""
+    return [
+        record
+        for trial_records in iter_experiment_trial_records(config)
+        for record in trial_records
+    ]
+
+
+def iter_experiment_trial_records(config):
+    """Generate the records of the processes of each trial of an experiment in turn"""
     source_hashes = config.get("source_hashes", {})
     trial_process_structure = config["structure"]
-    for trial_name, trial_params in trial_configs.items():
+    result_names = config["results"]
+    for trial_name, trial_params in iter_trial_params(config):
         trial_config = {
             "source_hashes": source_hashes,
             "structure": trial_process_structure,
             "parameters": trial_params,
         }
-        trial_structure = generate_trial_structure(trial_config)
-        trial_structure["trial"] = trial_name  # Set the trial name of each process
-        experiment_structure = pd.concat(
-            [experiment_structure, trial_structure], ignore_index=True
-        )
+        trial_records = generate_trial_records(trial_config)
+        for record in trial_records:
+            record["trial"] = trial_name  # Set the trial name of each process
+            # Set the output flag for each process
+            record["results"] = [r in result_names for r in record["result_names"]]
+        yield trial_records
 
-    # Set the output flag for each process
-    result_names = config["results"]
-    result_flags = experiment_structure["result_names"].apply(
-        lambda x: list(map(lambda y: y in result_names, x))
-    )
-    experiment_structure["results"] = result_flags
 
-    return experiment_structure
+def iter_trial_params(config):
+    """
+    Assemble the parameters for each trial of an experiment in turn,
+    followed by a control trial with only the global parameters
+    """
+    global_params = config.get("parameters", {})
+    trial_configs = config.get("trials", {})
+    for trial_name in trial_configs:
+        if trial_name != "control":
+            yield trial_name, global_params | trial_configs[trial_name]
+    yield "control", dict(global_params)
 
 
-def generate_trial_structure(config):
-    """Generate a structure dataframe with a row for each process"""
+def generate_trial_records(config):
+    """Generate a record for each process of a trial, in the order they must run"""
     # Extract the different parts of the config
     params = config.get("parameters", {})
     structure = override_structure(config["structure"], params)
@@ -78,46 +312,52 @@ def generate_trial_structure(config):
     proc_sources = get_proc_source_names(structure)
     proc_results = get_proc_result_names(structure)
     # And extract the order procs should be run it
-    proc_names = get_organized_proc_names(proc_sources, proc_results)
-    proc_order = {proc_names[i]: i for i in range(len(proc_names))}
+    proc_names = get_proc_order(proc_sources, proc_results)
     # Get the function for each process
+    proc_function_names = get_proc_function_names(structure)
     proc_functions = get_proc_functions(structure)
     # Extract the parameters relevant to each process
     proc_params = get_proc_params(proc_functions, params)
 
-    # Put all the parameters into a df
-    structure_df = pd.DataFrame.from_dict(
+    trial_records = [
         {
-            "function": proc_functions,
-            "order": proc_order,
-            "params": proc_params,
-            "source_names": proc_sources,
-            "result_names": proc_results,
+            "name": proc_name,
+            "function": proc_functions[proc_name],
+            "function_name": proc_function_names[proc_name],
+            "order": order,
+            "params": proc_params[proc_name],
+            "source_names": proc_sources[proc_name],
+            "result_names": proc_results[proc_name],
         }
-    )
+        for order, proc_name in enumerate(proc_names)
+    ]
 
     # Generate hashes for the processes and their dependencies
     source_hashes = config.get("source_hashes", {})
-    structure_df = gen_structure_hashes(structure_df, source_hashes)
-
-    # Pull the proc names the structure is indexed by into their own column
-    structure_df.index.names = ["name"]
-    structure_df = structure_df.reset_index()
+    gen_record_hashes(trial_records, source_hashes)
 
-    return structure_df
+    return trial_records
 
 
 def get_proc_functions(structure):
     """Get the function relevant to each process 'name'"""
     proc_functions = {}
-    for proc_name, proc_config in structure.items():
-        # If the function isn't specified, assume it's the same as the proc_name
-        function_name = proc_config.get("function", proc_name)
+    for proc_name, function_name in get_proc_function_names(structure).items():
         proc_functions[proc_name] = get_process(function_name)
 
     return proc_functions
 
 
+def get_proc_function_names(structure):
+    """Get the name of the function relevant to each process 'name'"""
+    proc_function_names = {}
+    for proc_name, proc_config in structure.items():
+        # If the function isn't specified, assume it's the same as the proc_name
+        proc_function_names[proc_name] = proc_config.get("function", proc_name)
+
+    return proc_function_names
+
+
 def get_proc_source_names(structure):
     """Simplify the given structure into a dependency dict"""
     simplified_structure = {}
@@ -140,11 +380,7 @@ def get_proc_params(proc_functions, all_params):
     """Get the relevant parameters for each process in proc_functions"""
     all_proc_params = {}
     for proc_name, proc_function in proc_functions.items():
-        proc_params = [
-            param
-            for param in inspect.signature(proc_function).parameters
-            if param is not inspect.Parameter.empty
-        ]
+        proc_params = get_function_params(proc_function)
         # Read the params from all_params that apply to the given proc
         relevant_params = {p: all_params[p] for p in proc_params if p in all_params}
         override_params = {
@@ -158,8 +394,48 @@ def get_proc_params(proc_functions, all_params):
     return all_proc_params
 
 
+def get_function_params(proc_function):
+    """Get the names of the parameters of a function, which are only looked up once"""
+    if proc_function not in _FUNCTION_PARAMS:
+        _FUNCTION_PARAMS[proc_function] = [
+            param
+            for param in inspect.signature(proc_function).parameters
+            if param is not inspect.Parameter.empty
+        ]
+    return _FUNCTION_PARAMS[proc_function]
+
+
+def get_function_signature(proc_function):
+    """Describe the names and defaults of the parameters of a function"""
+    return str(
+        [
+            (param.name, repr(param.default))
+            for param in inspect.signature(proc_function).parameters.values()
+        ]
+    )
+
+
+def get_proc_order(proc_sources, proc_results):
+    """
+    Get the order procs should be run in, which is only worked out once
+    for each distinct set of dependencies as trials usually share them
+    """
+    dependencies = tuple(
+        (proc_name, tuple(proc_sources[proc_name]), tuple(proc_results[proc_name]))
+        for proc_name in proc_sources
+    )
+    if dependencies not in _PROC_ORDERS:
+        _PROC_ORDERS[dependencies] = get_organized_proc_names(
+            proc_sources, proc_results
+        )
+    return _PROC_ORDERS[dependencies]
+
+
 def get_organized_proc_names(structure, proc_results):
     """Organize processes and their dependencies with networkx"""
+    # Only imported when needed, as cached structures are already organized
+    import networkx as nx
+
     proc_graph = nx.DiGraph()
     for proc_name, proc_sources in structure.items():
         # If there's no sources, it goes at level 0
@@ -211,42 +487,77 @@ def override_structure(structure, parameters):
     return structure
 
 
-def gen_structure_hashes(structure_df, source_hashes):
+def gen_record_hashes(records, source_hashes):
     """
-    Hash the dependencies of each process,
-    and then hash the processes themselves
+    Hash the dependencies of each process record,
+    and then hash the processes themselves, in the order they must be run in
     """
-    # Order the structure based on the order the processes must be run in
-    structure_df.sort_values("order", inplace=True)
-    hash_df = pd.DataFrame(columns=["result_hashes", "source_hashes"])
-
-    for process in structure_df.iterrows():
-        # The process function, params and hashes of dependencies
+    for record in records:
+        # The process function (and its code), params and hashes of dependencies
         # are used to generate a process' hash
-        proc_name = process[0]
-        proc_sources = process[1]["source_names"]
-        proc_params = process[1]["params"]
-        proc_function = process[1]["function"]
-        # A seperate hash is generated for each result
-        proc_results = process[1]["result_names"]
-
         # First retrieve and save the source hashes
-        proc_source_hashes = [source_hashes.get(s) for s in proc_sources]
-        hash_df.loc[proc_name, "source_hashes"] = proc_source_hashes
-        # Then generate and save the result hashes
-        proc_hash = sha256(str(proc_function.__name__).encode())
-        proc_hash.update(str(proc_source_hashes).encode())
-        proc_hash.update(str(proc_params).encode())
-        proc_result_hashes = [proc_hash.copy() for r in proc_results]
-        for i, r in enumerate(proc_results):
-            proc_result_hashes[i].update(str(r).encode())
-            proc_result_hashes[i] = str(proc_result_hashes[i].hexdigest())
-        hash_df.loc[proc_name, "result_hashes"] = proc_result_hashes
+        proc_source_hashes = [source_hashes.get(s) for s in record["source_names"]]
+        record["source_hashes"] = proc_source_hashes
+        # Then generate and save the result hashes,
+        # a seperate hash is generated for each result
+        proc_results = record["result_names"]
+        proc_result_hashes = hash_process_results(
+            record["function"], proc_source_hashes, record["params"], proc_results
+        )
+        record["result_hashes"] = proc_result_hashes
 
         # Also save the result hashes to be used as source hashes for other procs
         for source_name, source_hash in zip(proc_results, proc_result_hashes):
             source_hashes[source_name] = source_hash
 
-    # Return the combined df
-    structure_df = pd.concat([structure_df, hash_df], axis=1)
-    return structure_df
+    return records
+
+
+def hash_process_results(
+    proc_function, source_hashes, params, result_names, legacy=False
+):
+    """
+    Hash each result of a process from its function (and its code),
+    the hashes of its sources and its parameters; legacy hashes are made the way
+    they were before parameters were encoded canonically and code was fingerprinted
+    """
+    encode = str if legacy else encode_canonical
+    proc_hash = sha256(str(proc_function.__name__).encode())
+    if not legacy:
+        proc_hash.update(get_process_fingerprint(proc_function).encode())
+    proc_hash.update(encode(source_hashes).encode())
+    proc_hash.update(encode(params).encode())
+    result_hashes = []
+    for result_name in result_names:
+        result_hash = proc_hash.copy()
+        result_hash.update(str(result_name).encode())
+        result_hashes.append(result_hash.hexdigest())
+    return result_hashes
+
+
+def gen_legacy_result_hashes(structure_df):
+    """
+    Regenerate the result hashes of each process in a lab structure the way they
+    were before parameters were encoded canonically (with str) and process code
+    was fingerprinted, so results cached under those hashes can be found;
+    returns a list of hashes for each row
+    """
+    legacy_hashes = pd.Series(None, index=structure_df.index, dtype=object)
+    for _, trial_structure in structure_df.groupby(["experiment", "trial"]):
+        # Sources that aren't the results of the trial's processes are unchanged
+        trial_hashes = {}
+        for idx, proc_row in trial_structure.sort_values("order").iterrows():
+            proc_source_hashes = [
+                trial_hashes.get(n, h)
+                for n, h in zip(proc_row["source_names"], proc_row["source_hashes"])
+            ]
+            proc_result_hashes = hash_process_results(
+                proc_row["function"],
+                proc_source_hashes,
+                proc_row["params"],
+                proc_row["result_names"],
+                legacy=True,
+            )
+            trial_hashes.update(zip(proc_row["result_names"], proc_result_hashes))
+            legacy_hashes[idx] = proc_result_hashes
+    return legacy_hashes
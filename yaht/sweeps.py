@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import math
+import collections.abc
+import numpy as np
+from yaht.hashing import encode_canonical
+
+SWEEP_METHODS = ["grid", "random", "lhs"]
+DEFAULT_SWEEP_METHOD = "grid"
+# Ways the values of a parameter can be spread over a range
+SPACE_TYPES = ["uniform", "log_uniform"]
+
+
+class SweepTrials(collections.abc.Mapping):
+    """
+    The trials of an experiment, including the points of a parameter sweep,
+    which are only generated when they are used so large sweeps can be streamed;
+    each point is generated the same way every time, so its results are cached
+    """
+
+    def __init__(self, sweep_config, trials=None):
+        self.trials = trials or {}
+        self.method = sweep_config.get("method", DEFAULT_SWEEP_METHOD)
+        if self.method not in SWEEP_METHODS:
+            raise ValueError("Unknown sweep method %s" % self.method)
+        self.name = sweep_config.get("name", "sweep")
+        self.seed = sweep_config.get("seed", 0)
+        self.spaces = {
+            param: parse_space(param, space)
+            for param, space in sorted(sweep_config.get("params", {}).items())
+        }
+        if self.method == "grid":
+            self.grid = [get_grid_values(p, s) for p, s in self.spaces.items()]
+            self.n_points = math.prod(len(v) for v in self.grid)
+        elif "n_trials" not in sweep_config:
+            raise ValueError("%s sweeps need a number of trials" % self.method)
+        else:
+            self.n_points = sweep_config["n_trials"]
+        self.strata = None
+        self.config = sweep_config
+        # Point names are padded to the same width, e.g. sweep_007
+        self.name_width = len(str(max(self.n_points - 1, 0)))
+
+    def __len__(self):
+        return len(self.trials) + self.n_points
+
+    def __iter__(self):
+        yield from self.trials
+        for point in range(self.n_points):
+            yield self.get_point_name(point)
+
+    def __getitem__(self, trial_name):
+        if trial_name in self.trials:
+            return self.trials[trial_name]
+        point = self.get_point_index(trial_name)
+        if point is None:
+            raise KeyError(trial_name)
+        return self.get_point_params(point)
+
+    def __repr__(self):
+        return "SweepTrials(%s, %s)" % (
+            encode_canonical(self.config),
+            encode_canonical(self.trials),
+        )
+
+    def get_point_name(self, point):
+        return "%s_%0*d" % (self.name, self.name_width, point)
+
+    def get_point_index(self, trial_name):
+        """Get which point of the sweep a trial is, or None if it isn't one"""
+        prefix, _, point = trial_name.rpartition("_")
+        if prefix != self.name or not point.isdigit() or len(point) != self.name_width:
+            return None
+        point = int(point)
+        return point if point < self.n_points else None
+
+    def get_point_params(self, point):
+        """Generate the parameters of a point of the sweep"""
+        match self.method:
+            case "grid":
+                # Points count through the grid with the last parameter changing fastest
+                point_params = {}
+                for param, values in reversed(list(zip(self.spaces, self.grid))):
+                    point, value_index = divmod(point, len(values))
+                    point_params[param] = values[value_index]
+                return dict(reversed(point_params.items()))
+            case "random":
+                rng = np.random.default_rng([self.seed, point])
+                return {
+                    param: sample_space(space, rng.uniform())
+                    for param, space in self.spaces.items()
+                }
+            case "lhs":
+                # Each parameter's range is split into a stratum for every point,
+                # and every stratum is sampled once across the sweep
+                strata = self.get_strata()
+                rng = np.random.default_rng([self.seed, point])
+                return {
+                    param: sample_space(
+                        space, (param_strata[point] + rng.uniform()) / self.n_points
+                    )
+                    for (param, space), param_strata in zip(self.spaces.items(), strata)
+                }
+
+    def get_strata(self):
+        """Get the stratum each point samples for each parameter of a latin hypercube"""
+        if self.strata is None:
+            self.strata = [
+                np.random.default_rng([self.seed, self.n_points, i]).permutation(
+                    self.n_points
+                )
+                for i in range(len(self.spaces))
+            ]
+        return self.strata
+
+    def possible_params(self):
+        """
+        Iterate over parameters covering every value trials could choose from
+        a list without generating every point, e.g. to find overridden functions
+        """
+        yield from self.trials.values()
+        for param, space in self.spaces.items():
+            for value in space.get("values", []):
+                yield {param: value}
+
+
+def parse_space(param, space):
+    """
+    Parse the space a parameter is swept over, which can be a list of values,
+    a range to spread values over (uniform or log_uniform) or a single value
+    """
+    match space:
+        case list() | tuple():
+            return {"values": list(space)}
+        case {"values": values}:
+            return {"values": list(values)}
+        case dict() if any(t in space for t in SPACE_TYPES):
+            space_type = next(t for t in SPACE_TYPES if t in space)
+            low, high = map(float, space[space_type])
+            if space_type == "log_uniform" and (low <= 0 or high <= 0):
+                raise ValueError("%s must be swept over positive values" % param)
+            return {
+                "type": space_type,
+                "low": low,
+                "high": high,
+                "n": space.get("n", None),
+                "integer": space.get("integer", False),
+            }
+        case dict():
+            raise ValueError("Unknown space %s for %s" % (space, param))
+        case _:
+            return {"values": [space]}
+
+
+def get_grid_values(param, space):
+    """Get the values a grid sweep takes for a parameter"""
+    if "values" in space:
+        return space["values"]
+    if space["n"] is None:
+        raise ValueError("Grid sweeps need a number of points n for %s" % param)
+    quantiles = np.linspace(0, 1, space["n"])
+    return list(dict.fromkeys(sample_space(space, q) for q in quantiles))
+
+
+def sample_space(space, quantile):
+    """Get the value at a quantile (between 0 and 1) of a space"""
+    if "values" in space:
+        values = space["values"]
+        return values[min(int(quantile * len(values)), len(values) - 1)]
+    low, high = space["low"], space["high"]
+    if quantile <= 0 or quantile >= 1:
+        value = low if quantile <= 0 else high
+    elif space["type"] == "log_uniform":
+        value = math.exp(math.log(low) + quantile * (math.log(high) - math.log(low)))
+    else:
+        value = low + quantile * (high - low)
+    if space["integer"]:
+        return int(round(value))
+    # Rounding off floating point noise keeps values readable, e.g. 0.001
+    return float("%.12g" % value)